@@ -0,0 +1,265 @@
+"""
+Throughput of the compiler on synthetic Worm programs.
+
+Usage: python bench/compiler.py [--json] [--runs N] [--functions N [N ...]]
+                                [--depth D] [--macros M] [--generics G]
+                                [--jobs J] [--no-memory]
+
+Generates a program for each number of functions, each function having
+statements nested D levels deep, M expansions of a worm.block and calling one
+of G instantiations of a worm.generic, then measures each phase of its
+compilation to C: the transform of the import hook, the registration of the
+functions in the context (running the module), the collection of the program
+and each pass of Program.write_source. Times are the best of N runs (3 by
+default), memory is the peak allocated by each phase as seen by tracemalloc
+in a separate run (much slower, skipped with --no-memory). With --json, the
+results are written as a JSON object to track regressions.
+"""
+import argparse
+import ast
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), ".."))
+
+from worm.transformer import transform_ast  # noqa: E402
+
+
+def generate(functions, depth, macros, generics):
+    """
+    Return the source of a synthetic Worm module.
+    """
+    lines = [
+        "@worm.block",
+        "def bump(x, k):",
+        "    x = x + k",
+        "    if x > 1000000:",
+        "        x = x / 2",
+        "",
+        "",
+        "@worm.generic",
+        "def Scale(K):",
+        "    with worm.scope(K=K):",
+        "        @worm",
+        "        def scale(x: int) -> int:",
+        "            return x * K + 1",
+        "",
+        "    return scale",
+        "",
+        "",
+    ]
+    scales = ", ".join(f"scale_{g}=Scale({g + 2})" for g in range(generics))
+    lines.append(f"with worm.scope({scales}):")
+
+    for i in range(functions):
+        lines += ["    @worm", f"    def f{i}(x: int) -> int:", "        y: int = x"]
+        if i > 0:
+            lines.append(f"        y = y + f{i - 1}(x)")
+
+        indent = "        "
+        for level in range(depth):
+            if level % 2 == 0:
+                lines.append(f"{indent}if y > {level}:")
+            else:
+                lines.append(f"{indent}while y > {1000 + level}:")
+            indent += "    "
+            lines += [f"{indent}y = y / 2", f"{indent}x = x + y * {level}"]
+
+        # spread the expansions over the functions
+        share = macros // functions + (i < macros % functions)
+        lines += [f"        bump(x=y, k={k})" for k in range(share)]
+        if generics:
+            lines.append(f"        y = scale_{i % generics}(y)")
+        lines += ["        return x + y", ""]
+
+    lines += [
+        "    @worm.entry",
+        "    def main():",
+        f'        printf("%ld\\n", f{functions - 1}(3))',
+        "",
+    ]
+    return "\n".join(lines)
+
+
+class Sink:
+    """
+    Text file counting and discarding what is written.
+    """
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, text):
+        self.size += len(text)
+        return len(text)
+
+
+def compile_once(source, path, timer, jobs=1):
+    """
+    Compile source (the content of the file path) to C, each phase in a
+    timer context. Return the size of the C source.
+    """
+    from worm import worm
+    from worm.program import Program
+
+    worm.setup_fresh_state()
+    with timer("transform"):
+        tree = transform_ast(ast.parse(source, path))
+        code = compile(tree, path, "exec")
+
+    module = {"__name__": "synthetic", "__file__": path}
+    with timer("registration"):
+        exec(code, module)
+
+    with timer("program"):
+        program = Program.from_context(worm)
+
+    out = Sink()
+    program.write_source(out, jobs=jobs, timer=timer)
+    return out.size
+
+
+def measure(source, path, runs=3, jobs=1, memory=True):
+    """
+    Return the best time in seconds and the peak memory in bytes (None if
+    memory is False) of each phase of the compilation of source, and the size
+    of the C source.
+    """
+    times = {}
+
+    @contextmanager
+    def clock(name):
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        times[name] = min(times.get(name, elapsed), elapsed)
+
+    for _ in range(runs):
+        size = compile_once(source, path, clock, jobs)
+
+    peaks = dict.fromkeys(times)
+    if not memory:
+        return times, peaks, size
+
+    @contextmanager
+    def tracer(name):
+        tracemalloc.reset_peak()
+        base, _ = tracemalloc.get_traced_memory()
+        yield
+        _, peak = tracemalloc.get_traced_memory()
+        peaks[name] = peak - base
+
+    tracemalloc.start()
+    try:
+        compile_once(source, path, tracer, jobs)
+    finally:
+        tracemalloc.stop()
+
+    return times, peaks, size
+
+
+def run(
+    functions=(10, 50, 250),
+    depth=3,
+    macros=1,
+    generics=None,
+    runs=3,
+    jobs=1,
+    memory=True,
+):
+    """
+    Benchmark the compilation of a program for each number of functions, with
+    macros expansions per function and generics instantiations (one per 10
+    functions by default).
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in functions:
+            params = {
+                "functions": n,
+                "depth": depth,
+                "macros": macros * n,
+                "generics": max(1, n // 10) if generics is None else generics,
+            }
+            source = generate(**params)
+            path = os.path.join(tmp, f"synthetic_{n}.wm")
+            with open(path, "w") as f:
+                f.write(source)
+
+            try:
+                times, peaks, size = measure(source, path, runs, jobs, memory)
+            except RecursionError as e:
+                # where the compiler stops scaling
+                results.append({"params": params, "error": f"RecursionError: {e}"})
+                continue
+            results.append(
+                {
+                    "params": params,
+                    "wm_lines": source.count("\n") + 1,
+                    "c_bytes": size,
+                    "total_seconds": sum(times.values()),
+                    "phases": {
+                        name: {
+                            "seconds": times[name],
+                            "peak_kib": peaks[name] and peaks[name] / 1024,
+                        }
+                        for name in times
+                    },
+                }
+            )
+    return {
+        "python": platform.python_version(),
+        "runs": runs,
+        "jobs": jobs,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--functions", type=int, nargs="+", default=[10, 50, 250])
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--macros", type=int, default=1, help="per function")
+    parser.add_argument("--generics", type=int, default=None)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--no-memory", action="store_true")
+    args = parser.parse_args()
+
+    report = run(
+        args.functions,
+        args.depth,
+        args.macros,
+        args.generics,
+        args.runs,
+        args.jobs,
+        not args.no_memory,
+    )
+    if args.json:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+        return
+
+    for result in report["results"]:
+        params = ", ".join(f"{k}={v}" for k, v in result["params"].items())
+        if "error" in result:
+            print(f"{params}: {result['error']}")
+            continue
+        print(f"{params}: {result['wm_lines']} lines -> {result['c_bytes']} bytes of C")
+        for name, phase in result["phases"].items():
+            line = f"  {name:<24} {phase['seconds'] * 1e3:10.2f} ms"
+            if phase["peak_kib"] is not None:
+                line += f" {phase['peak_kib']:10.0f} KiB"
+            print(line)
+        print(f"  {'total':<24} {result['total_seconds'] * 1e3:10.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
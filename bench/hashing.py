@@ -0,0 +1,54 @@
+"""
+Throughput of the std hash functions.
+
+Usage: python bench/hashing.py [--json]
+Requires a C compiler (CC, defaults to cc).
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+sys.path.insert(1, os.path.join(os.path.dirname(__file__), ".."))
+
+from worm.transformer import hook  # noqa: E402
+
+hook(debug=False)
+
+
+def run():
+    from hash_throughput import worm
+
+    with tempfile.TemporaryDirectory() as tmp:
+        exe = os.path.join(tmp, "hash_throughput")
+        worm.save_program(exe, cflags=("-O3", "-march=native"))
+        output = subprocess.run([exe], capture_output=True, text=True)
+
+    results = []
+    for line in output.stdout.splitlines():
+        name, size, nbytes, ns, _ = line.split()
+        results.append(
+            {
+                "function": name,
+                "size": int(size),
+                "bytes": int(nbytes),
+                "seconds": int(ns) / 1e9,
+                "gib_per_s": int(nbytes) / int(ns) * 1e9 / 2**30,
+            }
+        )
+    return results
+
+
+def main():
+    results = run()
+    if "--json" in sys.argv[1:]:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        for r in results:
+            print(f"{r['function']:>8} {r['size']:>6} B  {r['gib_per_s']:8.2f} GiB/s")
+
+
+if __name__ == "__main__":
+    main()
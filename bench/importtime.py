@@ -0,0 +1,90 @@
+"""
+Import time of a Worm module, measured with python -X importtime.
+
+Usage: python bench/importtime.py [--json] [--runs N] [--max-ms MS]
+
+Runs a fresh interpreter importing bench/hash_throughput.wm N times (5 by
+default) and reports the best cumulative import times. Exits with status 1
+if the compiler (worm.program) was loaded, which only building a program
+should do, or if the total is above MS milliseconds.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH)
+
+CODE = "from worm.transformer import hook; hook(); import hash_throughput"
+
+
+def measure():
+    """
+    Return the cumulative import times in microseconds of the modules
+    imported by CODE and their total.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([ROOT, BENCH]))
+    res = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", CODE],
+        capture_output=True,
+        text=True,
+        env=env,
+        cwd=BENCH,
+        check=True,
+    )
+    modules = {}
+    total = 0
+    for line in res.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        modules[name.strip()] = int(cumulative)
+        if not name[1:].startswith(" "):
+            # imported by CODE itself
+            total += int(cumulative)
+    return modules, total
+
+
+def run(runs=5):
+    best = None
+    for _ in range(runs):
+        modules, total = measure()
+        if best is None or total < best[1]:
+            best = modules, total
+    modules, total = best
+    return {
+        "total_ms": total / 1e3,
+        "worm_ms": modules.get("worm.transformer", 0) / 1e3,
+        "module_ms": modules.get("hash_throughput", 0) / 1e3,
+        "compiler_loaded": "worm.program" in modules,
+        "worm_modules": sorted(m for m in modules if m.startswith("worm")),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--max-ms", type=float, default=None)
+    args = parser.parse_args()
+
+    result = run(args.runs)
+    if args.json:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    else:
+        print(f"total      {result['total_ms']:8.1f} ms")
+        print(f"worm       {result['worm_ms']:8.1f} ms")
+        print(f"module     {result['module_ms']:8.1f} ms")
+        print(f"compiler   {'loaded' if result['compiler_loaded'] else 'not loaded'}")
+
+    if result["compiler_loaded"]:
+        sys.exit(1)
+    if args.max_ms is not None and result["total_ms"] > args.max_ms:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
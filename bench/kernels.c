@@ -0,0 +1,139 @@
+/*
+ * Hand written C baseline of kernels.wm, same algorithms, same output.
+ */
+#include <stdio.h>
+#include <stdlib.h>
+#include <stdint.h>
+#include <time.h>
+
+static int64_t now(void){
+    struct timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return (int64_t)t.tv_sec * 1000000000 + t.tv_nsec;
+}
+
+static int64_t fib(int64_t a, int64_t b, int64_t n){
+    while(n > 0){
+        int64_t c = a;
+        a = a + b;
+        b = c;
+        n--;
+    }
+    return a;
+}
+
+static double power(double a, int64_t n){
+    double result = 1.0;
+    double partial = a;
+    while(n > 0){
+        if(n % 2 == 1){
+            result *= partial;
+        }
+        partial *= partial;
+        n /= 2;
+    }
+    return result;
+}
+
+static void fill(int64_t* a, double* b, int64_t size, int64_t seed){
+    int64_t x = seed;
+    for(int64_t i = 0; i < size; i++){
+        x = (x * 1103515245 + 12345) % 2147483648;
+        a[i] = x;
+        b[i] = (double)x / 2147483648.0;
+    }
+}
+
+#define QUICKSORT(name, T) \
+static void name(T* a, int64_t lo, int64_t hi){ \
+    while(lo < hi){ \
+        T pivot = a[(lo + hi) / 2]; \
+        int64_t i = lo, j = hi; \
+        while(i <= j){ \
+            while(a[i] < pivot) i++; \
+            while(a[j] > pivot) j--; \
+            if(i <= j){ \
+                T t = a[i]; \
+                a[i++] = a[j]; \
+                a[j--] = t; \
+            } \
+        } \
+        if(j - lo < hi - i){ \
+            name(a, lo, j); \
+            lo = i; \
+        } else { \
+            name(a, i, hi); \
+            hi = j; \
+        } \
+    } \
+}
+
+QUICKSORT(sort_int, int64_t)
+QUICKSORT(sort_float, double)
+
+static void bench_fib(int64_t rounds){
+    int64_t checksum = 0;
+    int64_t start = now();
+    for(int64_t i = 0; i < rounds; i++){
+        checksum ^= fib(i % 7, 1, 80);
+    }
+    printf("fib %ld %ld\n", now() - start, checksum);
+}
+
+static void bench_pow(int64_t rounds){
+    double total = 0.0;
+    int64_t start = now();
+    for(int64_t i = 0; i < rounds; i++){
+        total += power(1.0 + (double)(i % 1000) / 1000000.0, 4 + i % 16);
+    }
+    printf("pow %ld %.17g\n", now() - start, total);
+}
+
+static void bench_sort(int64_t size){
+    int64_t* a = calloc(size, sizeof(int64_t));
+    double* b = calloc(size, sizeof(double));
+    fill(a, b, size, 42);
+    int64_t start = now();
+    sort_int(a, 0, size - 1);
+    sort_float(b, 0, size - 1);
+    int64_t elapsed = now() - start;
+    int64_t checksum = 0;
+    for(int64_t i = 1; i < size; i++){
+        if(a[i - 1] > a[i] || b[i - 1] > b[i]){
+            checksum++;
+        }
+    }
+    printf("sort %ld %ld\n", elapsed, checksum + a[size / 2]);
+    free(a);
+    free(b);
+}
+
+static void bench_reduce(int64_t size, int64_t rounds){
+    int64_t* a = calloc(size, sizeof(int64_t));
+    double* b = calloc(size, sizeof(double));
+    fill(a, b, size, 7);
+    int64_t total = 0, high = 0;
+    double dot = 0.0;
+    int64_t start = now();
+    for(int64_t r = 0; r < rounds; r++){
+        for(int64_t i = 0; i < size; i++){
+            total += a[i];
+            if(a[i] > high){
+                high = a[i];
+            }
+            dot += b[i] * b[i];
+        }
+    }
+    int64_t elapsed = now() - start;
+    printf("reduce %ld %.17g\n", elapsed, (double)(total + high) + dot);
+    free(a);
+    free(b);
+}
+
+int main(void){
+    bench_fib(2000000);
+    bench_pow(10000000);
+    bench_sort(1000000);
+    bench_reduce(1000000, 100);
+    return 0;
+}
@@ -0,0 +1,122 @@
+"""
+Speed of the generated C against hand written C.
+
+Usage: python bench/runtime.py [--json] [--repeat N] [--cflags FLAGS]
+                               [--max-ratio R]
+
+Compiles bench/kernels.wm (fib, pow, generic quicksort and reductions) and its
+baseline bench/kernels.c with the system C compiler (CC, defaults to cc) and
+the same flags (-O2 by default), runs both N times (5 by default) and reports
+the best time of each kernel and the ratio Worm / C. The checksums of both
+programs must agree. Exits with status 1 if they do not, or if a ratio is
+above R, to catch code generation regressions (extra temporaries, lost
+inlining...).
+"""
+import argparse
+import json
+import math
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(1, os.path.join(BENCH, ".."))
+
+from worm.transformer import hook  # noqa: E402
+
+hook(debug=False)
+
+
+def parse(output):
+    """
+    Return a mapping from kernel to (nanoseconds, checksum).
+    """
+    kernels = {}
+    for line in output.splitlines():
+        name, ns, checksum = line.split()
+        kernels[name] = int(ns), checksum
+    return kernels
+
+
+def same(a, b):
+    """
+    Compare checksums, the float ones up to rounding.
+    """
+    if a == b:
+        return True
+    try:
+        return math.isclose(float(a), float(b), rel_tol=1e-9)
+    except ValueError:
+        return False
+
+
+def run(repeat=5, cflags=("-O2",)):
+    from kernels import worm
+
+    cc = os.environ.get("CC", "cc")
+    with tempfile.TemporaryDirectory() as tmp:
+        exe = os.path.join(tmp, "kernels_wm")
+        baseline = os.path.join(tmp, "kernels_c")
+        worm.save_program(exe, cflags=cflags)
+        subprocess.run(
+            [cc, *cflags, os.path.join(BENCH, "kernels.c"), "-o", baseline],
+            check=True,
+        )
+
+        best = {}
+        for _ in range(repeat):
+            for program in (exe, baseline):
+                output = subprocess.run(
+                    [program], capture_output=True, text=True, check=True
+                ).stdout
+                for name, (ns, checksum) in parse(output).items():
+                    times, checksums = best.setdefault(name, ({}, {}))
+                    times[program] = min(times.get(program, ns), ns)
+                    checksums[program] = checksum
+
+    results = []
+    for name, (times, checksums) in best.items():
+        results.append(
+            {
+                "kernel": name,
+                "worm_seconds": times[exe] / 1e9,
+                "c_seconds": times[baseline] / 1e9,
+                "ratio": times[exe] / times[baseline],
+                "checksum": checksums[exe],
+                "match": same(checksums[exe], checksums[baseline]),
+            }
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--cflags", default="-O2")
+    parser.add_argument("--max-ratio", type=float, default=None)
+    args = parser.parse_args()
+
+    results = run(args.repeat, tuple(shlex.split(args.cflags)))
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        for r in results:
+            status = "" if r["match"] else "  checksum mismatch"
+            print(
+                f"{r['kernel']:>8} {r['worm_seconds'] * 1e3:9.2f} ms"
+                f" {r['c_seconds'] * 1e3:9.2f} ms  x{r['ratio']:.2f}{status}"
+            )
+
+    if not all(r["match"] for r in results):
+        sys.exit(1)
+    if args.max_ratio is not None and any(r["ratio"] > args.max_ratio for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,48 @@
-from .context import WormContext
+"""
+Worm, a language embedded in Python and compiled to C.
 
+The package and its submodules are loaded on first access (PEP 562): running
+Worm modules only loads the AST and the types, the compiler is loaded when a
+program is built (dump_source, save_source, save_program, save_library, jit).
+"""
+import importlib
+import threading
 
-worm = WormContext()
+__all__ = ["worm"]
+
+_submodules = {
+    "bindings",
+    "constants",
+    "context",
+    "errors",
+    "native",
+    "pattern",
+    "prelude",
+    "printf",
+    "program",
+    "std",
+    "transformer",
+    "type_checker",
+    "visitor",
+    "wast",
+    "wtypes",
+}
+_lock = threading.Lock()
+
+
+def __getattr__(name):
+    global worm
+    if name == "worm":
+        with _lock:
+            if "worm" not in globals():
+                from .context import WormContext
+
+                worm = WormContext()
+        return worm
+    elif name in _submodules:
+        return importlib.import_module(f"{__name__}.{name}")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted({*globals(), "worm", *_submodules})
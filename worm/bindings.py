@@ -0,0 +1,185 @@
+"""
+Python bindings of the shared libraries built by Program.save_library.
+
+The functions are described by their Worm types: int, float, bool, str and
+void, and Array[int], Array[float] or Array[bool] for the parameters. load()
+opens a library with ctypes and returns its functions as Python functions.
+
+Arrays are passed without copying: any object supporting the buffer protocol
+(bytes, bytearray, memoryview, array.array, NumPy arrays...) is accepted if it
+is C contiguous and its items are of the type of the elements (8 bytes signed
+integers for int, doubles for float), or if it is a buffer of bytes, read as
+elements in the native layout. The Worm function sees the memory of the
+object for the duration of the call and its changes are visible from Python,
+it must not write to read only objects such as bytes.
+"""
+import ctypes
+import sys
+from types import SimpleNamespace
+
+
+_scalars = {
+    "int": ctypes.c_int64,
+    "float": ctypes.c_double,
+    "bool": ctypes.c_bool,
+    "str": ctypes.c_char_p,
+    "void": None,
+}
+
+# element type to (ctypes type, buffer formats of the same items)
+_elements = {
+    "int": (ctypes.c_int64, {"q", "l", "n"}),
+    "float": (ctypes.c_double, {"d"}),
+    "bool": (ctypes.c_bool, {"?"}),
+}
+
+# formats of buffers read as raw bytes
+_bytes = {"B", "b", "c"}
+
+_PyBUF_FORMAT = 0x0004
+_PyBUF_C_CONTIGUOUS = 0x0038
+
+
+class _Py_buffer(ctypes.Structure):
+    _fields_ = [
+        ("buf", ctypes.c_void_p),
+        ("obj", ctypes.c_void_p),
+        ("len", ctypes.c_ssize_t),
+        ("itemsize", ctypes.c_ssize_t),
+        ("readonly", ctypes.c_int),
+        ("ndim", ctypes.c_int),
+        ("format", ctypes.c_char_p),
+        ("shape", ctypes.POINTER(ctypes.c_ssize_t)),
+        ("strides", ctypes.POINTER(ctypes.c_ssize_t)),
+        ("suboffsets", ctypes.POINTER(ctypes.c_ssize_t)),
+        ("internal", ctypes.c_void_p),
+    ]
+
+
+_get_buffer = ctypes.pythonapi.PyObject_GetBuffer
+_get_buffer.argtypes = [ctypes.py_object, ctypes.POINTER(_Py_buffer), ctypes.c_int]
+_get_buffer.restype = ctypes.c_int
+_release_buffer = ctypes.pythonapi.PyBuffer_Release
+_release_buffer.argtypes = [ctypes.POINTER(_Py_buffer)]
+_release_buffer.restype = None
+
+_array_structs = {}
+
+
+def array_struct(element):
+    """
+    ctypes structure of Array[element].
+    """
+    if element not in _array_structs:
+        c_element = _elements[element][0]
+        _array_structs[element] = type(
+            f"Array_{element}",
+            (ctypes.Structure,),
+            {
+                "_fields_": [
+                    ("length", ctypes.c_int64),
+                    ("elems", ctypes.POINTER(c_element)),
+                ]
+            },
+        )
+    return _array_structs[element]
+
+
+def _item_format(fmt):
+    """
+    Return the item code of the struct format fmt if it has the native byte
+    order, else None.
+    """
+    order = "<" if sys.byteorder == "little" else ">"
+    if fmt[:1] in ("@", "=", order):
+        fmt = fmt[1:]
+    elif fmt[:1] in ("<", ">", "!"):
+        return None
+    return fmt
+
+
+def _as_array(value, element, buffers):
+    """
+    Return the Array[element] structure pointing to the memory of value,
+    recording the buffer to release in buffers.
+    """
+    c_element, formats = _elements[element]
+    view = _Py_buffer()
+    _get_buffer(value, ctypes.byref(view), _PyBUF_C_CONTIGUOUS | _PyBUF_FORMAT)
+    buffers.append(view)
+
+    fmt = _item_format((view.format or b"B").decode())
+    size = ctypes.sizeof(c_element)
+    if fmt in formats and view.itemsize == size:
+        pass
+    elif fmt in _bytes and view.len % size == 0:
+        # raw bytes in the native layout
+        pass
+    else:
+        raise TypeError(
+            f"expected a buffer of {element} items, got format"
+            f" {view.format.decode()!r} of {view.itemsize} byte(s)"
+        )
+
+    elems = ctypes.cast(view.buf, ctypes.POINTER(c_element))
+    return array_struct(element)(view.len // size, elems)
+
+
+def _element_of(type_name):
+    if type_name.startswith("Array[") and type_name.endswith("]"):
+        return type_name[len("Array[") : -1]
+    return None
+
+
+def wrap(function, name, returns, args):
+    """
+    Return a Python function calling the ctypes function function with the
+    Worm return type returns and argument types args (as strings).
+    """
+    elements = [_element_of(arg) for arg in args]
+    function.argtypes = [
+        array_struct(element) if element else _scalars[arg]
+        for arg, element in zip(args, elements)
+    ]
+    function.restype = _scalars[returns]
+
+    def call(*values):
+        if len(values) != len(args):
+            raise TypeError(
+                f"{name}() takes {len(args)} argument(s) ({len(values)} given)"
+            )
+        buffers = []
+        try:
+            converted = []
+            for value, arg, element in zip(values, args, elements):
+                if element is not None:
+                    value = _as_array(value, element, buffers)
+                elif arg == "str" and isinstance(value, str):
+                    value = value.encode("utf-8")
+                converted.append(value)
+            result = function(*converted)
+        finally:
+            for view in buffers:
+                _release_buffer(ctypes.byref(view))
+        if returns == "str" and result is not None:
+            return result.decode("utf-8", "surrogateescape")
+        return result
+
+    call.__name__ = call.__qualname__ = name
+    call.__doc__ = f"{name}({', '.join(args)}) -> {returns}"
+    return call
+
+
+def load(path, signatures):
+    """
+    Open the shared library path and return a namespace of its functions.
+    signatures maps the name of each function to its C symbol, return type
+    and argument types (Worm types as strings).
+    """
+    library = ctypes.CDLL(path)
+    return SimpleNamespace(
+        **{
+            name: wrap(getattr(library, symbol), name, returns, args)
+            for name, (symbol, returns, args) in signatures.items()
+        }
+    )
@@ -0,0 +1,292 @@
+"""
+Python values injected with worm.scope(...) and used as constants.
+
+Scalars (int, bool, float, str) and tables (lists and tuples of int, float or
+str, bytes, bytearray, array.array and one dimensional or flattened NumPy
+arrays) are emitted once as static const globals, so a lookup table computed
+in Python costs nothing at run time. Tables have the Table type: read only,
+indexable and with a length attribute. Numeric tables keep the width of their
+elements (bytes are uint8_t, an array.array("h") int16_t...) and are read as
+int or float.
+
+Identical values share the same global, whatever function uses them. Tables
+larger than INLINE_LIMIT bytes are embedded as a string literal holding their
+raw bytes (in the byte order of the compiling machine) instead of an
+initialiser list, which the C compiler parses much faster.
+
+Other values are ignored, but a function using a value that looks like a
+constant and cannot be one (an empty or nested list, a list mixing strings and
+numbers, an int out of the int64 range...) is rejected with the reason (see
+constant_error).
+"""
+import array
+import math
+import struct
+from hashlib import sha1
+
+from .errors import WormTypeError
+from .native import c_string
+from .wtypes import Table, to_c_type
+
+
+INLINE_LIMIT = 4096
+
+_int_limits = {
+    "int8_t": (-(1 << 7), 1 << 7),
+    "int16_t": (-(1 << 15), 1 << 15),
+    "int32_t": (-(1 << 31), 1 << 31),
+    "int64_t": (-(1 << 63), 1 << 63),
+    "uint8_t": (0, 1 << 8),
+    "uint16_t": (0, 1 << 16),
+    "uint32_t": (0, 1 << 32),
+    "uint64_t": (0, 1 << 64),
+}
+
+# storage type to struct format (native byte order and sizes)
+_formats = {
+    "int8_t": "b",
+    "int16_t": "h",
+    "int32_t": "i",
+    "int64_t": "q",
+    "uint8_t": "B",
+    "uint16_t": "H",
+    "uint32_t": "I",
+    "uint64_t": "Q",
+    "float": "f",
+    "double": "d",
+}
+
+
+class Constant:
+    """
+    A global constant: its C name, Worm type and C definition (generated on
+    first access, large tables are only rendered when emitted).
+    """
+
+    def __init__(self, name, type_, define):
+        self.name = name
+        self.type = type_
+        self._define = define
+        self._definition = None
+
+    @property
+    def definition(self):
+        if self._definition is None:
+            self._definition = self._define(self.name)
+        return self._definition
+
+    def render(self):
+        """
+        Return the C definition without keeping it (see MakeCSource.write).
+        """
+        if self._definition is not None:
+            return self._definition
+        return self._define(self.name)
+
+    def __repr__(self):
+        return f"Constant('{self.name}')"
+
+
+def c_number(x, storage):
+    """
+    C literal for the number x stored as storage.
+    """
+    if storage in ("float", "double"):
+        if math.isnan(x):
+            return '__builtin_nan("")'
+        elif math.isinf(x):
+            return "__builtin_inf()" if x > 0 else "-__builtin_inf()"
+        literal = float(x).hex()
+        return literal + "f" if storage == "float" else literal
+    elif x == -(1 << 63):
+        return "(-9223372036854775807LL - 1)"
+    elif storage == "uint64_t":
+        return f"{x}ULL"
+    else:
+        return f"{x}LL" if storage.endswith("64_t") else str(x)
+
+
+def _blob(data):
+    """
+    String literal holding data, split in lines.
+    """
+    lines = [c_string(data[i : i + 64]) for i in range(0, len(data), 64)]
+    # ?? sequences could form trigraphs
+    return "\n".join(line.replace("?", "\\077") for line in lines)
+
+
+def _storage_of_typecode(typecode, itemsize):
+    if typecode in "fd":
+        return "float" if itemsize == 4 else "double"
+    elif typecode in "bhilq":
+        return f"int{8 * itemsize}_t"
+    elif typecode in "BHILQ":
+        return f"uint{8 * itemsize}_t"
+    return None
+
+
+def _numpy_storage(dtype):
+    if dtype.kind == "f" and dtype.itemsize in (4, 8):
+        return "float" if dtype.itemsize == 4 else "double"
+    elif dtype.kind == "i":
+        return f"int{8 * dtype.itemsize}_t"
+    elif dtype.kind in "ub":
+        return f"uint{8 * dtype.itemsize}_t"
+    return None
+
+
+def _table(value):
+    """
+    Return the storage type and the elements (a list of Python values) or raw
+    native bytes of value, or None if value is not a table. Raise a
+    WormTypeError if value looks like a table but cannot be one.
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return "uint8_t", bytes(value)
+    elif isinstance(value, array.array):
+        storage = _storage_of_typecode(value.typecode, value.itemsize)
+        if storage is None:
+            raise WormTypeError(f"array.array('{value.typecode}') is not supported")
+        return storage, value.tobytes()
+    elif hasattr(value, "dtype") and hasattr(value, "tobytes"):
+        # NumPy is not imported, any array with this interface is accepted
+        storage = _numpy_storage(value.dtype)
+        if storage is None:
+            raise WormTypeError(f"arrays of {value.dtype} are not supported")
+        native = value.dtype.newbyteorder("=")
+        return storage, value.astype(native, order="C").tobytes(order="C")
+    elif isinstance(value, (list, tuple)):
+        if not value:
+            raise WormTypeError("an empty table has no element type")
+        elif all(isinstance(v, str) for v in value):
+            return "char*", list(value)
+        elif all(isinstance(v, (int, bool)) for v in value):
+            low, high = _int_limits["int64_t"]
+            if not all(low <= v < high for v in value):
+                raise WormTypeError("the elements must fit in an int64")
+            return "int64_t", [int(v) for v in value]
+        elif all(isinstance(v, (int, bool, float)) for v in value):
+            return "double", [float(v) for v in value]
+        elif any(isinstance(v, (list, tuple)) for v in value):
+            raise WormTypeError("nested tables are not supported")
+        raise WormTypeError("the elements must be all strings or all numbers")
+    return None
+
+
+def _make_constant(value):
+    """
+    Return the type, the content digest and the definition generator of the
+    constant value, or None. Raise a WormTypeError if value looks like a
+    constant but cannot be one.
+    """
+    if isinstance(value, (bool, int)):
+        low, high = _int_limits["int64_t"]
+        if not low <= value < high:
+            raise WormTypeError("the value does not fit in an int64")
+        literal = c_number(int(value), "int64_t")
+        return (
+            int,
+            sha1(f"int {literal}".encode()),
+            lambda name: f"static const int64_t {name} = {literal};",
+        )
+    elif isinstance(value, float):
+        literal = c_number(value, "double")
+        return (
+            float,
+            sha1(f"float {literal}".encode()),
+            lambda name: f"static const double {name} = {literal};",
+        )
+    elif isinstance(value, str):
+        literal = c_string(value)
+        return (
+            str,
+            sha1(f"str {literal}".encode()),
+            lambda name: f"static char* const {name} = {literal};",
+        )
+
+    table = _table(value)
+    if table is None:
+        return None
+    storage, elements = table
+    element_type = {"char*": str, "float": float, "double": float}.get(storage, int)
+    type_ = Table[element_type, storage]
+
+    if isinstance(elements, bytes):
+        raw = elements
+        length = len(raw) // struct.calcsize(_formats[storage])
+    elif storage == "char*":
+        raw = "\0".join(elements).encode("utf-8", "surrogatepass") + b"\0" * 2
+        length = len(elements)
+    else:
+        raw = struct.pack(f"={len(elements)}{_formats[storage]}", *elements)
+        length = len(elements)
+    digest = sha1(f"{storage} {length} ".encode() + raw)
+
+    def definition(name):
+        data = f"{name}_data"
+        if storage == "char*":
+            init = ", ".join(map(c_string, elements))
+            code = [f"static char* const {data}[] = {{{init}}};"]
+            elems = data
+        elif len(raw) <= INLINE_LIMIT:
+            values = struct.unpack(f"={length}{_formats[storage]}", raw)
+            init = ", ".join(c_number(x, storage) for x in values) or "0"
+            code = [f"static const {storage} {data}[{max(length, 1)}] = {{{init}}};"]
+            elems = data
+        else:
+            code = [
+                "static const union {",
+                f"unsigned char bytes[{len(raw)}];",
+                f"{storage} values[{length}];",
+                f"}} {data} = {{",
+                _blob(raw),
+                "};",
+            ]
+            elems = f"{data}.values"
+        code.append(f"static const {to_c_type(type_)} {name} = {{{length}, {elems}}};")
+        return "\n".join(code)
+
+    return type_, digest, definition
+
+
+def as_constant(value):
+    """
+    Return the Constant for the Python value value or None if it cannot be
+    used as a constant.
+    """
+    try:
+        made = _make_constant(value)
+    except WormTypeError:
+        return None
+    if made is None:
+        return None
+    type_, digest, define = made
+    return Constant(f"wm_const_{digest.hexdigest()[:16]}", type_, define)
+
+
+def constant_error(value):
+    """
+    Return why the Python value value cannot be used as a constant while
+    looking like one, or None.
+    """
+    try:
+        _make_constant(value)
+    except WormTypeError as e:
+        return str(e)
+    return None
+
+
+def collect_constants(functions):
+    """
+    Return a mapping from C name to Constant for all constants found in the
+    scopes attached to functions.
+    """
+    constants = {}
+    for f in functions:
+        for value in f.attached.values():
+            if isinstance(value, type):
+                continue
+            constant = as_constant(value)
+            if constant is not None:
+                constants[constant.name] = constant
+    return constants
@@ -1,6 +1,5 @@
 from contextlib import contextmanager
 from functools import wraps
-from copy import deepcopy
 
 from .wast import (
     WAst,
@@ -8,8 +7,9 @@ from .wast import (
     WClass,
     WExpr,
     WBlock,
+    WName,
+    WConstant,
 )
-from .program import Program
 
 
 def invalidate_progam(f):
@@ -21,6 +21,39 @@ def invalidate_progam(f):
     return wrapper
 
 
+class Instantiation:
+    """
+    Record of a generic instantiation: the value returned by the factory, how
+    many times it was requested and how many functions and classes it added
+    to the program.
+    """
+
+    def __init__(self, value, functions, classes):
+        self.value = value
+        self.functions = functions
+        self.classes = classes
+        self.requests = 1
+
+
+def _signature(value):
+    """
+    Hashable description of a block argument, or None for arguments that
+    cannot be shared between expansions.
+    """
+    if isinstance(value, WName):
+        return ("name", value.name)
+    elif isinstance(value, WConstant):
+        return ("constant", type(value.value), value.value)
+    return None
+
+
+def _format_args(args, kwargs):
+    def fmt(a):
+        return getattr(a, "__name__", None) or getattr(a, "name", None) or repr(a)
+
+    return ", ".join([*map(fmt, args), *(f"{k}={fmt(v)}" for k, v in kwargs)])
+
+
 class WormContext:
     def __init__(self):
         self.setup_fresh_state()
@@ -29,23 +62,33 @@ class WormContext:
         """
         Clear all states and setup the context for a new program.
         """
-        self.functions = set()
+        # used as an ordered set: the C source follows the definition order,
+        # which keeps it identical from a run to the next (see Program.jit)
+        self.functions = {}
         self.classes = set()
         self.entry_point = None
         self.exported = set()
+        # (generic, args, kwargs) to Instantiation
+        self.instantiations = {}
 
         self._scope = [{}]
+        # incremented whenever the scope changes, see block
+        self._scope_version = 0
         self._program = None
 
     @property
     def program(self):
         if self._program is None:
+            # the compiler is only loaded when a program is built
+            from .program import Program
+
             self._program = Program.from_context(self)
 
         return self._program
 
     def add_to_scope(self, name, value):
         self._scope[-1][name] = value
+        self._scope_version += 1
 
     @contextmanager
     def scope(self, **kwargs):
@@ -56,10 +99,12 @@ class WormContext:
         """
         frame = kwargs
         self._scope.append(frame)
+        self._scope_version += 1
         try:
             yield
         finally:
             self._scope.pop()
+            self._scope_version += 1
 
     def flat_scope(self):
         """
@@ -85,7 +130,7 @@ class WormContext:
             ), "worm.add does not accept keyword arguments with function definition parameter."
             self.add_to_scope(node.name, node)
             node.attached = self.flat_scope()
-            self.functions.add(node)
+            self.functions[node] = None
         elif isinstance(node, WClass):
             assert (
                 not injected
@@ -119,13 +164,15 @@ class WormContext:
     @invalidate_progam
     def export(self, f):
         """
-        Take a worm function and register it as an exported function.
+        Take a worm function and register it as an exported function, see
+        save_library.
         """
         self.add_to_scope(f.name, f)
         f.attached = self.flat_scope()
         assert isinstance(
             f, WFuncDef
         ), "Only a function can be exported."  # FIXME export types too
+        self.functions[f] = None
         self.exported.add(f.name)
         return f
 
@@ -134,7 +181,15 @@ class WormContext:
         """
         Used as a decorator, the decorated function is made into an hygienic
         Worm block of statements block to be used in Worm function.
+
+        The body of the function is a template that is never modified: each
+        expansion is a new block sharing its statements, the passes of the
+        compiler copy the nodes they change and Renaming gives fresh names to
+        the locals of each use site. Expansions with the same arguments (same
+        names or constants) in the same scope are the same block.
         """
+        template = f.body
+        expansions = {}
 
         def wrapper(**kwargs):
             defaults = f.defaults
@@ -152,13 +207,22 @@ class WormContext:
                 else:
                     injected[arg] = defaults[i - offset]
 
-            b = f.body
+            signature = tuple((k, _signature(v)) for k, v in injected.items())
+            if any(s is None for _, s in signature):
+                key = None
+            else:
+                key = (signature, self._scope_version)
+                if key in expansions:
+                    return expansions[key]
 
+            b = WBlock(template.statements).copy_common(template)
             b.hygienic = True
-
-            with self.scope(**injected):
-                b.attached = self.flat_scope()
+            b.attached = {**self.flat_scope(), **injected}
             b.injected = injected
+            b.src_file = f.src_file
+
+            if key is not None:
+                expansions[key] = b
             return b
 
         wrapper._wrapped_block = True
@@ -167,6 +231,69 @@ class WormContext:
 
         return wrapper
 
+    def generic(self, factory):
+        """
+        Used as a decorator on a Python function building Worm code from
+        (type) parameters, like a template. Each instantiation is built once
+        per program: later calls with the same arguments return the first
+        result instead of adding duplicated functions and classes. Since types
+        are interned, Array[int] always designates the same instantiation.
+
+        The factory runs in the scope where it was defined, not in the scope
+        of the first caller, so that all callers get the same code.
+        See generic_report for the instantiation counts.
+        """
+        definition_scope = self.flat_scope()
+
+        @wraps(factory)
+        def instantiate(*args, **kwargs):
+            key = (instantiate, args, tuple(sorted(kwargs.items())))
+            try:
+                instance = self.instantiations.get(key)
+            except TypeError:
+                raise TypeError(
+                    f"Arguments of generic {factory.__name__} must be hashable."
+                ) from None
+
+            if instance is not None:
+                instance.requests += 1
+                return instance.value
+
+            functions, classes = len(self.functions), len(self.classes)
+            scope, self._scope = self._scope, [dict(definition_scope)]
+            try:
+                value = factory(*args, **kwargs)
+            finally:
+                self._scope = scope
+            self.instantiations[key] = Instantiation(
+                value,
+                len(self.functions) - functions,
+                len(self.classes) - classes,
+            )
+            return value
+
+        instantiate._generic = True
+        return instantiate
+
+    def generic_report(self):
+        """
+        Return a summary of the generic instantiations of the program: one
+        line per instantiation with the number of functions and classes it
+        added and the number of times it was requested.
+        """
+        lines = []
+        for (generic, args, kwargs), inst in self.instantiations.items():
+            lines.append(
+                f"{generic.__name__}({_format_args(args, kwargs)}):"
+                f" {inst.functions} function(s), {inst.classes} class(es),"
+                f" requested {inst.requests} time(s)"
+            )
+        total = sum(inst.functions for inst in self.instantiations.values())
+        lines.append(
+            f"{len(self.instantiations)} instantiation(s), {total} function(s)"
+        )
+        return "\n".join(lines)
+
     @invalidate_progam
     def __call__(self, *args, **kwargs):
         """
@@ -174,26 +301,98 @@ class WormContext:
         """
         return self.add(*args, **kwargs)
 
-    def dump_source(self):
+    def dump_source(self, **kwargs):
         """
         Return the current program as a string of C source.
+        Keyword parameters (gc, jobs, lines, profile) are passed to
+        Program.dump_source.
         """
-        return self.program.dump_source()
+        return self.program.dump_source(**kwargs)
 
-    def save_source(self, file):
+    def save_source(self, file, **kwargs):
         """
         Dump the current program into the given file in the form of a C source
-        file.
+        file, written as the functions are translated.
         The file parameter may be a string (filename) or a file-like object.
+        Keyword parameters (gc, jobs, lines, profile) are passed to
+        Program.save_source.
         """
-        return self.program.save_source(file)
+        return self.program.save_source(file, **kwargs)
+
+    def save_symbols(self, file):
+        """
+        Write the mapping from the identifiers of the C source of the current
+        program to the original Worm names as JSON into the given file.
+        The file parameter may be a string (filename) or a file-like object.
+        """
+        return self.program.save_symbols(file)
+
+    def save_library(self, filename, **kwargs):
+        """
+        Compile the exported functions of the current program to the shared
+        library filename and write its Python bindings next to it.
+        Keyword parameters (bindings, cc, cflags, gc, jobs) are passed to
+        Program.save_library.
+        """
+        return self.program.save_library(filename, **kwargs)
+
+    def jit(self, f=None, /, **options):
+        """
+        Export the worm function f and return a Python function calling it.
+        On the first call, the current program is compiled to a shared library
+        cached on disk and loaded in the process (see Program.jit).
+        Keyword parameters (cache, cc, cflags, gc) are passed to Program.jit.
+        May be used as a decorator, with or without options:
+
+            @worm.jit(cflags=["-O3"])
+            def norm2(a: Array[float]) -> float:
+                ...
+        """
+        if f is None:
+            return lambda f: self.jit(f, **options)
+
+        self.export(f)
+        compiled = None
+
+        def call(*args):
+            nonlocal compiled
+            if compiled is None:
+                compiled = self.program.jit(f.name, **options)
+            return compiled(*args)
+
+        call.__name__ = call.__qualname__ = f.name
+        call.__doc__ = f.docstring
+        call.__wrapped__ = f
+        return call
+
+    def runtime_units(self):
+        """
+        Return the C units of the standard library implementing the gc and
+        profile options of the programs, the compiler does not depend on it.
+        """
+        from .std.gc import unit as gc_unit
+        from .std.profile import unit as profile_unit
+
+        return {"gc": gc_unit, "profile": profile_unit}
+
+    def profile_report(self, file):
+        """
+        Return the table of the profile report written to the given file by
+        the current program compiled with profile=True, keyed by Worm names.
+        The file parameter may be a string (filename) or a file-like object.
+        """
+        from .std.profile import format_report, read_report
+
+        return format_report(read_report(file, self.program.symbol_map()))
 
-    def save_program(self, file):
+    def save_program(self, file, **kwargs):
         """
         Compile the current program and write on disk under filename.
         The file parameter may be a string (filename) or a file-like object.
+        Keyword parameters (cc, cflags, gc, jobs, lines, profile) are passed to
+        Program.save_program.
         """
-        return self.program.save_program(file)
+        return self.program.save_program(file, **kwargs)
 
     def expand(self, f, **kwargs):
         """
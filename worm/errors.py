@@ -23,3 +23,7 @@ class WormSyntaxError(WormError):
 
 class WormBindingError(WormError):
     pass
+
+
+class WormCompileError(WormError):
+    pass
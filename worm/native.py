@@ -0,0 +1,141 @@
+"""
+Bridge between Worm code and C code that is not produced from Worm AST.
+Summary:
+- a CUnit is a chunk of C source (hand written or generated by Python at compile
+  time) with the headers, Worm types, other units and compiler flags it needs
+- a NativeFunction is a function prototype implemented by a CUnit, it can be put
+  in a Worm scope (worm.scope(name=native)) and called from Worm code
+- the program collects the native functions reachable from the scopes of its
+  functions and emits the units they depend on, in dependency order, units
+  may declare other units they cannot be used with (see check_conflicts)
+- c_string is the C literal of a Python string, for the generated code
+"""
+from .errors import WormCompileError
+from .type_checker import FunctionPrototype
+
+
+class CUnit:
+    def __init__(
+        self,
+        name,
+        source="",
+        headers=(),
+        types=(),
+        requires=(),
+        cflags=(),
+        ldflags=(),
+        conflicts=None,
+    ):
+        self.name = name
+        self.source = source
+        self.headers = list(headers)
+        self.types = list(types)
+        self.requires = list(requires)
+        self.cflags = list(cflags)
+        self.ldflags = list(ldflags)
+        # name of a unit that cannot be in the same program to the reason
+        self.conflicts = dict(conflicts or {})
+
+    def __repr__(self):
+        return f"CUnit('{self.name}')"
+
+
+class NativeFunction(FunctionPrototype):
+    """
+    A function implemented in C. name is the C symbol.
+    """
+
+    def __init__(self, name, returns, *args, unit=None):
+        super().__init__(returns, *args)
+        self.name = name
+        self.unit = unit
+
+    def __repr__(self):
+        return f"NativeFunction('{self.name}')"
+
+
+def collect_natives(functions):
+    """
+    Return a mapping from C name to native function for all natives found in
+    the scopes attached to functions.
+    """
+    natives = {}
+    for f in functions:
+        for value in f.attached.values():
+            if isinstance(value, NativeFunction):
+                natives[value.name] = value
+    return natives
+
+
+def resolve_units(natives):
+    """
+    Return the list of units required by natives, each unit appearing after
+    the units it requires.
+    """
+    ordered = []
+    seen = set()
+
+    def visit(unit):
+        if unit.name in seen:
+            return
+        seen.add(unit.name)
+        for dep in unit.requires:
+            visit(dep)
+        ordered.append(unit)
+
+    for native in natives:
+        if native.unit is not None:
+            visit(native.unit)
+
+    return ordered
+
+
+def check_conflicts(units):
+    """
+    Raise a WormCompileError if two of units cannot be in the same program.
+    """
+    names = {unit.name for unit in units}
+    for unit in units:
+        for other, reason in unit.conflicts.items():
+            if other in names:
+                raise WormCompileError(
+                    f"The {unit.name} and {other} units cannot be used together:"
+                    f" {reason}."
+                )
+
+
+def unit_headers(units):
+    headers = []
+    for unit in units:
+        for h in unit.headers:
+            if h not in headers:
+                headers.append(h)
+    return headers
+
+
+def unit_flags(units):
+    cflags, ldflags = [], []
+    for unit in units:
+        cflags.extend(f for f in unit.cflags if f not in cflags)
+        ldflags.extend(f for f in unit.ldflags if f not in ldflags)
+    return cflags, ldflags
+
+
+def c_string(text):
+    """
+    Return a C string literal for text (str or bytes).
+    """
+    out = []
+    for b in text.encode("utf-8") if isinstance(text, str) else text:
+        c = chr(b)
+        if c in '"\\':
+            out.append("\\" + c)
+        elif c == "\n":
+            out.append("\\n")
+        elif c == "\t":
+            out.append("\\t")
+        elif 32 <= b < 127:
+            out.append(c)
+        else:
+            out.append(f"\\{b:03o}")
+    return '"' + "".join(out) + '"'
@@ -0,0 +1,366 @@
+"""
+Pattern matching.
+
+A chain of if/elif testing a value with `is` is a match of this value:
+
+    if a - 1 is 1:
+        ...
+    elif _ is 2:  # _ is implicitly a - 1
+        ...
+    elif _ is 3 * n:  # n get bound to (a - 1) / 3
+        ...
+    else:
+        ...
+
+The subject (a - 1) is evaluated once and the first matching case is
+executed. Valid patterns are:
+- int constants
+- names, bound to the matched value (catch all), _ matches without binding
+- + - * with one constant operand, the other operand being a pattern: 3 * n
+  matches the multiples of 3 and binds n to the value divided by 3, n + 1
+  matches anything and binds n to the value minus 1
+- unary minus of a pattern
+- constructors of Sum types, Result.ok(v) or ok(v) with the constructor in
+  the scope (see Sum), with a pattern for the value of the variant,
+  Option.none() for variants without value
+
+`x is None` is not a pattern and stays a comparison.
+
+Matches are compiled into decision trees (see decision_tree): consecutive
+constant cases are dispatched with a switch on the value when they are dense
+and with a binary search on the value followed by a switch on the index of
+the case otherwise. Other patterns are tested in order between them.
+Matches of Sum values are a switch on the tag (see tag_tree).
+"""
+from .errors import WormSyntaxError, WormTypeError
+from .wast import WBinary, WCompare, WConstant, WIf, WMatch, WName, WUnary, WVariant
+
+
+# a run of constant cases is a switch on the value when its range is smaller
+# than DENSITY times the number of cases
+DENSITY = 2
+# number of values below which a binary search ends with linear comparisons
+LINEAR = 3
+
+
+def _is_wildcard(node):
+    return isinstance(node, WName) and node.name == "_"
+
+
+def _pattern_of(test):
+    """
+    Return the pattern of test if test is of the form `subject is pattern`.
+    """
+    if not isinstance(test, WCompare) or len(test.rest) != 1:
+        return None
+    op, pattern = test.rest[0]
+    if op != "is" or (isinstance(pattern, WConstant) and pattern.value is None):
+        return None
+    return pattern
+
+
+def as_match(node):
+    """
+    Return the WMatch equivalent to the WIf node or None if node is a plain
+    if statement.
+    """
+    pattern = _pattern_of(node.test)
+    if pattern is None:
+        return None
+    subject = node.test.left
+    if _is_wildcard(subject):
+        raise WormSyntaxError(
+            "_ is only the subject of an elif following a pattern test.",
+            at=node.src_pos,
+        )
+
+    cases = [(pattern, node.body)]
+    orelse = node.orelse
+    while len(orelse.statements) == 1 and isinstance(orelse.statements[0], WIf):
+        elif_ = orelse.statements[0]
+        pattern = _pattern_of(elif_.test)
+        if pattern is None or not _is_wildcard(elif_.test.left):
+            break
+        cases.append((pattern, elif_.body))
+        orelse = elif_.orelse
+
+    return WMatch(subject, cases, orelse).copy_common(node)
+
+
+def constant_value(pattern):
+    """
+    Return the value of pattern if it does not bind anything, else None.
+    """
+    if isinstance(pattern, WConstant):
+        return pattern.value
+    elif isinstance(pattern, WUnary):
+        value = constant_value(pattern.operand)
+        if value is None or pattern.op == "+":
+            return value
+        return -value
+    elif isinstance(pattern, WBinary):
+        left, right = constant_value(pattern.left), constant_value(pattern.right)
+        if left is None or right is None:
+            return None
+        elif pattern.op == "+":
+            return left + right
+        elif pattern.op == "-":
+            return left - right
+        else:
+            return left * right
+    return None
+
+
+def check_pattern(pattern):
+    """
+    Raise a WormSyntaxError if pattern is not a valid pattern.
+    """
+    if isinstance(pattern, WConstant):
+        if type(pattern.value) is not int:
+            raise WormSyntaxError(
+                "Only int constants are valid in patterns.", at=pattern.src_pos
+            )
+    elif isinstance(pattern, WName):
+        pass
+    elif isinstance(pattern, WVariant):
+        if pattern.value is not None:
+            check_pattern(pattern.value)
+    elif isinstance(pattern, WUnary) and pattern.op in ("-", "+"):
+        check_pattern(pattern.operand)
+    elif isinstance(pattern, WBinary) and pattern.op in ("+", "-", "*"):
+        left, right = constant_value(pattern.left), constant_value(pattern.right)
+        if left is None and right is None:
+            raise WormSyntaxError(
+                "One of the operands of an arithmetic pattern must be constant.",
+                at=pattern.src_pos,
+            )
+        elif pattern.op == "*" and 0 in (left, right):
+            raise WormSyntaxError("Pattern multiplied by zero.", at=pattern.src_pos)
+        check_pattern(pattern.left)
+        check_pattern(pattern.right)
+    else:
+        raise WormSyntaxError("Invalid pattern.", at=pattern.src_pos)
+
+
+def pattern_bindings(pattern):
+    """
+    Return the names bound by pattern.
+    """
+    if isinstance(pattern, WName):
+        return [] if _is_wildcard(pattern) else [pattern]
+    elif isinstance(pattern, WVariant):
+        return [] if pattern.value is None else pattern_bindings(pattern.value)
+    elif isinstance(pattern, WUnary):
+        return pattern_bindings(pattern.operand)
+    elif isinstance(pattern, WBinary):
+        return pattern_bindings(pattern.left) + pattern_bindings(pattern.right)
+    return []
+
+
+def typed_bindings(pattern, type_):
+    """
+    Return the names bound by pattern matching a value of type type_ with
+    their types. Raise a WormTypeError if pattern cannot match such values.
+    """
+    if isinstance(pattern, WName):
+        return [] if _is_wildcard(pattern) else [(pattern, type_)]
+    elif isinstance(pattern, WVariant):
+        if pattern.sum_type is not type_:
+            raise WormTypeError(
+                "Variant pattern of another type.",
+                at=pattern.src_pos,
+                expect=type_,
+                got=pattern.sum_type,
+            )
+        if pattern.value is None:
+            return []
+        return typed_bindings(pattern.value, type_.variants[pattern.variant])
+    elif type_ != int:
+        raise WormTypeError(
+            "Arithmetic and constant patterns only match int values.",
+            at=pattern.src_pos,
+            expect=int,
+            got=type_,
+        )
+    return [(name, int) for name in pattern_bindings(pattern)]
+
+
+def _literal(value):
+    if value == -(1 << 63):
+        return "INT64_MIN"
+    return str(value) if -(1 << 31) <= value < 1 << 31 else f"{value}LL"
+
+
+def destructure(pattern, value):
+    """
+    Return the C conditions for the C expression value to match pattern and
+    the bindings of pattern as (name, C expression) pairs.
+    """
+    constant = constant_value(pattern)
+    if constant is not None:
+        return [f"{value} == {_literal(constant)}"], []
+    elif _is_wildcard(pattern):
+        return [], []
+    elif isinstance(pattern, WName):
+        return [], [(pattern, value)]
+    elif isinstance(pattern, WVariant):
+        tag, conditions, bindings = destructure_variant(pattern, value)
+        return [f"{pattern.sum_type.tag_of(value)} == {tag}", *conditions], bindings
+    elif isinstance(pattern, WUnary):
+        return destructure(pattern.operand, f"(-{value})" if pattern.op == "-" else value)
+
+    left = constant_value(pattern.left)
+    if left is not None:
+        k, sub = _literal(left), pattern.right
+    else:
+        k, sub = _literal(constant_value(pattern.right)), pattern.left
+
+    conditions = []
+    if pattern.op == "+":
+        inner = f"({value} - {k})"
+    elif pattern.op == "-":
+        inner = f"({k} - {value})" if left is not None else f"({value} + {k})"
+    else:
+        conditions.append(f"{value} % {k} == 0")
+        inner = f"({value} / {k})"
+    sub_conditions, bindings = destructure(sub, inner)
+    return conditions + sub_conditions, bindings
+
+
+def destructure_variant(pattern, value):
+    """
+    Return the tag matched by pattern (None for catch all patterns), the
+    other C conditions for the Sum value to match pattern and the bindings.
+    """
+    if not isinstance(pattern, WVariant):
+        return (None, *destructure(pattern, value))
+    tag = pattern.sum_type.tags[pattern.variant]
+    if pattern.value is None:
+        return tag, [], []
+    payload = pattern.sum_type.payload_of(value, pattern.variant)
+    return (tag, *destructure(pattern.value, payload))
+
+
+def _guarded(conditions, body, fallback):
+    if not conditions:
+        return f"{{\n{body}\n}}"
+    test = " && ".join(f"({c})" for c in conditions)
+    return f"if({test}){{\n{body}\n}} else {{\n{fallback}\n}}"
+
+
+def _switch(value, cases, default):
+    return "\n".join(
+        [f"switch({value}){{", *cases, f"default: {{\n{default}\n}}", "}"]
+    )
+
+
+def _search(subject, values, index, first=1):
+    """
+    Binary search of subject in the sorted values, setting index to the
+    position of the value found, counted from first.
+    """
+    if len(values) <= LINEAR:
+        return " else ".join(
+            f"if({subject} == {_literal(v)}) {index} = {i};"
+            for i, v in enumerate(values, first)
+        )
+    mid = len(values) // 2
+    low = _search(subject, values[:mid], index, first)
+    high = _search(subject, values[mid:], index, first + mid)
+    return f"if({subject} < {_literal(values[mid])}){{\n{low}\n}} else {{\n{high}\n}}"
+
+
+def _dispatch(subject, run, fallback, index):
+    """
+    Code executing the body of run (a mapping from value to body) matching
+    subject, or fallback.
+    """
+    values = sorted(run)
+    if len(values) == 1:
+        (value,) = values
+        return (
+            f"if({subject} == {_literal(value)}){{\n{run[value]}\n}}"
+            f" else {{\n{fallback}\n}}"
+        )
+    elif values[-1] - values[0] < DENSITY * len(values):
+        # dense, the C compiler makes a jump table
+        cases = [f"case {_literal(v)}: {{\n{run[v]}\n}} break;" for v in values]
+        return _switch(subject, cases, fallback)
+
+    cases = [f"case {i}: {{\n{run[v]}\n}} break;" for i, v in enumerate(values, 1)]
+    return "\n".join(
+        [
+            "{",
+            f"int {index} = 0;",
+            _search(subject, values, index),
+            _switch(index, cases, fallback),
+            "}",
+        ]
+    )
+
+
+def decision_tree(subject, cases, orelse, index):
+    """
+    C code for the match of the C variable subject.
+
+    cases is a list of (value, conditions, body) in the order of the source:
+    value is the int of constant patterns (None for others), conditions the C
+    conditions of other patterns (empty for catch all patterns) and body the C
+    code of the case. orelse is executed if no case matches. index is the
+    name to use for the case index of binary searches.
+    """
+    steps = []
+    run = {}
+    exhaustive = False
+    for value, conditions, body in cases:
+        if value is not None:
+            # a value already tested is caught by the first case
+            if not any(value in step for step in steps if isinstance(step, dict)):
+                run.setdefault(value, body)
+            continue
+        if run:
+            steps.append(run)
+            run = {}
+        steps.append((conditions, body))
+        if not conditions:
+            # the next cases are unreachable
+            exhaustive = True
+            break
+    if run:
+        steps.append(run)
+
+    code = "" if exhaustive else orelse
+    for step in reversed(steps):
+        if isinstance(step, dict):
+            code = _dispatch(subject, step, code, index)
+            continue
+        conditions, body = step
+        code = _guarded(conditions, body, code)
+    return code
+
+
+def tag_tree(tag, cases, orelse):
+    """
+    C code for the match of a Sum value of C tag expression tag.
+
+    cases is a list of (tag, conditions, body) in the order of the source,
+    tag being None for catch all patterns. The cases of each tag are tested
+    in order in a branch of a switch on the tag, orelse is repeated in the
+    branches where no case may match.
+    """
+
+    def chain(applicable):
+        code = orelse
+        for _, conditions, body in reversed(applicable):
+            code = _guarded(conditions, body, code)
+        return code
+
+    tags = sorted({t for t, _, _ in cases if t is not None})
+    default = chain([case for case in cases if case[0] is None])
+    if not tags:
+        return default
+    branches = [
+        f"case {t}: {{\n{chain([c for c in cases if c[0] in (t, None)])}\n}} break;"
+        for t in tags
+    ]
+    return _switch(tag, branches, default)
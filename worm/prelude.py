@@ -38,6 +38,7 @@ prelude = {
     "deref": WDeref,
     "int": int,
     "float": float,
+    "str": str,
     "chr": char,
     "bool": bool,
     "void": void,
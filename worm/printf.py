@@ -15,6 +15,7 @@ def parse_format(string):
             i = last
         else:
             i += 1
+    elements.append(string[last:])
 
     actual_params = []
     for p in elements:
@@ -1,7 +1,16 @@
-from functools import reduce
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+from contextlib import nullcontext
 from contextlib import contextmanager
 
-from .errors import WormBindingError, WormTypeError
+from .errors import WormBindingError, WormTypeError, WormCompileError, WormSyntaxError
+from .bindings import load
 from .visitor import WormVisitor
 from .wast import (
     WTopLevel,
@@ -12,22 +21,85 @@ from .wast import (
     WClass,
     WArg,
     WAssign,
+    WExprStatement,
     WExpr,
+    WSetItem,
+    WMatch,
+    WVariant,
+    WGetAttr,
+    Ref,
 )
 from .prelude import prelude
-from .wtypes import to_c_type, void, WormType, Array
+from .native import (
+    c_string,
+    check_conflicts,
+    NativeFunction,
+    collect_natives,
+    resolve_units,
+    unit_headers,
+    unit_flags,
+)
+from .wtypes import (
+    gc_managed,
+    to_c_type,
+    void,
+    WormType,
+    HigherOrderType,
+    Array,
+    Table,
+    Sum,
+    Variant,
+)
+from .constants import as_constant, collect_constants, constant_error
+from .pattern import (
+    as_match,
+    check_pattern,
+    constant_value,
+    decision_tree,
+    destructure,
+    destructure_variant,
+    pattern_bindings,
+    tag_tree,
+)
 from .type_checker import ResolveTypes, AnnotateSymbols, PropagateAndCheckTypes
 
 
+# size of the translated functions kept in memory before spilling to a
+# temporary file (see MakeCSource.write)
+SPOOL_SIZE = 1 << 20
+# buffer of the files the C source is saved to
+WRITE_BUFFER = 1 << 16
+
+
 class Program:
-    def __init__(self, entry_point, functions, exported):
+    def __init__(self, entry_point, functions, exported, runtime=None):
         self.entry_point = entry_point
         self.functions = functions
         self.exported = exported
+        # C identifier to Worm name, filled when the source is generated
+        self.symbols = None
+        # exported function name to (C symbol, return type, argument types),
+        # filled when the source of a library is generated (see save_library)
+        self.signatures = None
+        # (cc, cflags, gc) to the functions of the library loaded by jit
+        self.libraries = {}
+        # C units of the last generated source, with the natives specialized
+        # by the type checker and the runtime (see compiler_flags)
+        self.units = None
+        # option of write_source (gc, profile) to the C unit implementing it,
+        # provided by the standard library (see WormContext.runtime_units)
+        self.runtime = runtime or {}
+
+        if entry_point is not None:
+            self.natives = collect_natives([entry_point, *functions])
+            self.constants = collect_constants([entry_point, *functions])
+        else:
+            self.natives = collect_natives(functions)
+            self.constants = collect_constants(functions)
 
     @classmethod
     def from_context(cls, context):
-        functions = context.functions
+        functions = list(context.functions)
         entry_point = context.entry_point
 
         exported = set()
@@ -36,51 +108,452 @@ class Program:
             if f.name in context.exported:
                 exported.add(f)
 
-        return cls(entry_point, functions, exported)
+        return cls(entry_point, functions, exported, context.runtime_units())
 
-    def dump_source(self):
+    def dump_source(self, gc=False, jobs=1, lines=False, profile=False):
+        """
+        Return the C source of the program (see write_source).
+        """
+        out = io.StringIO()
+        self.write_source(out, gc=gc, jobs=jobs, lines=lines, profile=profile)
+        return out.getvalue()
+
+    def write_source(
+        self,
+        out,
+        gc=False,
+        jobs=1,
+        lines=False,
+        profile=False,
+        library=False,
+        timer=None,
+    ):
+        """
+        Write the C source of the program to the text file out. With gc=True,
+        the variables holding collected values are registered as roots of the
+        garbage collector of worm.std.gc.
+
+        With jobs > 1 (or jobs=0 for one job per CPU), the type checking and
+        the translation of the functions are spread over a pool of processes.
+        The fragments are assembled in the order of the functions, so the
+        result does not depend on the scheduling. Types created while checking
+        the functions are then named after their content rather than numbered.
+        This needs the fork start method (POSIX), else the functions are
+        translated in this process.
+
+        The source is written as the functions are translated, the whole
+        program is never held in memory (see MakeCSource.write).
+
+        With lines=True, the statements are preceded by #line directives
+        pointing to the Worm source, so that compiler errors, debuggers and
+        profilers refer to the .wm files. The renamed identifiers of the C
+        source can be traced back with the symbol map (see save_symbols).
+
+        With profile=True, or a list of Worm function names, the functions
+        (or the functions listed) count their calls and measure their time,
+        reported when the program exits (see worm.std.profile).
+
+        With library=True, each exported function is also defined with the
+        external C symbol worm_<name> (see save_library).
+
+        timer, if given, is called with the name of each pass (the last one
+        being MakeCSource, or "parallel" for the passes run by the pool) and
+        returns a context manager wrapping the pass, to measure it.
+        """
+        timer = timer or (lambda name: nullcontext())
         headers = ["#include <stdio.h>", "#include <stdlib.h>", "#include <stdint.h>"]
+        if library:
+            # bool is part of the interface of the exported functions
+            headers.append("#include <stdbool.h>")
 
-        scope = {**prelude}
+        scope = {
+            **prelude,
+            **{name: Ref(native) for name, native in self.natives.items()},
+            **{name: Ref(c.type) for name, c in self.constants.items()},
+        }
 
+        renaming = Renaming(scope)
         pipeline = [
-            Unsugar(),
-            Renaming(scope),
+            Unsugar(prelude),
+            renaming,
             ResolveTypes(scope),
             ValidateMain(),
             AnnotateSymbols(scope),
-            PropagateAndCheckTypes(scope),
-            MakeCSource(),
         ]
+        jobs = jobs or os.cpu_count()
+        parallel = jobs > 1 and "fork" in multiprocessing.get_all_start_methods()
+        if not parallel:
+            pipeline.append(PropagateAndCheckTypes(scope))
 
         def transform(node):
-            return reduce(lambda n, t: t.visit(n), pipeline, node)
-
+            for t in pipeline:
+                with timer(type(t).__name__):
+                    node = t.visit(node)
+            return node
 
         top_level = WTopLevel(
-            entry=self.entry_point, functions=self.functions, headers=headers, exported=self.exported
+            entry=self.entry_point,
+            functions=self.functions,
+            headers=headers,
+            exported=self.exported,
+            natives=self.natives,
+            constants=self.constants,
+        )
+
+        top_level = transform(top_level)
+        self.symbols = dict(renaming.symbols)
+        exported = [
+            f for f in top_level.functions if getattr(f, "origin", f) in self.exported
+        ]
+        options = {
+            "gc": gc,
+            "lines": lines,
+            "profile": self.profiled(profile),
+            "runtime": [
+                self.runtime_unit(option)
+                for option, enabled in [("profile", profile), ("gc", gc)]
+                if enabled
+            ],
+            "exports": {f.name: f"worm_{f.origin.name}" for f in exported}
+            if library
+            else {},
+        }
+        check_conflicts(
+            [*options["runtime"], *resolve_units(top_level.natives.values())]
         )
+        if parallel:
+            with timer("parallel"):
+                _translate_in_parallel(top_level, options, jobs, out)
+        else:
+            source = MakeCSource(**options)
+            with timer("MakeCSource"):
+                source.write(top_level, source.translate(top_level), out)
+
+        units = resolve_units(top_level.natives.values())
+        names = {unit.name for unit in units}
+        self.units = [u for u in options["runtime"] if u.name not in names] + units
+
+        if library:
+            self.signatures = {
+                f.origin.name: (
+                    options["exports"][f.name],
+                    _binding_type(f.returns.deref(), f),
+                    [_binding_type(arg.type.deref(), f, arg=True) for arg in f.args],
+                )
+                for f in exported
+            }
+
+    def runtime_unit(self, option):
+        """
+        Return the C unit implementing the option of write_source.
+        """
+        if option not in self.runtime:
+            raise WormCompileError(f"No runtime is available for {option}=True.")
+        return self.runtime[option]
 
-        return transform(top_level)
+    def profiled(self, profile):
+        """
+        Return True or the C names of the functions to measure for the
+        profile parameter of write_source.
+        """
+        if profile is True:
+            return True
+        names = set(profile or ())
+        return {
+            symbol
+            for symbol, name in [*self.symbols.items(), ("main", "main")]
+            if name in names or symbol in names
+        }
+
+    def save_source(self, file, gc=False, jobs=1, lines=False, profile=False):
+        """
+        Write the C source of the program to file, a filename or a text
+        file-like object.
+        """
+        options = {"gc": gc, "jobs": jobs, "lines": lines, "profile": profile}
+        if isinstance(file, str):
+            with open(file, "w", buffering=WRITE_BUFFER) as f:
+                self.write_source(f, **options)
+        else:
+            self.write_source(file, **options)
 
-    def save_source(self, file):
+    def symbol_map(self):
+        """
+        Return the mapping from the identifiers of the C source to the names
+        of the Worm source they replace (v4_result to result).
+        """
+        if self.symbols is None:
+            self.write_source(io.StringIO())
+        return self.symbols
+
+    def save_symbols(self, file):
+        """
+        Write the symbol map (see symbol_map) as a JSON object to file, a
+        filename or a text file-like object.
+        """
         if isinstance(file, str):
             with open(file, "w") as f:
-                f.write(self.dump_source())
+                json.dump(self.symbol_map(), f, indent=1, sort_keys=True)
         else:
-            file.write(self.dump_source())
+            json.dump(self.symbol_map(), file, indent=1, sort_keys=True)
 
-    def save_program(self, filename):
-        pass
+    def compiler_flags(self):
+        """
+        Return the extra (cflags, ldflags) required by the native units of the
+        program, those of the last generated source if any: the type checker
+        may add natives (see PropagateAndCheckTypes.visit_call) and the options
+        runtime units.
+        """
+        if self.units is None:
+            return unit_flags(resolve_units(self.natives.values()))
+        return unit_flags(self.units)
+
+    def save_program(
+        self,
+        file,
+        cc=None,
+        cflags=("-O2",),
+        gc=False,
+        jobs=1,
+        lines=False,
+        profile=False,
+    ):
+        """
+        Compile the program with the system C compiler (CC environment
+        variable, cc by default).
+        The file parameter may be a string (filename) or a file-like object.
+        With lines=True (and -g in cflags), the debug information of the
+        program refers to the Worm source.
+        """
+        cc = cc or os.environ.get("CC", "cc")
+
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "prog.c")
+            self.save_source(source, gc=gc, jobs=jobs, lines=lines, profile=profile)
+            # after the source, which may need more units
+            extra_cflags, ldflags = self.compiler_flags()
+            output = file if isinstance(file, str) else os.path.join(tmp, "a.out")
+            res = subprocess.run(
+                [cc, *cflags, *extra_cflags, source, "-o", output, *ldflags],
+                capture_output=True,
+                text=True,
+            )
+            if res.returncode != 0:
+                raise WormCompileError(f"{cc} failed:\n{res.stderr}")
 
-    def save_library(self, filename):
-        pass
+            if not isinstance(file, str):
+                with open(output, "rb") as f:
+                    file.write(f.read())
+
+    def save_library(
+        self, filename, bindings=None, cc=None, cflags=("-O2",), gc=False, jobs=1
+    ):
+        """
+        Compile the exported functions (see WormContext.export) to the shared
+        library filename, each one with the C symbol worm_<name>, and write
+        the Python module bindings (filename without extension followed by
+        _bindings.py by default) loading it with ctypes (see worm.bindings):
+
+            worm.save_library("libstats.so")
+            import libstats_bindings
+            libstats_bindings.mean(array.array("d", [1.0, 2.0]))
+
+        Arrays are passed to the functions without copying.
+        """
+        if not self.exported:
+            raise WormCompileError("No function is exported.")
+        # not <name>.py: python would import <name>.so as an extension module
+        bindings = bindings or os.path.splitext(filename)[0] + "_bindings.py"
+
+        with tempfile.TemporaryDirectory() as tmp:
+            source = os.path.join(tmp, "lib.c")
+            with open(source, "w", buffering=WRITE_BUFFER) as f:
+                self.write_source(f, gc=gc, jobs=jobs, library=True)
+            self.compile_library(source, filename, cc, cflags)
+
+        library = os.path.relpath(
+            os.path.abspath(filename), os.path.dirname(os.path.abspath(bindings))
+        )
+        with open(bindings, "w") as f:
+            f.write(_bindings_module(library, self.signatures))
+
+    def compile_library(self, source, filename, cc=None, cflags=("-O2",)):
+        """
+        Compile the C source file source of the program, generated with
+        library=True, to the shared library filename.
+        """
+        cc, flags, ldflags = self.library_flags(cc, cflags)
+        res = subprocess.run(
+            [cc, *flags, source, "-o", filename, *ldflags],
+            capture_output=True,
+            text=True,
+        )
+        if res.returncode != 0:
+            raise WormCompileError(f"{cc} failed:\n{res.stderr}")
+
+    def library_flags(self, cc=None, cflags=("-O2",)):
+        """
+        Return the compiler, compiler flags and linker flags of the shared
+        library of the program.
+        """
+        cc = cc or os.environ.get("CC", "cc")
+        extra_cflags, ldflags = self.compiler_flags()
+        flags = [*cflags, "-shared", "-fPIC", "-fvisibility=hidden", *extra_cflags]
+        return cc, flags, ldflags
+
+    def jit(self, name, cache=None, cc=None, cflags=("-O2",), gc=False):
+        """
+        Return a Python function calling the exported function name of the
+        program compiled to a shared library loaded in the current process.
+
+        The library is stored in the directory cache (WORM_CACHE environment
+        variable, ~/.cache/worm by default) under a hash of its source and of
+        the compiler command: the compilation is skipped when the program did
+        not change, in this process or a later one. The C source is still
+        generated to compute the hash.
+        """
+        key = (cc, tuple(cflags), gc)
+        if key not in self.libraries:
+            out = io.StringIO()
+            self.write_source(out, gc=gc, library=True)
+            source = out.getvalue()
+            cc, flags, ldflags = self.library_flags(cc, cflags)
+            digest = hashlib.sha256(
+                "\0".join([cc, *flags, *ldflags, source]).encode()
+            ).hexdigest()
+
+            cache = cache or cache_dir()
+            filename = os.path.join(cache, f"{digest}.so")
+            if not os.path.exists(filename):
+                os.makedirs(cache, exist_ok=True)
+                with tempfile.TemporaryDirectory(dir=cache) as tmp:
+                    c_file = os.path.join(tmp, "lib.c")
+                    with open(c_file, "w") as f:
+                        f.write(source)
+                    so_file = os.path.join(tmp, "lib.so")
+                    self.compile_library(c_file, so_file, cc, cflags)
+                    # atomic, other processes never load a partial library
+                    os.replace(so_file, filename)
+            self.libraries[key] = load(filename, self.signatures)
+
+        return getattr(self.libraries[key], name)
+
+
+def cache_dir():
+    """
+    Directory of the libraries compiled by Program.jit.
+    """
+    if "WORM_CACHE" in os.environ:
+        return os.environ["WORM_CACHE"]
+    cache = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(cache, "worm")
+
+
+_binding_names = {int: "int", float: "float", bool: "bool", str: "str"}
+
+
+def _binding_type(type_, f, arg=False):
+    """
+    Name of the Worm type type_ in the bindings (see worm.bindings) of the
+    exported function f.
+    """
+    if type_ is None or type_ == void:
+        if not arg:
+            return "void"
+    elif type_ in _binding_names:
+        return _binding_names[type_]
+    elif arg and isinstance(type_, Array) and type_.element_type in (int, float, bool):
+        return f"Array[{_binding_names[type_.element_type]}]"
+    raise WormTypeError(
+        f"Functions taking or returning {type_} cannot be exported.", at=f.src_pos
+    )
+
+
+def _bindings_module(library, signatures):
+    """
+    Source of the Python module loading the shared library (path relative to
+    the module) exporting the functions of signatures.
+    """
+    lines = [
+        '"""',
+        f"Bindings of {os.path.basename(library)}, generated by worm.",
+        '"""',
+        "import os",
+        "",
+        "from worm.bindings import load",
+        "",
+        "_library = load(",
+        "    os.path.join(",
+        f"        os.path.dirname(os.path.abspath(__file__)), {library!r}",
+        "    ),",
+        "    {",
+    ]
+    for name, (symbol, returns, args) in sorted(signatures.items()):
+        lines.append(f"        {name!r}: ({symbol!r}, {returns!r}, {args!r}),")
+    lines += ["    },", ")", ""]
+    lines += [f"{name} = _library.{name}" for name in sorted(signatures)]
+    return "\n".join(lines) + "\n"
+
+
+# (functions, symbol table, options of MakeCSource) of the program translated in parallel, the
+# workers inherit it when the pool forks
+_parallel_state = None
+
+
+def _init_worker():
+    # the workers create types concurrently, they must agree on their names
+    HigherOrderType.content_names = True
+
+
+def _translate_function(index):
+    """
+    Type check and translate a function of _parallel_state. Return its C
+    code, its C prototype, the types it uses and the natives it specialized.
+    """
+    functions, symbol_table, options = _parallel_state
+    checker = PropagateAndCheckTypes(prelude)
+    checker.symbol_table = symbol_table
+    checker.natives = {}
+    f = checker.visit(functions[index])
+    source = MakeCSource(**options)
+    code = source.visit(f)
+    return code, source.prototype(f), list(source.types.values()), checker.natives
+
+
+def _translate_in_parallel(top_level, options, jobs, out):
+    """
+    Run the last passes (type checking and translation) of the annotated
+    top_level in a pool of jobs processes, one function at a time, and write
+    the C source to the text file out as the functions come back.
+    """
+    global _parallel_state
+    functions = [top_level.entry] if top_level.entry is not None else []
+    functions.extend(top_level.functions)
+    source = MakeCSource(**options)
+
+    def translated(pool):
+        chunksize = max(1, len(functions) // (4 * jobs))
+        results = pool.imap(_translate_function, range(len(functions)), chunksize)
+        for f, (code, prototype, types, natives) in zip(functions, results):
+            for t in types:
+                source.declare(t)
+            for name, native in natives.items():
+                top_level.natives.setdefault(name, native)
+            yield code, None if f is top_level.entry else prototype
+
+    _parallel_state = (functions, top_level.symbol_table, options)
+    try:
+        context = multiprocessing.get_context("fork")
+        with context.Pool(jobs, initializer=_init_worker) as pool:
+            source.write(top_level, translated(pool), out)
+    finally:
+        _parallel_state = None
 
 
 class Unsugar(WormVisitor):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, prelude, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.scope = [{}]
+        self.scope = [prelude]
 
     def lookup(self, name):
         for frame in reversed(self.scope):
@@ -90,14 +563,38 @@ class Unsugar(WormVisitor):
 
     def visit_funcDef(self, node):
         self.scope.append(node.attached)
+        try:
+            return super().visit_funcDef(node)
+        finally:
+            self.scope.pop()
 
-        return super().visit_funcDef(node)
+    def visit_block(self, node):
+        if not node.hygienic:
+            return super().visit_block(node)
+        self.scope.append(node.attached)
+        try:
+            return super().visit_block(node)
+        finally:
+            self.scope.pop()
+
+    def visit_if(self, node):
+        match = as_match(node)
+        if match is not None:
+            return self.visit(match)
+        return super().visit_if(node)
+
+    def visit_match(self, node):
+        match = super().visit_match(node)
+        # Sum constructors in patterns are only recognized now
+        for pattern, _ in match.cases:
+            check_pattern(pattern)
+        return match
 
     def visit_exprStatement(self, node):
         val = super().visit(node.value)
         if isinstance(val, WExpr):
-            node.value = val
-            return node
+            # the node may belong to a block template, it must not be changed
+            return WExprStatement(val).copy_common(node)
         else:
             # have been expanded into a non-expr
             return val
@@ -105,13 +602,39 @@ class Unsugar(WormVisitor):
     def visit_call(self, node):
         if isinstance(node.func, WName):
             bind = self.lookup(node.func.name)
-            if bind:
+            if isinstance(bind, Variant):
+                # constructor put in the scope, ok(x) for Result.ok(x)
+                return self.variant(bind.sum_type, bind.name, node)
+            elif bind:
                 if getattr(bind, "_wrapped_block", False):
-                    return bind(*node.args, **node.kwargs)
+                    # expand the blocks used in the block too
+                    return self.visit(bind(*node.args, **node.kwargs))
                 elif getattr(bind, "_primitive", False):
-                    return bind(super().visit_call(node))
+                    call = super().visit_call(node)
+                    return bind(*call.args, **call.kwargs).copy_common(node)
+        elif isinstance(node.func, WGetAttr) and isinstance(node.func.value, WName):
+            bind = self.lookup(node.func.value.name)
+            if isinstance(bind, Sum):
+                if node.func.attr not in bind.variants:
+                    raise WormTypeError(
+                        f"{node.func.value.name} has no variant {node.func.attr}.",
+                        at=node.src_pos,
+                    )
+                return self.variant(bind, node.func.attr, node)
         return super().visit_call(node)
 
+    def variant(self, sum_type, name, node):
+        """
+        Turn the call of the constructor of the variant name into a WVariant.
+        """
+        arity = 0 if sum_type.variants[name] is void else 1
+        if len(node.args) != arity or node.kwargs:
+            raise WormTypeError(
+                f"The variant {name} takes {arity} argument(s).", at=node.src_pos
+            )
+        value = self.visit(node.args[0]) if arity else None
+        return WVariant(sum_type, name, value).copy_common(node)
+
 
 class Renaming(WormVisitor):
     """
@@ -123,8 +646,13 @@ class Renaming(WormVisitor):
         self._counter = 0
         # FIXME Add the outer scope
         self.scope = [[extract_name_from_scope(prelude)]]
-        self.symbols = set()
+        # unique symbol to the name it replaces
+        self.symbols = {}
+        # user defined function to its unique name
         self.globals = {}
+        # scope key to the reason its value is not a constant, for the
+        # function being renamed
+        self.rejected = {}
 
     # internals
     # def get_name(self, base):
@@ -160,7 +688,7 @@ class Renaming(WormVisitor):
         else:
             frame[base] = new_name
 
-        self.symbols.add(frame[base])
+        self.symbols[frame[base]] = base
         return frame[base]
 
     @contextmanager
@@ -203,6 +731,7 @@ class Renaming(WormVisitor):
         if self.stop_at_proto:
             assert node.name != "__main"
             node.name = self.add_to_scope(node.name)
+            self.globals[id(getattr(node, "origin", node))] = node.name
             return node
 
         if node.name == "__main":
@@ -211,6 +740,22 @@ class Renaming(WormVisitor):
             name = node.name
 
         with self.major_frame():
+            self.rejected = {}
+            for local_name, value in node.attached.items():
+                if isinstance(value, NativeFunction):
+                    self.add_to_scope(local_name, value.name)
+                elif isinstance(value, WFuncDef) and id(value) in self.globals:
+                    # a Worm function bound to another name, as the results
+                    # of generic instantiations are
+                    self.add_to_scope(local_name, self.globals[id(value)])
+                elif not isinstance(value, type):
+                    constant = as_constant(value)
+                    reason = None if constant else constant_error(value)
+                    if constant is not None:
+                        self.add_to_scope(local_name, constant.name)
+                    elif reason is not None:
+                        self.rejected[local_name] = reason
+
             defaults = list(map(self.visit, node.defaults))
 
             with self.minor_frame():
@@ -243,6 +788,17 @@ class Renaming(WormVisitor):
 
             return WBlock(map(self.visit, prelude + node.statements)).copy_common(node)
 
+    def visit_match(self, node):
+        subject = self.visit(node.subject)
+        cases = []
+        for pattern, body in node.cases:
+            with self.minor_frame():
+                self.add_to_scope("_", "_")
+                for name in pattern_bindings(pattern):
+                    self.add_to_scope(name.name)
+                cases.append((self.visit(pattern), self.visit(body)))
+        return WMatch(subject, cases, self.visit(node.orelse)).copy_common(node)
+
     def visit_class(self, node):
         with self.major_frame():
             name = self.add_to_scope(node.name)
@@ -252,7 +808,13 @@ class Renaming(WormVisitor):
 
     def visit_name(self, node):
         renamed = self.in_scope(node.name)
-        if not renamed:
+        if not renamed and node.name in self.rejected:
+            raise WormTypeError(
+                f"{node.name} cannot be used as a constant:"
+                f" {self.rejected[node.name]}.",
+                at=node.src_pos,
+            )
+        elif not renamed:
             raise WormBindingError(
                 f"Unbound symbol {node.name}. {self.scope}", at=node.src_pos
             )
@@ -274,12 +836,19 @@ class Renaming(WormVisitor):
 class ValidateMain(WormVisitor):
     def visit_topLevel(self, node):
         if node.entry is not None:
-            if node.entry.returns.deref() is None:
+            if node.entry.returns.deref() in (None, void):
                 node.entry.returns = void
                 self.returns = void
             else:
                 self.returns = int
                 node.entry.returns = int
+            args = node.entry.args
+            if len(args) > 1 or (args and args[0].type.deref() != Array[str]):
+                raise WormTypeError(
+                    "The entry point takes either no argument or the command line"
+                    " arguments as an Array[str].",
+                    at=node.entry.src_pos,
+                )
             self.visit(node.entry.body)
 
         return node
@@ -326,45 +895,148 @@ class CollectRequiredSymbols(WormVisitor):
     # Probleme: Renaming sert justement à ne plus avoir besoin de connaitre le scope des
     # symboles alors comment faire le tri dans cette passe ?
 
-class MakeCSource(WormVisitor):
-    def visit_topLevel(self, node):
-        code = node.headers
+_gc_leave = "wm_gc_top = wm_gc_here.prev;\nwm_gc_ntemps = wm_gc_here.ntemps;"
 
-        for k, t in node.required.items():
-            if isinstance(t, WormType) and t.is_declared():
-                code.append(t.declaration(to_c_type))
 
-        for k, f in node.required.items():
-            if isinstance(f, WFuncDef):
-                proto = f.prototype
-                arg_list = ", ".join(to_c_type(type.deref()) for type in proto["args"])
-                code.append(to_c_type(proto["return"]) + f' {proto["name"]}({arg_list});')
+class MakeCSource(WormVisitor):
+    def __init__(
+        self, gc=False, lines=False, profile=frozenset(), exports=None, runtime=()
+    ):
+        self.gc = gc
+        # units required by the options (see Program.runtime_unit)
+        self.runtime = list(runtime)
+        # C name of exported functions to their external symbol
+        self.exports = exports or {}
+        # emit #line directives pointing to the Worm source
+        self.lines = lines
+        # True or the C names of the functions to measure (see worm.std.profile)
+        self.profile = profile
+        # file of the function being translated
+        self.src_file = None
+        # roots of the function being translated, None outside of gc mode
+        self.gc_roots = None
+        self.matches = 0
+        # enclosing loops of the statement being translated (see visit_while)
+        self.loops = []
+        self.loop_count = 0
+        self.types = {}
 
+    def visit_topLevel(self, node):
+        self.types = {}
+        out = io.StringIO()
+        self.write(node, self.translate(node), out)
+        return out.getvalue()
+
+    def translate(self, node):
+        """
+        Yield the C code and prototype (None for the entry point) of the
+        functions of node.
+        """
         if node.entry is not None:
-            code.append(self.visit(node.entry))
+            yield self.visit(node.entry), None
 
         for f in node.functions:
-            code.append(self.visit(f))
+            yield self.visit(f), self.prototype(f)
 
-        return "\n".join(code)
+    def prototype(self, f):
+        proto = f.prototype
+        arg_list = ", ".join(self.c_type(type.deref()) for type in proto["args"])
+        return self.c_type(proto["return"]) + f' {proto["name"]}({arg_list});'
+
+    def write(self, node, translated, out):
+        """
+        Write the C source of the program to the text file out, translated
+        yielding the code and prototype of each function (see translate).
+
+        The functions are written to a spool (a temporary file past
+        SPOOL_SIZE) as they are translated, then copied after the
+        declarations they need, so only one function is kept in memory.
+        """
+        prototypes = []
+        with tempfile.SpooledTemporaryFile(SPOOL_SIZE, mode="w+") as spool:
+            for code, prototype in translated:
+                spool.write("\n")
+                spool.write(code)
+                if prototype is not None:
+                    prototypes.append(prototype)
+
+            self.write_declarations(node, prototypes, out)
+            spool.seek(0)
+            shutil.copyfileobj(spool, out)
+
+    def write_declarations(self, node, prototypes, out):
+        """
+        Write everything before the functions: headers, types, native units,
+        constants and prototypes.
+        """
+        units = resolve_units(node.natives.values())
+        names = {unit.name for unit in units}
+        units[:0] = [unit for unit in self.runtime if unit.name not in names]
+
+        for native in node.natives.values():
+            self.declare(native.returns.deref())
+            for arg in native.args:
+                self.declare(arg.deref())
+
+        for unit in units:
+            for t in unit.types:
+                self.declare(t)
+
+        for t in node.required.values():
+            self.declare(t)
+
+        for constant in node.constants.values():
+            self.declare(constant.type)
+
+        headers = list(node.headers)
+        headers.extend(h for h in unit_headers(units) if h not in headers)
+        out.write("\n".join(headers))
+
+        for t in self.types.values():
+            out.write("\n" + t.declaration(to_c_type))
+
+        if self.gc:
+            out.write("\n#define WM_GC_PRECISE 1")
+
+        for unit in units:
+            out.write("\n" + unit.source)
+
+        for constant in node.constants.values():
+            out.write("\n" + constant.render())
+
+        for prototype in prototypes:
+            out.write("\n" + prototype)
+
+    def declare(self, type_):
+        """
+        Record type_ and the types it depends on as needing a declaration.
+        """
+        if isinstance(type_, WormType):
+            for dep in type_.dependencies():
+                self.declare(dep)
+            if type_.is_declared() and type_.name not in self.types:
+                self.types[type_.name] = type_
+
+    def c_type(self, type_):
+        self.declare(type_)
+        return to_c_type(type_)
 
     def visit_constant(self, node):
         if isinstance(node.value, str):
-            return "\"" + repr(node.value)[1:-1] + "\""
+            return c_string(node.value)
         else:
             return repr(node.value)
 
     def visit_array(self, node):
-        return Array(node.elements.type.deref()).value_to_c(
-            list(map(self.visit, node.elements))
-        )
+        self.declare(node.type.deref())
+        return node.type.deref().value_to_c(list(map(self.visit, node.elements)))
 
     def visit_tuple(self, node):
         raise NotImplementedError()
 
     def visit_struct(self, node):
         return (
-            f"({to_c_type(node.type.deref())}){{"
+            f"({self.c_type(node.type.deref())}){{"
             + ", ".join(f".{self.visit(name)}={self.visit(val)}" for name, val in node.fields)
             + "}"
         )
@@ -376,6 +1048,9 @@ class MakeCSource(WormVisitor):
         return f"{node.op}{self.visit(node.operand)}"
 
     def visit_ptr(self, node):
+        return f"&({self.visit(node.value)})"
+
+    def visit_deref(self, node):
         return f"*({self.visit(node.value)})"
 
     def visit_binary(self, node):
@@ -391,7 +1066,7 @@ class MakeCSource(WormVisitor):
         else:
             op = " || "
 
-        return "(" + op.join(node.values) + ")"
+        return "(" + op.join(map(self.visit, node.values)) + ")"
 
     def visit_compare(self, node):
         left = self.visit(node.left)
@@ -405,8 +1080,34 @@ class MakeCSource(WormVisitor):
     def visit_exprStatement(self, node):
         return self.visit(node.value) + ";"
 
+    def line(self, node):
+        """
+        Return the #line directive attributing the code of node to its Worm
+        source, or None.
+        """
+        if not self.lines or self.src_file is None or node.src_pos is None:
+            return None
+        return f"#line {node.src_pos[0]} {c_string(self.src_file)}"
+
     def visit_block(self, node):
-        return "\n".join(map(self.visit, node.statements))
+        src_file = self.src_file
+        if node.src_file is not None:
+            self.src_file = node.src_file
+
+        code = []
+        for statement in node.statements:
+            directive = self.line(statement)
+            if directive is not None:
+                code.append(directive)
+            code.append(self.visit(statement))
+            if self.gc_roots is not None and isinstance(
+                statement, (WAssign, WExprStatement)
+            ):
+                # values computed by the statement are either stored or dead
+                code.append("wm_gc_ntemps = wm_gc_here.ntemps;")
+
+        self.src_file = src_file
+        return "\n".join(code)
 
     def visit_call(self, node):
         if not isinstance(node.func, WName):
@@ -416,6 +1117,11 @@ class MakeCSource(WormVisitor):
 
         return f"{node.func.name}({arg_list})"
 
+    def visit_variant(self, node):
+        value = None if node.value is None else self.visit(node.value)
+        self.declare(node.sum_type)
+        return node.sum_type.construct(node.variant, value)
+
     def visit_ifExpr(self, node):
         test = self.visit(node.test)
         body = self.visit(node.body)
@@ -430,10 +1136,15 @@ class MakeCSource(WormVisitor):
         raise NotImplementedError()
 
     def visit_getItem(self, node):
-        raise NotImplementedError()
+        item = f"{self.visit(node.value)}.elems[{self.visit(node.slice)}]"
+        t = node.value.type.deref()
+        if isinstance(t, Table) and t.storage != to_c_type(t.element_type):
+            # narrow storage, read as a Worm int or float
+            return f"(({to_c_type(t.element_type)}){item})"
+        return item
 
     def visit_setItem(self, node):
-        raise NotImplementedError()
+        return f"{self.visit(node.value)}.elems[{self.visit(node.slice)}]"
 
     def visit_slice(self, node):
         raise NotImplementedError()
@@ -442,13 +1153,20 @@ class MakeCSource(WormVisitor):
         if len(node.targets) > 1:
             raise NotImplementedError()
         target = node.targets[0]
-        if not isinstance(target, WStoreName):
-            raise NotImplementedError(target)
-
         expr = self.visit(node.value)
 
+        if isinstance(target, WSetItem):
+            return f"{self.visit(target)} = {expr};"
+        elif not isinstance(target, WStoreName):
+            raise NotImplementedError(target)
+
         if target.declaration:
-            return f"{to_c_type(node.type.deref())} {target.name} = {expr};"
+            type_ = node.type.deref()
+            if self.gc_roots is not None and gc_managed(type_):
+                # declared at the top of the function to be registered as root
+                self.gc_roots.append((self.c_type(type_), target.name))
+                return f"{target.name} = {expr};"
+            return f"{self.c_type(type_)} {target.name} = {expr};"
         else:
             return f"{target.name} = {expr};"
 
@@ -470,45 +1188,208 @@ class MakeCSource(WormVisitor):
         orelse = self.visit(node.orelse)
         return f"if({test}){{\n{body}\n}} else {{\n{orelse}\n}}"
 
+    def visit_match(self, node):
+        self.matches += 1
+        subject = f"wm_match_{self.matches}"
+        subject_type = node.subject.type.deref()
+        if self.loops:
+            # the cases may be in a C switch, see visit_break
+            self.loops[-1]["matches"] += 1
+        cases = []
+        for pattern, body in node.cases:
+            if isinstance(subject_type, Sum):
+                key, conditions, bindings = destructure_variant(pattern, subject)
+            else:
+                key = constant_value(pattern)
+                conditions, bindings = destructure(pattern, subject)
+            code = [
+                f"{self.c_type(name.type.deref())} {name.name} = {value};"
+                for name, value in bindings
+            ]
+            code.append(self.visit(body))
+            cases.append((key, conditions, "\n".join(code)))
+
+        orelse = self.visit(node.orelse)
+        if self.loops:
+            self.loops[-1]["matches"] -= 1
+        if isinstance(subject_type, Sum):
+            tree = tag_tree(subject_type.tag_of(subject), cases, orelse)
+        else:
+            tree = decision_tree(subject, cases, orelse, f"wm_case_{self.matches}")
+        return "\n".join(
+            [
+                "{",
+                f"{self.c_type(subject_type)} {subject} = {self.visit(node.subject)};",
+                tree,
+                "}",
+            ]
+        )
+
     def visit_for(self, node):
         raise NotImplementedError()
 
     def visit_while(self, node):
         test = self.visit(node.test)
+        self.loop_count += 1
+        # matches being translated in the loop, whether a label is needed
+        loop = {"id": self.loop_count, "matches": 0, "break": False, "continue": False}
+        self.loops.append(loop)
         body = self.visit(node.body)
+        self.loops.pop()
         # FIXME (gotta implement break first I guess)
         # orelse = '\n'.join(map(self.visit, node.orelse))
-        return f"while({test}){{\n{body}\n}}"
+        if loop["continue"]:
+            body = f"{body}\nwm_continue_{loop['id']}:;"
+        code = f"while({test}){{\n{body}\n}}"
+        if loop["break"]:
+            code = f"{code}\nwm_break_{loop['id']}:;"
+        return code
+
+    def visit_break(self, node):
+        return self.jump(node, "break")
 
     def visit_continue(self, node):
-        raise NotImplementedError()
+        return self.jump(node, "continue")
+
+    def jump(self, node, statement):
+        """
+        C code of a break or continue statement. In the body of a match,
+        which may be a case of a C switch, it is a goto to a label of the
+        loop.
+        """
+        if not self.loops:
+            raise WormSyntaxError(f"{statement} outside of a loop.", at=node.src_pos)
+        loop = self.loops[-1]
+        if not loop["matches"]:
+            return f"{statement};"
+        loop[statement] = True
+        return f"goto wm_{statement}_{loop['id']};"
 
     def visit_funcDef(self, node):
-        prelude = []
-        for name, value in node.attached.items():
-            # FIXME attached is weird, it represent both values put in scope and types and is used at different moments
-            if isinstance(value, (int, bool, float, str)):
-                t = to_c_type(type(value))
-                prelude.append(f"{t} {name} = {repr(value)};")
-            elif isinstance(value, (WormType, type(lambda: 0))):
-                pass  # we probably don't need that
-            else:
-                continue
-                # FIXME there is really to many things, we may need to split attached into two separate things again
-                raise NotImplementedError(f"We got a {name}={value} in attached values of {node.name}")
+        # values of the scope are emitted once as globals (see worm.constants)
+        self.src_file = node.src_file
+        if self.gc:
+            self.gc_roots = [
+                (None, arg.name) for arg in node.args if gc_managed(arg.type.deref())
+            ]
+            self.gc_returns = node.returns.deref()
         body = self.visit(node.body)
-        returns = to_c_type(node.returns.deref())
-        args = [f"{to_c_type(arg.type.deref())} {arg.name}" for arg in node.args]
+        returns = self.c_type(node.returns.deref())
+        args = [f"{self.c_type(arg.type.deref())} {arg.name}" for arg in node.args]
         arg_list = ", ".join(args)
-        head = f"{returns} {node.name}({arg_list}){{"
-        return "\n".join(prelude + [head, body, "}"])
+        params = [arg.name for arg in node.args]
+        if node.name == "main" and node.args:
+            # entry point receiving the command line (see ValidateMain)
+            body = f"{args[0]} = {{wm_argc, wm_argv}};\n{body}"
+            arg_list = "int wm_argc, char** wm_argv"
+            params = ["wm_argc", "wm_argv"]
+        profiled = self.profile is True or node.name in self.profile
+        name = self.profile_body(node.name) if profiled else node.name
+        head = f"{returns} {name}({arg_list}){{"
+        if self.gc:
+            body = self.gc_frame(body)
+            self.gc_roots = None
+        code = "\n".join([head, body, "}"])
+        if profiled:
+            code = self.instrument(node.name, returns, arg_list, params, code)
+        if node.name in self.exports:
+            code = "\n".join([code, self.export(node.name, returns, arg_list, params)])
+        directive = self.line(node)
+        if directive is not None:
+            code = f"{directive}\n{code}"
+        return code
+
+    def profile_body(self, name):
+        """
+        C name of the function holding the code of the measured function name.
+        """
+        return f"wm_prof_body_{name}"
+
+    def instrument(self, name, returns, arg_list, params, code):
+        """
+        Return the C code of the function name measured by a wrapper calling
+        the runtime of worm.std.profile: code is the C code of the function
+        named profile_body(name), returns the C return type, arg_list the C
+        parameter list and params the names of the parameters. The wrapper of
+        a void entry point returns the exit status 0.
+        """
+        entry = f"wm_prof_{name}"
+        call = f"{self.profile_body(name)}({', '.join(params)});"
+        if returns != "void":
+            call = f"{returns} wm_prof_result = {call}"
+        status = name == "main" and returns == "void"
+        lines = [
+            f'static wm_prof_entry {entry} = {{"{name}"}};',
+            f"static {code}",
+            f"{'int' if status else returns} {name}({arg_list}){{",
+            "wm_prof_frame wm_prof_here;",
+            f"wm_prof_enter(&wm_prof_here, &{entry});",
+            call,
+            "wm_prof_leave(&wm_prof_here);",
+        ]
+        if returns != "void":
+            lines.append("return wm_prof_result;")
+        elif status:
+            lines.append("return 0;")
+        lines.append("}")
+        return "\n".join(lines)
+
+    def export(self, name, returns, arg_list, params):
+        """
+        Return the definition of the external symbol of the exported function
+        name, calling it.
+        """
+        call = f"{name}({', '.join(params)});"
+        return "\n".join(
+            [
+                f'__attribute__((visibility("default"))) {returns}'
+                f" {self.exports[name]}({arg_list}){{",
+                call if returns == "void" else f"return {call}",
+                "}",
+            ]
+        )
+
+    def gc_frame(self, body):
+        """
+        Wrap body with the registration of the roots of the current function
+        in the shadow stack of the garbage collector.
+        """
+        code = [f"{t} {name} = NULL;" for t, name in self.gc_roots if t is not None]
+        if self.gc_roots:
+            addresses = ", ".join(f"(void**)&{name}" for _, name in self.gc_roots)
+            code.append(f"void** wm_gc_roots[] = {{{addresses}}};")
+            roots = "wm_gc_roots"
+        else:
+            roots = "NULL"
+        frame = f"{{wm_gc_top, {len(self.gc_roots)}, {roots}, wm_gc_ntemps}}"
+        code += [
+            f"wm_gc_frame wm_gc_here = {frame};",
+            "wm_gc_top = &wm_gc_here;",
+            body,
+            _gc_leave,
+        ]
+        return "\n".join(code)
 
     def visit_class(self, node):
         pass
 
     def visit_return(self, node):
-        value = self.visit(node.value)
-        return f"return {value};"
+        if self.gc_roots is None:
+            if node.value is None:
+                return "return;"
+            return f"return {self.visit(node.value)};"
+
+        if node.value is None:
+            return f"{{\n{_gc_leave}\nreturn;\n}}"
+        code = [
+            f"{self.c_type(self.gc_returns)} wm_gc_result = {self.visit(node.value)};",
+            _gc_leave,
+        ]
+        if gc_managed(self.gc_returns):
+            # the caller has not stored the result yet
+            code.append("wm_gc_temp(wm_gc_result);")
+        code.append("return wm_gc_result;")
+        return "{\n" + "\n".join(code) + "\n}"
 
 
 def extract_name_from_scope(scope):
@@ -0,0 +1,5 @@
+"""
+Worm standard library.
+Each module exposes native functions and types (see worm.native) and a
+namespace dict meant to be injected in Worm code with worm.scope(**namespace).
+"""
@@ -0,0 +1,472 @@
+"""
+Command line arguments parser generated at compile time.
+
+The options are described in Python with an interface close to the one of
+the argparse module of the standard library:
+
+    cli = ArgumentParser("greet", description="Greet someone.")
+    cli.add_argument("name", help="who to greet")
+    cli.add_argument("-n", "--count", type=int, default=1)
+    cli.add_argument("-v", "--verbose", action="count")
+
+    with worm.scope(Args=cli.Args, parse_args=cli.parse_args, **argparse.namespace):
+        @worm.entry
+        def main(argv: Argv):
+            args: Args = parse_args(argv)
+
+cli.Args is a Struct with one typed field per argument (int, float or str,
+flags are ints) and cli.parse_args the native function filling it from the
+arguments of the entry point. The generated C dispatches on the length of
+long option names then on their characters with nested switch statements, a
+single memcmp confirming the match, and short options with a switch on their
+letter. Values are converted straight into the fields of the result and str
+fields point into argv, so no option table is built or searched at run time.
+
+Supported: flags (store_true, store_false, count), options with a value
+(--count 3, --count=3, -n 3, -n3), grouped short flags (-vv), required
+options, positional arguments, -- and the automatic -h/--help. Unlike Python's
+argparse, long options cannot be abbreviated. Errors print the usage and a
+message on stderr and exit with status 2.
+"""
+import itertools
+
+from ..errors import WormTypeError
+from ..native import CUnit, NativeFunction, c_string
+from ..wtypes import Array, Struct
+
+
+Argv = Array[str]
+
+
+_source = r"""
+static void wm_args_fail(const char* usage, const char* prog, const char* msg, const char* arg){
+    fprintf(stderr, usage, prog);
+    if(arg){
+        fprintf(stderr, "%s: error: %s: %s\n", prog, msg, arg);
+    } else {
+        fprintf(stderr, "%s: error: %s\n", prog, msg);
+    }
+    exit(2);
+}
+
+static int64_t wm_args_int(const char* usage, const char* prog, const char* option, const char* value){
+    char* end;
+    errno = 0;
+    long long v = strtoll(value, &end, 0);
+    if(errno || end == value || *end){
+        fprintf(stderr, usage, prog);
+        fprintf(stderr, "%s: error: argument %s: invalid int value: '%s'\n", prog, option, value);
+        exit(2);
+    }
+    return v;
+}
+
+static double wm_args_float(const char* usage, const char* prog, const char* option, const char* value){
+    char* end;
+    errno = 0;
+    double v = strtod(value, &end);
+    if(errno || end == value || *end){
+        fprintf(stderr, usage, prog);
+        fprintf(stderr, "%s: error: argument %s: invalid float value: '%s'\n", prog, option, value);
+        exit(2);
+    }
+    return v;
+}
+"""
+
+
+unit = CUnit(
+    "argparse",
+    source=_source,
+    headers=["#include <errno.h>", "#include <string.h>"],
+)
+
+
+class Argument:
+    def __init__(self, names, dest, type_, action, default, required, help, metavar):
+        self.names = names
+        self.dest = dest
+        self.type = type_
+        self.action = action
+        self.default = default
+        self.required = required
+        self.help = help
+        self.metavar = metavar
+
+    @property
+    def positional(self):
+        return not self.names[0].startswith("-")
+
+    @property
+    def takes_value(self):
+        return self.action == "store"
+
+    @property
+    def display(self):
+        """
+        Name of the argument in error messages.
+        """
+        return "/".join(self.names)
+
+    def c_default(self):
+        if self.default is None:
+            return {int: "0", float: "0.0", str: "NULL"}[self.type]
+        elif self.type == str:
+            return c_string(self.default)
+        elif self.type == float:
+            return repr(float(self.default))
+        else:
+            return str(int(self.default))
+
+    def store(self, value):
+        """
+        C statements storing the C string value into the result.
+        """
+        if self.action == "store_true":
+            return f"r.{self.dest} = 1;"
+        elif self.action == "store_false":
+            return f"r.{self.dest} = 0;"
+        elif self.action == "count":
+            return f"r.{self.dest}++;"
+        elif self.type == str:
+            return f"r.{self.dest} = {value};"
+        else:
+            convert = "wm_args_int" if self.type == int else "wm_args_float"
+            return (
+                f"r.{self.dest} = {convert}(usage, prog, {c_string(self.display)}, {value});"
+            )
+
+
+_counter = itertools.count()
+
+
+class ArgumentParser:
+    """
+    Specification of the command line of a program, see the module
+    documentation.
+    """
+
+    def __init__(self, prog=None, description=None, add_help=True):
+        self.prog = prog
+        self.description = description
+        self.add_help = add_help
+        self.arguments = []
+        self._id = next(_counter)
+        self._native = None
+
+    def add_argument(
+        self,
+        *names,
+        type=None,
+        action="store",
+        default=None,
+        required=None,
+        help=None,
+        metavar=None,
+        dest=None,
+    ):
+        if self._native is not None:
+            raise WormTypeError("Cannot add arguments to a parser already generated.")
+        if not names:
+            raise WormTypeError("add_argument needs at least a name.")
+
+        positional = not names[0].startswith("-")
+        if positional and len(names) > 1:
+            raise WormTypeError(f"Positional argument {names[0]} has several names.")
+        for name in names:
+            if not positional and (
+                not name.startswith("-") or name == "-" or name in ("--", "---")
+                or (not name.startswith("--") and len(name) != 2)
+            ):
+                raise WormTypeError(f"Invalid option name {name}.")
+            if any(name in arg.names for arg in self._options()):
+                raise WormTypeError(f"Conflicting option name {name}.")
+
+        if action not in ("store", "store_true", "store_false", "count"):
+            raise WormTypeError(f"Unknown action {action}.")
+        if action != "store":
+            if positional or type is not None:
+                raise WormTypeError(f"Action {action} is only for options without a type.")
+            type = int
+            if default is None:
+                default = 1 if action == "store_false" else 0
+        type = type or str
+        if type not in (int, float, str):
+            raise WormTypeError(f"Unsupported argument type {type}.")
+
+        if dest is None:
+            if positional:
+                dest = names[0]
+            else:
+                long_names = [n for n in names if n.startswith("--")]
+                dest = (long_names or names)[0].lstrip("-")
+            dest = dest.replace("-", "_")
+        if not dest.isidentifier() or any(dest == arg.dest for arg in self.arguments):
+            raise WormTypeError(f"Invalid or duplicated destination {dest}.")
+
+        if required is None:
+            required = positional
+        if metavar is None:
+            metavar = dest if positional else dest.upper()
+
+        self.arguments.append(
+            Argument(names, dest, type, action, default, required, help, metavar)
+        )
+
+    @property
+    def Args(self):
+        """
+        Struct type of the parsed arguments.
+        """
+        return self.parse_args.returns.deref()
+
+    @property
+    def parse_args(self):
+        """
+        Native function taking the argv of the entry point and returning an
+        Args value.
+        """
+        if self._native is None:
+            args = Struct(**{arg.dest: arg.type for arg in self.arguments})
+            name = f"wm_args_parse_{self._id}"
+            parser_unit = CUnit(
+                name,
+                source=self.c_source(name, args),
+                types=[args, Argv],
+                requires=[unit],
+            )
+            self._native = NativeFunction(name, args, Argv, unit=parser_unit)
+        return self._native
+
+    def _options(self):
+        options = [arg for arg in self.arguments if not arg.positional]
+        if self.add_help:
+            help_ = Argument(
+                ("-h", "--help"), None, None, "help", None, False,
+                "show this help message and exit", None,
+            )
+            options.insert(0, help_)
+        return options
+
+    def usage(self):
+        """
+        Usage line, with %s standing for the program name.
+        """
+        parts = []
+        for arg in self._options():
+            option = arg.names[0]
+            if arg.takes_value:
+                option += " " + arg.metavar
+            parts.append(option if arg.required else f"[{option}]")
+        parts.extend(arg.metavar for arg in self.arguments if arg.positional)
+        return "usage: %s " + " ".join(parts).replace("%", "%%") + "\n"
+
+    def help(self):
+        """
+        Complete help message, with %s standing for the program name.
+        """
+        lines = [self.usage()]
+        if self.description:
+            lines.append(self.description.replace("%", "%%") + "\n")
+
+        def entry(invocation, text):
+            invocation = "  " + invocation
+            if not text:
+                return [invocation]
+            text = text.replace("%", "%%")
+            if len(invocation) <= 22:
+                return [invocation.ljust(24) + text]
+            return [invocation, " " * 24 + text]
+
+        positionals = [arg for arg in self.arguments if arg.positional]
+        if positionals:
+            lines.append("positional arguments:")
+            for arg in positionals:
+                lines.extend(entry(arg.metavar, arg.help))
+            lines.append("")
+        lines.append("options:")
+        for arg in self._options():
+            if arg.takes_value:
+                invocation = ", ".join(f"{n} {arg.metavar}" for n in arg.names)
+            else:
+                invocation = ", ".join(arg.names)
+            lines.extend(entry(invocation, arg.help))
+        return "\n".join(lines) + "\n"
+
+    def c_source(self, name, args):
+        options = self._options()
+        positionals = [arg for arg in self.arguments if arg.positional]
+        required = [arg for arg in options if arg.required]
+
+        prog = c_string(self.prog) if self.prog else "argv.length ? argv.elems[0] : \"\""
+        fields = ", ".join(f".{arg.dest}={arg.c_default()}" for arg in self.arguments)
+        code = [
+            f"{args.name} {name}({Argv.name} argv){{",
+            f"static const char usage[] = {c_string(self.usage())};",
+            f"{args.name} r = {{{fields}}};",
+            f"const char* prog = {prog};",
+            "int64_t npos = 0;",
+            "int only_positionals = 0;",
+        ]
+        if required:
+            code.append(f"unsigned char seen[{len(required)}] = {{0}};")
+        code += [
+            "for(int64_t i = 1; i < argv.length; i++){",
+            "char* a = argv.elems[i];",
+            "char* value = NULL;",
+            "if(only_positionals || a[0] != '-' || a[1] == 0){",
+            "switch(npos++){",
+        ]
+        for i, arg in enumerate(positionals):
+            code += [f"case {i}:", arg.store("a"), "break;"]
+        code += [
+            "default:",
+            'wm_args_fail(usage, prog, "unrecognized argument", a);',
+            "}",
+            "continue;",
+            "}",
+            # long options
+            "if(a[1] == '-'){",
+            "if(a[2] == 0){",
+            "only_positionals = 1;",
+            "continue;",
+            "}",
+            "char* name = a + 2;",
+            "size_t len = 0;",
+            "while(name[len] && name[len] != '='){",
+            "len++;",
+            "}",
+            "if(name[len] == '='){",
+            "value = name + len + 1;",
+            "}",
+        ]
+        long_names = {}
+        for arg in options:
+            for n in arg.names:
+                if n.startswith("--"):
+                    long_names[n[2:]] = self._handle(arg, required, short=False)
+        code += dispatch_names(long_names)
+        code += [
+            'wm_args_fail(usage, prog, "unrecognized argument", a);',
+            "}",
+            # short options, flags can be grouped as in -vq
+            "for(char* c = a + 1; *c; c++){",
+            "switch(*c){",
+        ]
+        for arg in options:
+            for n in arg.names:
+                if not n.startswith("--"):
+                    code += [f"case {_c_char(n[1])}:", *self._handle(arg, required, short=True)]
+        code += [
+            "default:",
+            'wm_args_fail(usage, prog, "unrecognized argument", a);',
+            "}",
+            "}",
+            "wm_next: ;",
+            "}",
+        ]
+        if positionals:
+            code += [
+                f"if(npos < {len(positionals)}){{",
+                "static const char* missing[] = {"
+                + ", ".join(c_string(arg.metavar) for arg in positionals)
+                + "};",
+                'wm_args_fail(usage, prog, "the following argument is required", missing[npos]);',
+                "}",
+            ]
+        for index, arg in enumerate(required):
+            code += [
+                f"if(!seen[{index}]){{",
+                f'wm_args_fail(usage, prog, "the following argument is required", {c_string(arg.display)});',
+                "}",
+            ]
+        code += ["return r;", "}"]
+        return "\n".join(code)
+
+    def _handle(self, arg, required, short):
+        """
+        C statements handling the option arg once recognised.
+        """
+        if arg.action == "help":
+            return [
+                f"printf({c_string(self.help())}, prog);",
+                "exit(0);",
+            ]
+        code = []
+        if arg in required:
+            code.append(f"seen[{required.index(arg)}] = 1;")
+        if arg.takes_value:
+            if short:
+                code.append("value = c[1] ? c + 1 : NULL;")
+            code += [
+                "if(!value){",
+                "if(++i >= argv.length){",
+                f'wm_args_fail(usage, prog, "expected one argument", {c_string(arg.display)});',
+                "}",
+                "value = argv.elems[i];",
+                "}",
+                arg.store("value"),
+                "goto wm_next;",
+            ]
+        else:
+            if not short:
+                code += [
+                    "if(value){",
+                    'wm_args_fail(usage, prog, "ignored explicit argument", a);',
+                    "}",
+                ]
+            code.append(arg.store(None))
+            code.append("continue;" if short else "goto wm_next;")
+        return code
+
+
+def _c_char(c):
+    return "'\\''" if c == "'" else ("'\\\\'" if c == "\\" else f"'{c}'")
+
+
+def dispatch_names(handlers):
+    """
+    Nested switch statements selecting among the names of handlers (a dict
+    of name to list of C statements) the one stored in the C variables name
+    (not NUL terminated) and len, and running its handler. Falls through
+    when no name matches.
+    """
+    by_length = {}
+    for n, handler in handlers.items():
+        by_length.setdefault(len(n), {})[n] = handler
+    if not by_length:
+        return []
+
+    code = ["switch(len){"]
+    for length, group in sorted(by_length.items()):
+        code.append(f"case {length}:")
+        code += _dispatch_chars(group)
+        code.append("break;")
+    code.append("}")
+    return code
+
+
+def _dispatch_chars(group):
+    if len(group) == 1:
+        [(n, handler)] = group.items()
+        return [f"if(memcmp(name, {c_string(n)}, {len(n)}) == 0){{", *handler, "}"]
+
+    # the position with the most distinct characters splits the group best
+    length = len(next(iter(group)))
+    position = max(range(length), key=lambda p: len({n[p] for n in group}))
+    subgroups = {}
+    for n, handler in group.items():
+        subgroups.setdefault(n[position], {})[n] = handler
+
+    code = [f"switch(name[{position}]){{"]
+    for c, subgroup in sorted(subgroups.items()):
+        code.append(f"case {_c_char(c)}:")
+        code += _dispatch_chars(subgroup)
+        code.append("break;")
+    code.append("}")
+    return code
+
+
+namespace = {
+    "Argv": Argv,
+}
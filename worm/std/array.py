@@ -0,0 +1,56 @@
+"""
+Heap allocated arrays.
+new_array(T) and free_array(T) return the native functions allocating and
+releasing an Array[T], the namespace provides them for int and float.
+"""
+from ..native import CUnit, NativeFunction
+from ..wtypes import Array, to_c_type, c_identifier, void
+
+
+_natives = {}
+
+
+def _array_natives(element_type):
+    if element_type not in _natives:
+        array = Array[element_type]
+        c_array = to_c_type(array)
+        c_element = to_c_type(element_type)
+        suffix = c_identifier(c_element)
+        source = f"""
+{c_array} wm_array_new_{suffix}(int64_t length){{
+    {c_array} a = {{length, calloc(length > 0 ? length : 1, sizeof({c_element}))}};
+    return a;
+}}
+
+void wm_array_free_{suffix}({c_array} a){{
+    free(a.elems);
+}}
+"""
+        unit = CUnit(f"array_{suffix}", source=source, types=[array])
+        _natives[element_type] = (
+            NativeFunction(f"wm_array_new_{suffix}", array, int, unit=unit),
+            NativeFunction(f"wm_array_free_{suffix}", void, array, unit=unit),
+        )
+    return _natives[element_type]
+
+
+def new_array(element_type):
+    """
+    Native function allocating a zeroed Array[element_type] of a given length.
+    """
+    return _array_natives(element_type)[0]
+
+
+def free_array(element_type):
+    """
+    Native function releasing an array allocated by new_array(element_type).
+    """
+    return _array_natives(element_type)[1]
+
+
+namespace = {
+    "new_int_array": new_array(int),
+    "new_float_array": new_array(float),
+    "free_int_array": free_array(int),
+    "free_float_array": free_array(float),
+}
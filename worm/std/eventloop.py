@@ -0,0 +1,374 @@
+"""
+Single threaded event loop on top of epoll (Linux only).
+
+The API is callback based: Worm functions are registered to be called when a
+file descriptor becomes readable or writable, or when a timer expires. Watchers
+are level triggered and stay registered until unwatch is called. Timers are one
+shot, a callback can rearm itself with call_later. watch_read, watch_write and
+unwatch return -1 for a negative fd, such as a failed tcp_listen, and 0
+otherwise.
+
+Read callbacks, write callbacks: (loop: Loop, fd: int) -> void
+Timer callbacks: (loop: Loop, data: int) -> void
+
+Sockets created by this module are non-blocking.
+"""
+from ..native import CUnit, NativeFunction
+from ..type_checker import FunctionPrototype
+from ..wtypes import SimpleType, void
+
+
+Loop = SimpleType("wm_loop*")
+
+FdCallback = FunctionPrototype(void, Loop, int)
+TimerCallback = FunctionPrototype(void, Loop, int)
+
+
+_source = r"""
+typedef struct wm_loop wm_loop;
+typedef void (*wm_fd_cb)(wm_loop*, int64_t);
+
+typedef struct wm_watcher {
+    wm_fd_cb on_read;
+    wm_fd_cb on_write;
+} wm_watcher;
+
+typedef struct wm_timer {
+    int64_t deadline;
+    int64_t seq;
+    wm_fd_cb fn;
+    int64_t data;
+} wm_timer;
+
+struct wm_loop {
+    int epfd;
+    int stop;
+    wm_watcher* watchers; /* indexed by fd */
+    int64_t nwatchers_slots;
+    int64_t nwatched;
+    wm_timer* timers; /* binary min heap on (deadline, seq) */
+    int64_t ntimers, timers_capacity;
+    int64_t timer_seq;
+};
+
+static int64_t wm_now_ms(void){
+    struct timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (int64_t)ts.tv_sec * 1000 + ts.tv_nsec / 1000000;
+}
+
+wm_loop* wm_loop_new(void){
+    wm_loop* loop = calloc(1, sizeof(wm_loop));
+    loop->epfd = epoll_create1(EPOLL_CLOEXEC);
+    loop->nwatchers_slots = 64;
+    loop->watchers = calloc(loop->nwatchers_slots, sizeof(wm_watcher));
+    loop->timers_capacity = 16;
+    loop->timers = malloc(loop->timers_capacity * sizeof(wm_timer));
+    return loop;
+}
+
+void wm_loop_free(wm_loop* loop){
+    close(loop->epfd);
+    free(loop->watchers);
+    free(loop->timers);
+    free(loop);
+}
+
+void wm_loop_stop(wm_loop* loop){
+    loop->stop = 1;
+}
+
+static void wm_loop_update(wm_loop* loop, int64_t fd, wm_watcher before){
+    wm_watcher* w = &loop->watchers[fd];
+    struct epoll_event ev = {0};
+    ev.data.fd = fd;
+    if(w->on_read){
+        ev.events |= EPOLLIN;
+    }
+    if(w->on_write){
+        ev.events |= EPOLLOUT;
+    }
+    int was = before.on_read || before.on_write;
+    if(!ev.events){
+        if(was){
+            epoll_ctl(loop->epfd, EPOLL_CTL_DEL, fd, NULL);
+            loop->nwatched--;
+        }
+    } else if(was){
+        epoll_ctl(loop->epfd, EPOLL_CTL_MOD, fd, &ev);
+    } else {
+        epoll_ctl(loop->epfd, EPOLL_CTL_ADD, fd, &ev);
+        loop->nwatched++;
+    }
+}
+
+/* Return NULL for an invalid fd. */
+static wm_watcher* wm_loop_watcher(wm_loop* loop, int64_t fd){
+    if(fd < 0){
+        return NULL;
+    }
+    if(fd >= loop->nwatchers_slots){
+        int64_t slots = loop->nwatchers_slots;
+        while(fd >= slots){
+            slots *= 2;
+        }
+        loop->watchers = realloc(loop->watchers, slots * sizeof(wm_watcher));
+        memset(loop->watchers + loop->nwatchers_slots, 0, (slots - loop->nwatchers_slots) * sizeof(wm_watcher));
+        loop->nwatchers_slots = slots;
+    }
+    return &loop->watchers[fd];
+}
+
+int64_t wm_watch_read(wm_loop* loop, int64_t fd, wm_fd_cb cb){
+    wm_watcher* w = wm_loop_watcher(loop, fd);
+    if(!w){
+        return -1;
+    }
+    wm_watcher before = *w;
+    w->on_read = cb;
+    wm_loop_update(loop, fd, before);
+    return 0;
+}
+
+int64_t wm_watch_write(wm_loop* loop, int64_t fd, wm_fd_cb cb){
+    wm_watcher* w = wm_loop_watcher(loop, fd);
+    if(!w){
+        return -1;
+    }
+    wm_watcher before = *w;
+    w->on_write = cb;
+    wm_loop_update(loop, fd, before);
+    return 0;
+}
+
+int64_t wm_unwatch(wm_loop* loop, int64_t fd){
+    wm_watcher* w = wm_loop_watcher(loop, fd);
+    if(!w){
+        return -1;
+    }
+    wm_watcher before = *w;
+    w->on_read = NULL;
+    w->on_write = NULL;
+    wm_loop_update(loop, fd, before);
+    return 0;
+}
+
+static int wm_timer_before(wm_timer* a, wm_timer* b){
+    return a->deadline < b->deadline || (a->deadline == b->deadline && a->seq < b->seq);
+}
+
+void wm_call_later(wm_loop* loop, int64_t ms, wm_fd_cb fn, int64_t data){
+    if(loop->ntimers == loop->timers_capacity){
+        loop->timers_capacity *= 2;
+        loop->timers = realloc(loop->timers, loop->timers_capacity * sizeof(wm_timer));
+    }
+    wm_timer t = {wm_now_ms() + ms, loop->timer_seq++, fn, data};
+    int64_t i = loop->ntimers++;
+    while(i > 0 && wm_timer_before(&t, &loop->timers[(i - 1) / 2])){
+        loop->timers[i] = loop->timers[(i - 1) / 2];
+        i = (i - 1) / 2;
+    }
+    loop->timers[i] = t;
+}
+
+static wm_timer wm_timer_pop(wm_loop* loop){
+    wm_timer top = loop->timers[0];
+    wm_timer last = loop->timers[--loop->ntimers];
+    int64_t i = 0, n = loop->ntimers;
+    while(1){
+        int64_t child = 2 * i + 1;
+        if(child >= n){
+            break;
+        }
+        if(child + 1 < n && wm_timer_before(&loop->timers[child + 1], &loop->timers[child])){
+            child++;
+        }
+        if(!wm_timer_before(&loop->timers[child], &last)){
+            break;
+        }
+        loop->timers[i] = loop->timers[child];
+        i = child;
+    }
+    loop->timers[i] = last;
+    return top;
+}
+
+/* Run until wm_loop_stop is called or there is nothing left to wait for. */
+void wm_loop_run(wm_loop* loop){
+    struct epoll_event events[64];
+    loop->stop = 0;
+    while(!loop->stop && (loop->nwatched > 0 || loop->ntimers > 0)){
+        int timeout = -1;
+        if(loop->ntimers > 0){
+            int64_t delay = loop->timers[0].deadline - wm_now_ms();
+            timeout = delay > 0 ? (int)delay : 0;
+        }
+        int n = epoll_wait(loop->epfd, events, 64, timeout);
+        for(int i = 0; i < n && !loop->stop; i++){
+            int64_t fd = events[i].data.fd;
+            /* a previous callback may have changed the watchers */
+            wm_watcher w = loop->watchers[fd];
+            if((events[i].events & (EPOLLIN | EPOLLHUP | EPOLLERR)) && w.on_read){
+                w.on_read(loop, fd);
+                w = loop->watchers[fd];
+            }
+            if((events[i].events & (EPOLLOUT | EPOLLHUP | EPOLLERR)) && w.on_write){
+                w.on_write(loop, fd);
+            }
+        }
+        int64_t now = wm_now_ms();
+        while(!loop->stop && loop->ntimers > 0 && loop->timers[0].deadline <= now){
+            wm_timer t = wm_timer_pop(loop);
+            t.fn(loop, t.data);
+        }
+    }
+}
+
+static int wm_set_nonblocking(int fd){
+    int flags = fcntl(fd, F_GETFL, 0);
+    return fcntl(fd, F_SETFL, flags | O_NONBLOCK);
+}
+
+static int wm_fill_addr(struct sockaddr_in* addr, const char* host, int64_t port){
+    memset(addr, 0, sizeof(*addr));
+    addr->sin_family = AF_INET;
+    addr->sin_port = htons((uint16_t)port);
+    return inet_pton(AF_INET, host, &addr->sin_addr) == 1 ? 0 : -1;
+}
+
+int64_t wm_tcp_listen(char* host, int64_t port){
+    struct sockaddr_in addr;
+    if(wm_fill_addr(&addr, host, port) < 0){
+        return -1;
+    }
+    int fd = socket(AF_INET, SOCK_STREAM | SOCK_NONBLOCK | SOCK_CLOEXEC, 0);
+    int one = 1;
+    setsockopt(fd, SOL_SOCKET, SO_REUSEADDR, &one, sizeof(one));
+    if(bind(fd, (struct sockaddr*)&addr, sizeof(addr)) < 0 || listen(fd, SOMAXCONN) < 0){
+        close(fd);
+        return -1;
+    }
+    return fd;
+}
+
+int64_t wm_tcp_connect(char* host, int64_t port){
+    struct sockaddr_in addr;
+    if(wm_fill_addr(&addr, host, port) < 0){
+        return -1;
+    }
+    int fd = socket(AF_INET, SOCK_STREAM | SOCK_NONBLOCK | SOCK_CLOEXEC, 0);
+    if(connect(fd, (struct sockaddr*)&addr, sizeof(addr)) < 0 && errno != EINPROGRESS){
+        close(fd);
+        return -1;
+    }
+    return fd;
+}
+
+int64_t wm_socket_port(int64_t fd){
+    struct sockaddr_in addr;
+    socklen_t len = sizeof(addr);
+    if(getsockname(fd, (struct sockaddr*)&addr, &len) < 0){
+        return -1;
+    }
+    return ntohs(addr.sin_port);
+}
+
+/* Return -1 when no connection is pending. */
+int64_t wm_sock_accept(int64_t fd){
+    int conn = accept(fd, NULL, NULL);
+    if(conn >= 0){
+        wm_set_nonblocking(conn);
+    }
+    return conn;
+}
+
+/* Return -1 when the operation would block, 0 at end of stream. */
+int64_t wm_sock_recv(int64_t fd, char* buf, int64_t size){
+    return recv(fd, buf, size, 0);
+}
+
+int64_t wm_sock_send(int64_t fd, char* buf, int64_t size){
+    return send(fd, buf, size, MSG_NOSIGNAL);
+}
+
+int64_t wm_sock_send_str(int64_t fd, char* s){
+    return send(fd, s, strlen(s), MSG_NOSIGNAL);
+}
+
+void wm_sock_close(int64_t fd){
+    close(fd);
+}
+
+/* Zero initialised byte buffer, usable as a C string. */
+char* wm_buffer_new(int64_t size){
+    return calloc(size + 1, 1);
+}
+
+void wm_buffer_free(char* buf){
+    free(buf);
+}
+"""
+
+
+unit = CUnit(
+    "eventloop",
+    source=_source,
+    headers=[
+        "#include <errno.h>",
+        "#include <fcntl.h>",
+        "#include <string.h>",
+        "#include <time.h>",
+        "#include <unistd.h>",
+        "#include <arpa/inet.h>",
+        "#include <netinet/in.h>",
+        "#include <sys/epoll.h>",
+        "#include <sys/socket.h>",
+    ],
+)
+
+loop_new = NativeFunction("wm_loop_new", Loop, unit=unit)
+loop_free = NativeFunction("wm_loop_free", void, Loop, unit=unit)
+loop_run = NativeFunction("wm_loop_run", void, Loop, unit=unit)
+loop_stop = NativeFunction("wm_loop_stop", void, Loop, unit=unit)
+
+watch_read = NativeFunction("wm_watch_read", int, Loop, int, FdCallback, unit=unit)
+watch_write = NativeFunction("wm_watch_write", int, Loop, int, FdCallback, unit=unit)
+unwatch = NativeFunction("wm_unwatch", int, Loop, int, unit=unit)
+call_later = NativeFunction(
+    "wm_call_later", void, Loop, int, TimerCallback, int, unit=unit
+)
+
+tcp_listen = NativeFunction("wm_tcp_listen", int, str, int, unit=unit)
+tcp_connect = NativeFunction("wm_tcp_connect", int, str, int, unit=unit)
+socket_port = NativeFunction("wm_socket_port", int, int, unit=unit)
+sock_accept = NativeFunction("wm_sock_accept", int, int, unit=unit)
+sock_recv = NativeFunction("wm_sock_recv", int, int, str, int, unit=unit)
+sock_send = NativeFunction("wm_sock_send", int, int, str, int, unit=unit)
+sock_send_str = NativeFunction("wm_sock_send_str", int, int, str, unit=unit)
+sock_close = NativeFunction("wm_sock_close", void, int, unit=unit)
+
+buffer_new = NativeFunction("wm_buffer_new", str, int, unit=unit)
+buffer_free = NativeFunction("wm_buffer_free", void, str, unit=unit)
+
+
+namespace = {
+    "Loop": Loop,
+    "loop_new": loop_new,
+    "loop_free": loop_free,
+    "loop_run": loop_run,
+    "loop_stop": loop_stop,
+    "watch_read": watch_read,
+    "watch_write": watch_write,
+    "unwatch": unwatch,
+    "call_later": call_later,
+    "tcp_listen": tcp_listen,
+    "tcp_connect": tcp_connect,
+    "socket_port": socket_port,
+    "sock_accept": sock_accept,
+    "sock_recv": sock_recv,
+    "sock_send": sock_send,
+    "sock_send_str": sock_send_str,
+    "sock_close": sock_close,
+    "buffer_new": buffer_new,
+    "buffer_free": buffer_free,
+}
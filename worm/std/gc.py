@@ -0,0 +1,311 @@
+"""
+Optional garbage collected strings.
+
+The collector is a non-moving mark and sweep. It is only active in programs
+compiled with gc=True (dump_source, save_source and save_program accept it):
+then the compiler registers the string variables of every function as
+precise roots in a shadow stack, and the values produced by an unfinished
+statement are kept in a table of temporaries, so a collection can happen in
+any allocation. Strings built by the natives below are collected when no
+longer reachable, other strings (literals, buffers of other modules) are
+ignored by the collector.
+
+Without gc=True the natives allocate the same way but nothing is ever
+collected.
+
+The collector records the number of collections, the pause of each collection
+and the total time spent collecting. gc_stats() prints them on stderr, as does
+the program at exit when the WORM_GC_STATS environment variable is set.
+
+The shadow stack, the temporaries and the heap are process globals without
+locking: the collector is single threaded, and compiling a program using
+worm.std.threading with gc=True is an error.
+"""
+from ..native import CUnit, NativeFunction
+from ..wtypes import void
+
+
+_source = r"""
+typedef struct wm_gc_frame {
+    struct wm_gc_frame* prev;
+    int64_t nroots;
+    void*** roots;
+    int64_t ntemps;
+} wm_gc_frame;
+
+typedef struct wm_gc_header {
+    struct wm_gc_header* next;
+    size_t size;
+    unsigned char marked;
+    unsigned char atomic;
+} wm_gc_header;
+
+#define WM_GC_HEADER ((sizeof(wm_gc_header) + 15) & ~(size_t)15)
+#define WM_GC_PAYLOAD(h) ((void*)((char*)(h) + WM_GC_HEADER))
+#define WM_GC_OBJECT(p) ((wm_gc_header*)((char*)(p) - WM_GC_HEADER))
+
+wm_gc_frame* wm_gc_top = NULL;
+void** wm_gc_temps = NULL;
+int64_t wm_gc_ntemps = 0;
+static int64_t wm_gc_temps_cap = 0;
+
+static struct {
+    wm_gc_header* objects;
+    /* open addressing set of the payload addresses */
+    void** table;
+    size_t table_cap;
+    size_t count;
+    size_t live_bytes;
+    size_t since_collect;
+    size_t threshold;
+    wm_gc_header** stack;
+    size_t stack_len, stack_cap;
+    int64_t collections;
+    size_t allocated_bytes, freed_bytes;
+    int64_t total_pause_ns, max_pause_ns;
+    int64_t start_ns;
+} wm_gc = {.threshold = 1 << 20};
+
+static int64_t wm_gc_now(void){
+    struct timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return (int64_t)t.tv_sec * 1000000000 + t.tv_nsec;
+}
+
+static size_t wm_gc_slot(void* p, size_t cap){
+    uintptr_t x = (uintptr_t)p >> 4;
+    x *= 0x9e3779b97f4a7c15ULL;
+    return (x >> 17) & (cap - 1);
+}
+
+static void wm_gc_table_insert(void* p){
+    size_t i = wm_gc_slot(p, wm_gc.table_cap);
+    while(wm_gc.table[i]){
+        i = (i + 1) & (wm_gc.table_cap - 1);
+    }
+    wm_gc.table[i] = p;
+}
+
+static int wm_gc_table_contains(void* p){
+    if(wm_gc.table_cap == 0){
+        return 0;
+    }
+    size_t i = wm_gc_slot(p, wm_gc.table_cap);
+    while(wm_gc.table[i]){
+        if(wm_gc.table[i] == p){
+            return 1;
+        }
+        i = (i + 1) & (wm_gc.table_cap - 1);
+    }
+    return 0;
+}
+
+/* Rebuild the set from the object list, large enough for count + extra objects. */
+static void wm_gc_table_rebuild(size_t extra){
+    size_t cap = 64;
+    while(cap < 2 * (wm_gc.count + extra)){
+        cap <<= 1;
+    }
+    free(wm_gc.table);
+    wm_gc.table = calloc(cap, sizeof(void*));
+    wm_gc.table_cap = cap;
+    for(wm_gc_header* h = wm_gc.objects; h; h = h->next){
+        wm_gc_table_insert(WM_GC_PAYLOAD(h));
+    }
+}
+
+static void wm_gc_mark(void* p){
+    if(p == NULL || !wm_gc_table_contains(p)){
+        return;
+    }
+    wm_gc_header* h = WM_GC_OBJECT(p);
+    if(h->marked){
+        return;
+    }
+    h->marked = 1;
+    if(!h->atomic){
+        if(wm_gc.stack_len == wm_gc.stack_cap){
+            wm_gc.stack_cap = wm_gc.stack_cap ? 2 * wm_gc.stack_cap : 256;
+            wm_gc.stack = realloc(wm_gc.stack, wm_gc.stack_cap * sizeof(*wm_gc.stack));
+        }
+        wm_gc.stack[wm_gc.stack_len++] = h;
+    }
+}
+
+void wm_gc_collect(void){
+#ifdef WM_GC_PRECISE
+    int64_t start = wm_gc_now();
+
+    for(wm_gc_frame* f = wm_gc_top; f; f = f->prev){
+        for(int64_t i = 0; i < f->nroots; i++){
+            wm_gc_mark(*f->roots[i]);
+        }
+    }
+    for(int64_t i = 0; i < wm_gc_ntemps; i++){
+        wm_gc_mark(wm_gc_temps[i]);
+    }
+    /* objects that are not atomic are scanned conservatively */
+    while(wm_gc.stack_len){
+        wm_gc_header* h = wm_gc.stack[--wm_gc.stack_len];
+        void** words = WM_GC_PAYLOAD(h);
+        for(size_t i = 0; i < h->size / sizeof(void*); i++){
+            wm_gc_mark(words[i]);
+        }
+    }
+
+    wm_gc_header** link = &wm_gc.objects;
+    while(*link){
+        wm_gc_header* h = *link;
+        if(h->marked){
+            h->marked = 0;
+            link = &h->next;
+        } else {
+            *link = h->next;
+            wm_gc.count--;
+            wm_gc.live_bytes -= h->size;
+            wm_gc.freed_bytes += h->size;
+            free(h);
+        }
+    }
+    wm_gc_table_rebuild(0);
+
+    wm_gc.since_collect = 0;
+    wm_gc.threshold = wm_gc.live_bytes > (1 << 20) ? 2 * wm_gc.live_bytes : 1 << 20;
+
+    int64_t pause = wm_gc_now() - start;
+    wm_gc.collections++;
+    wm_gc.total_pause_ns += pause;
+    if(pause > wm_gc.max_pause_ns){
+        wm_gc.max_pause_ns = pause;
+    }
+#endif
+}
+
+void wm_gc_stats(void){
+    double run = wm_gc.start_ns ? (wm_gc_now() - wm_gc.start_ns) / 1e9 : 0.0;
+    double pause = wm_gc.total_pause_ns / 1e9;
+    fprintf(
+        stderr,
+        "gc: %ld collections, pauses total %.3f ms, max %.3f ms, mean %.3f ms\n"
+        "gc: %.1f%% of %.3f s spent collecting\n"
+        "gc: %zu bytes allocated, %zu freed, %zu live in %zu objects\n",
+        (long)wm_gc.collections,
+        pause * 1e3,
+        wm_gc.max_pause_ns / 1e6,
+        wm_gc.collections ? pause * 1e3 / wm_gc.collections : 0.0,
+        run > 0 ? 100.0 * pause / run : 0.0,
+        run,
+        wm_gc.allocated_bytes,
+        wm_gc.freed_bytes,
+        wm_gc.live_bytes,
+        wm_gc.count
+    );
+}
+
+/* Keep p alive until the end of the statement being evaluated. */
+static inline void* wm_gc_temp(void* p){
+    if(wm_gc_ntemps == wm_gc_temps_cap){
+        wm_gc_temps_cap = wm_gc_temps_cap ? 2 * wm_gc_temps_cap : 64;
+        wm_gc_temps = realloc(wm_gc_temps, wm_gc_temps_cap * sizeof(void*));
+    }
+    wm_gc_temps[wm_gc_ntemps++] = p;
+    return p;
+}
+
+/* Zeroed memory, atomic objects are not scanned for pointers. */
+void* wm_gc_alloc(size_t size, int atomic){
+    if(wm_gc.start_ns == 0){
+        wm_gc.start_ns = wm_gc_now();
+        if(getenv("WORM_GC_STATS")){
+            atexit(wm_gc_stats);
+        }
+    }
+    if(wm_gc.since_collect + size > wm_gc.threshold){
+        wm_gc_collect();
+    }
+    wm_gc_header* h = calloc(1, WM_GC_HEADER + size);
+    h->size = size;
+    h->atomic = atomic;
+    h->next = wm_gc.objects;
+    wm_gc.objects = h;
+    wm_gc.count++;
+    wm_gc.live_bytes += size;
+    wm_gc.allocated_bytes += size;
+    wm_gc.since_collect += size;
+    if(2 * wm_gc.count > wm_gc.table_cap){
+        wm_gc_table_rebuild(wm_gc.count);
+    } else {
+        wm_gc_table_insert(WM_GC_PAYLOAD(h));
+    }
+#ifdef WM_GC_PRECISE
+    return wm_gc_temp(WM_GC_PAYLOAD(h));
+#else
+    return WM_GC_PAYLOAD(h);
+#endif
+}
+
+char* wm_gc_str_new(int64_t length){
+    return wm_gc_alloc(length + 1, 1);
+}
+
+char* wm_gc_str_concat(const char* a, const char* b){
+    size_t la = strlen(a), lb = strlen(b);
+    char* s = wm_gc_alloc(la + lb + 1, 1);
+    memcpy(s, a, la);
+    memcpy(s + la, b, lb);
+    return s;
+}
+
+char* wm_gc_str_repeat(const char* a, int64_t n){
+    size_t la = strlen(a);
+    char* s = wm_gc_alloc(n > 0 ? la * n + 1 : 1, 1);
+    for(int64_t i = 0; i < n; i++){
+        memcpy(s + la * i, a, la);
+    }
+    return s;
+}
+
+char* wm_gc_str_from_int(int64_t x){
+    char* s = wm_gc_alloc(21, 1);
+    snprintf(s, 21, "%ld", (long)x);
+    return s;
+}
+
+int64_t wm_gc_live_bytes(void){
+    return wm_gc.live_bytes;
+}
+
+int64_t wm_gc_collections(void){
+    return wm_gc.collections;
+}
+"""
+
+
+unit = CUnit(
+    "gc",
+    source=_source,
+    headers=["#include <string.h>", "#include <time.h>"],
+    conflicts={"threading": "the collector is not thread safe"},
+)
+
+
+str_new = NativeFunction("wm_gc_str_new", str, int, unit=unit)
+str_concat = NativeFunction("wm_gc_str_concat", str, str, str, unit=unit)
+str_repeat = NativeFunction("wm_gc_str_repeat", str, str, int, unit=unit)
+str_from_int = NativeFunction("wm_gc_str_from_int", str, int, unit=unit)
+gc_collect = NativeFunction("wm_gc_collect", void, unit=unit)
+gc_stats = NativeFunction("wm_gc_stats", void, unit=unit)
+gc_live_bytes = NativeFunction("wm_gc_live_bytes", int, unit=unit)
+gc_collections = NativeFunction("wm_gc_collections", int, unit=unit)
+
+
+namespace = {
+    "str_new": str_new,
+    "str_concat": str_concat,
+    "str_repeat": str_repeat,
+    "str_from_int": str_from_int,
+    "gc_collect": gc_collect,
+    "gc_stats": gc_stats,
+    "gc_live_bytes": gc_live_bytes,
+    "gc_collections": gc_collections,
+}
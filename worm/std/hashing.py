@@ -0,0 +1,259 @@
+"""
+Non-cryptographic hashing.
+
+hash_bytes and hash_str use a wyhash style function: fast, good distribution,
+but an attacker knowing the seed can build collisions. siphash_bytes and
+siphash_str implement SipHash-2-4, slower but keyed, for tables filled with
+untrusted keys.
+
+hash_function(T) returns the native function hashing a value of type T. For a
+Struct it generates at compile time a function that loads every scalar field
+(nested structs are flattened) and folds them two words at a time, so no
+function is called per field. Containers of the std get their hash from
+hash_function so that every table hashes the same way.
+"""
+from ..errors import WormTypeError
+from ..native import CUnit, NativeFunction
+from ..wtypes import Struct, Ptr, SimpleType
+
+
+_source = r"""
+#define WM_HASH_P0 0x2d358dccaa6c78a5ULL
+#define WM_HASH_P1 0x8bb84b93962eacc9ULL
+#define WM_HASH_P2 0x4b33a62ed433d4a3ULL
+#define WM_HASH_P3 0x4d5a2da51de1aa47ULL
+
+static inline uint64_t wm_hash_mix(uint64_t a, uint64_t b){
+    __uint128_t r = (__uint128_t)a * b;
+    return (uint64_t)r ^ (uint64_t)(r >> 64);
+}
+
+static inline uint64_t wm_hash_r8(const uint8_t* p){
+    uint64_t v;
+    memcpy(&v, p, 8);
+    return v;
+}
+
+static inline uint64_t wm_hash_r4(const uint8_t* p){
+    uint32_t v;
+    memcpy(&v, p, 4);
+    return v;
+}
+
+static inline uint64_t wm_hash_r3(const uint8_t* p, size_t k){
+    return ((uint64_t)p[0] << 16) | ((uint64_t)p[k >> 1] << 8) | p[k - 1];
+}
+
+static inline uint64_t wm_hash_f64(double x){
+    uint64_t v;
+    /* 0.0 == -0.0 so they must hash the same */
+    if(x == 0.0){
+        return 0;
+    }
+    memcpy(&v, &x, 8);
+    return v;
+}
+
+static inline uint64_t wm_wyhash(const void* key, size_t len, uint64_t seed){
+    const uint8_t* p = key;
+    uint64_t a, b;
+    seed ^= wm_hash_mix(seed ^ WM_HASH_P0, WM_HASH_P1);
+    if(len <= 16){
+        if(len >= 4){
+            a = (wm_hash_r4(p) << 32) | wm_hash_r4(p + ((len >> 3) << 2));
+            b = (wm_hash_r4(p + len - 4) << 32) | wm_hash_r4(p + len - 4 - ((len >> 3) << 2));
+        } else if(len > 0){
+            a = wm_hash_r3(p, len);
+            b = 0;
+        } else {
+            a = b = 0;
+        }
+    } else {
+        size_t i = len;
+        if(i >= 48){
+            uint64_t see1 = seed, see2 = seed;
+            do {
+                seed = wm_hash_mix(wm_hash_r8(p) ^ WM_HASH_P1, wm_hash_r8(p + 8) ^ seed);
+                see1 = wm_hash_mix(wm_hash_r8(p + 16) ^ WM_HASH_P2, wm_hash_r8(p + 24) ^ see1);
+                see2 = wm_hash_mix(wm_hash_r8(p + 32) ^ WM_HASH_P3, wm_hash_r8(p + 40) ^ see2);
+                p += 48;
+                i -= 48;
+            } while(i >= 48);
+            seed ^= see1 ^ see2;
+        }
+        while(i > 16){
+            seed = wm_hash_mix(wm_hash_r8(p) ^ WM_HASH_P1, wm_hash_r8(p + 8) ^ seed);
+            i -= 16;
+            p += 16;
+        }
+        a = wm_hash_r8(p + i - 16);
+        b = wm_hash_r8(p + i - 8);
+    }
+    a ^= WM_HASH_P1;
+    b ^= seed;
+    __uint128_t r = (__uint128_t)a * b;
+    a = (uint64_t)r;
+    b = (uint64_t)(r >> 64);
+    return wm_hash_mix(a ^ WM_HASH_P0 ^ len, b ^ WM_HASH_P1);
+}
+
+/* Hash of a 64 bits word, also used to finish struct hashes. */
+static inline uint64_t wm_hash_u64(uint64_t x){
+    return wm_hash_mix(wm_hash_mix(x ^ WM_HASH_P0, WM_HASH_P1) ^ WM_HASH_P0, WM_HASH_P1);
+}
+
+int64_t wm_hash_bytes(const char* data, int64_t len, int64_t seed){
+    return (int64_t)wm_wyhash(data, (size_t)len, (uint64_t)seed);
+}
+
+int64_t wm_hash_str(const char* s){
+    return (int64_t)wm_wyhash(s, strlen(s), 0);
+}
+
+int64_t wm_hash_int(int64_t x){
+    return (int64_t)wm_hash_u64((uint64_t)x);
+}
+
+int64_t wm_hash_float(double x){
+    return (int64_t)wm_hash_u64(wm_hash_f64(x));
+}
+
+#define WM_SIP_ROTL(x, b) (uint64_t)(((x) << (b)) | ((x) >> (64 - (b))))
+#define WM_SIP_ROUND \
+    do { \
+        v0 += v1; v1 = WM_SIP_ROTL(v1, 13); v1 ^= v0; v0 = WM_SIP_ROTL(v0, 32); \
+        v2 += v3; v3 = WM_SIP_ROTL(v3, 16); v3 ^= v2; \
+        v0 += v3; v3 = WM_SIP_ROTL(v3, 21); v3 ^= v0; \
+        v2 += v1; v1 = WM_SIP_ROTL(v1, 17); v1 ^= v2; v2 = WM_SIP_ROTL(v2, 32); \
+    } while(0)
+
+/* SipHash-2-4, k0 and k1 are the two little endian halves of the key. */
+int64_t wm_siphash_bytes(int64_t k0, int64_t k1, const char* data, int64_t len){
+    const uint8_t* p = (const uint8_t*)data;
+    const uint8_t* end = p + (len - len % 8);
+    uint64_t v0 = 0x736f6d6570736575ULL ^ (uint64_t)k0;
+    uint64_t v1 = 0x646f72616e646f6dULL ^ (uint64_t)k1;
+    uint64_t v2 = 0x6c7967656e657261ULL ^ (uint64_t)k0;
+    uint64_t v3 = 0x7465646279746573ULL ^ (uint64_t)k1;
+    uint64_t b = (uint64_t)len << 56;
+    for(; p != end; p += 8){
+        uint64_t m = wm_hash_r8(p);
+        v3 ^= m;
+        WM_SIP_ROUND;
+        WM_SIP_ROUND;
+        v0 ^= m;
+    }
+    for(int i = 0; i < len % 8; i++){
+        b |= (uint64_t)p[i] << (8 * i);
+    }
+    v3 ^= b;
+    WM_SIP_ROUND;
+    WM_SIP_ROUND;
+    v0 ^= b;
+    v2 ^= 0xff;
+    WM_SIP_ROUND;
+    WM_SIP_ROUND;
+    WM_SIP_ROUND;
+    WM_SIP_ROUND;
+    return (int64_t)(v0 ^ v1 ^ v2 ^ v3);
+}
+
+int64_t wm_siphash_str(int64_t k0, int64_t k1, const char* s){
+    return wm_siphash_bytes(k0, k1, s, strlen(s));
+}
+"""
+
+
+unit = CUnit(
+    "hashing",
+    source=_source,
+    headers=["#include <string.h>"],
+)
+
+hash_bytes = NativeFunction("wm_hash_bytes", int, str, int, int, unit=unit)
+hash_str = NativeFunction("wm_hash_str", int, str, unit=unit)
+hash_int = NativeFunction("wm_hash_int", int, int, unit=unit)
+hash_float = NativeFunction("wm_hash_float", int, float, unit=unit)
+siphash_bytes = NativeFunction(
+    "wm_siphash_bytes", int, int, int, str, int, unit=unit
+)
+siphash_str = NativeFunction("wm_siphash_str", int, int, int, str, unit=unit)
+
+
+def _words(type_, access):
+    """
+    Return the C expressions of the 64 bits words representing a value of
+    type_ accessed through the C expression access.
+    """
+    if type_ in (int, bool):
+        return [f"(uint64_t){access}"]
+    elif type_ == float:
+        return [f"wm_hash_f64({access})"]
+    elif type_ == str:
+        return [f"wm_wyhash({access}, strlen({access}), 0)"]
+    elif isinstance(type_, Ptr) or (
+        isinstance(type_, SimpleType) and type_.name.endswith("*")
+    ):
+        return [f"(uint64_t)(uintptr_t){access}"]
+    elif isinstance(type_, Struct):
+        words = []
+        for name, field in type_.fields.items():
+            words.extend(_words(field, f"{access}.{name}"))
+        return words
+    else:
+        raise WormTypeError(f"Cannot generate a hash function for {type_}.")
+
+
+def struct_hash_source(struct):
+    """
+    Return the name and C definition of the hash function of struct.
+    """
+    name = f"wm_hash_{struct.name}"
+    words = _words(struct, "v")
+    if len(words) % 2:
+        words.append("0")
+
+    body = ["uint64_t h = WM_HASH_P0;"]
+    for a, b in zip(words[::2], words[1::2]):
+        body.append(f"h = wm_hash_mix({a} ^ WM_HASH_P1, {b} ^ h);")
+    body.append(f"return (int64_t)wm_hash_u64(h ^ {len(words)});")
+
+    source = "\n".join(
+        [f"int64_t {name}({struct.name} v){{", *("    " + l for l in body), "}"]
+    )
+    return name, source
+
+
+_struct_hashes = {}
+
+
+def hash_function(type_):
+    """
+    Native function hashing a value of type_.
+    """
+    if type_ in (int, bool):
+        return hash_int
+    elif type_ == float:
+        return hash_float
+    elif type_ == str:
+        return hash_str
+    elif isinstance(type_, Struct):
+        if type_ not in _struct_hashes:
+            name, source = struct_hash_source(type_)
+            struct_unit = CUnit(name, source=source, types=[type_], requires=[unit])
+            _struct_hashes[type_] = NativeFunction(
+                name, int, type_, unit=struct_unit
+            )
+        return _struct_hashes[type_]
+    else:
+        raise WormTypeError(f"Cannot generate a hash function for {type_}.")
+
+
+namespace = {
+    "hash_bytes": hash_bytes,
+    "hash_str": hash_str,
+    "hash_int": hash_int,
+    "hash_float": hash_float,
+    "siphash_bytes": siphash_bytes,
+    "siphash_str": siphash_str,
+}
@@ -0,0 +1,435 @@
+"""
+Buffered standard output with printf specialised at compile time.
+
+The printf of this module has the same interface as the prelude printf, but
+each format string is parsed once by the compiler and turned into a dedicated C
+function writing straight into a 64 KiB stdout buffer: no format string is
+interpreted at runtime. Conversions that have no dedicated writer (%e, %g, %a,
+%p and precisions given as arguments) fall back to snprintf for that slot only.
+Constant string and character arguments are folded into the format.
+
+The buffer is flushed when full, at exit and by flush(). Output written with the
+prelude printf (libc stdio) is buffered separately and may interleave
+differently.
+"""
+from hashlib import sha1
+
+from ..native import CUnit, NativeFunction, c_string
+from ..prelude import PrintfChecker, formatconv_to_type
+from ..printf import parse_format, Slot, FormatError
+from ..wast import WConstant
+from ..wtypes import to_c_type, void
+
+
+_runtime = r"""
+#define WM_OUT_SIZE (1 << 16)
+#define WM_LEFT 1
+#define WM_ZERO 2
+#define WM_PLUS 4
+#define WM_SPACE 8
+#define WM_ALT 16
+
+static char wm_out_buf[WM_OUT_SIZE];
+static size_t wm_out_len = 0;
+static int wm_out_registered = 0;
+
+void wm_out_flush(void){
+    size_t done = 0;
+    while(done < wm_out_len){
+        ssize_t n = write(1, wm_out_buf + done, wm_out_len - done);
+        if(n < 0 && errno == EINTR){
+            continue;
+        } else if(n <= 0){
+            break;
+        }
+        done += n;
+    }
+    wm_out_len = 0;
+}
+
+/* Make room for n bytes, n <= WM_OUT_SIZE */
+static inline void wm_out_reserve(size_t n){
+    if(!wm_out_registered){
+        wm_out_registered = 1;
+        atexit(wm_out_flush);
+    }
+    if(wm_out_len + n > WM_OUT_SIZE){
+        wm_out_flush();
+    }
+}
+
+static inline void wm_out_write(const char* s, size_t n){
+    if(n > WM_OUT_SIZE){
+        wm_out_reserve(0);
+        wm_out_flush();
+        while(n > 0){
+            ssize_t w = write(1, s, n);
+            if(w < 0 && errno == EINTR){
+                continue;
+            } else if(w <= 0){
+                return;
+            }
+            s += w;
+            n -= w;
+        }
+        return;
+    }
+    wm_out_reserve(n);
+    memcpy(wm_out_buf + wm_out_len, s, n);
+    wm_out_len += n;
+}
+
+static inline void wm_out_pad(char c, int64_t n){
+    while(n > 0){
+        int64_t k = n < 64 ? n : 64;
+        wm_out_reserve(k);
+        memset(wm_out_buf + wm_out_len, c, k);
+        wm_out_len += k;
+        n -= k;
+    }
+}
+
+static inline void wm_out_uint(uint64_t v, int neg, int base, int upper, int flags, int64_t width, int64_t prec){
+    const char* table = upper ? "0123456789ABCDEF" : "0123456789abcdef";
+    char digits[24];
+    char prefix[3];
+    int n = 0, np = 0;
+    uint64_t x = v;
+    while(x){
+        digits[n++] = table[x % base];
+        x /= base;
+    }
+    if(v == 0 && prec != 0){
+        digits[n++] = '0';
+    }
+    if(neg){
+        prefix[np++] = '-';
+    } else if(flags & WM_PLUS){
+        prefix[np++] = '+';
+    } else if(flags & WM_SPACE){
+        prefix[np++] = ' ';
+    }
+    if((flags & WM_ALT) && base == 16 && v != 0){
+        prefix[np++] = '0';
+        prefix[np++] = upper ? 'X' : 'x';
+    }
+    int64_t zeros = prec > n ? prec - n : 0;
+    if((flags & WM_ALT) && base == 8 && zeros == 0 && (n == 0 || digits[n - 1] != '0')){
+        zeros = 1;
+    }
+    int64_t total = np + zeros + n;
+    int64_t pad = width > total ? width - total : 0;
+    if(pad && !(flags & WM_LEFT) && (flags & WM_ZERO) && prec < 0){
+        zeros += pad;
+        pad = 0;
+    }
+    if(!(flags & WM_LEFT)){
+        wm_out_pad(' ', pad);
+    }
+    wm_out_write(prefix, np);
+    wm_out_pad('0', zeros);
+    wm_out_reserve(n);
+    while(n > 0){
+        wm_out_buf[wm_out_len++] = digits[--n];
+    }
+    if(flags & WM_LEFT){
+        wm_out_pad(' ', pad);
+    }
+}
+
+static inline void wm_out_int(int64_t v, int flags, int64_t width, int64_t prec){
+    int neg = v < 0;
+    wm_out_uint(neg ? -(uint64_t)v : (uint64_t)v, neg, 10, 0, flags, width, prec);
+}
+
+/* Format a single conversion with snprintf, used when there is no dedicated writer. */
+static void wm_out_vformat(const char* fmt, va_list ap){
+    va_list again;
+    va_copy(again, ap);
+    wm_out_reserve(0);
+    size_t space = WM_OUT_SIZE - wm_out_len;
+    int n = vsnprintf(wm_out_buf + wm_out_len, space, fmt, ap);
+    if(n >= 0 && (size_t)n < space){
+        wm_out_len += n;
+    } else if(n >= 0){
+        char* tmp = malloc(n + 1);
+        vsnprintf(tmp, n + 1, fmt, again);
+        wm_out_write(tmp, n);
+        free(tmp);
+    }
+    va_end(again);
+}
+
+static void wm_out_format(const char* fmt, ...){
+    va_list ap;
+    va_start(ap, fmt);
+    wm_out_vformat(fmt, ap);
+    va_end(ap);
+}
+
+static void wm_out_double_fallback(double x, int flags, int64_t width, int64_t prec, char conv){
+    char fmt[16];
+    int i = 0;
+    fmt[i++] = '%';
+    if(flags & WM_LEFT) fmt[i++] = '-';
+    if(flags & WM_ZERO) fmt[i++] = '0';
+    if(flags & WM_PLUS) fmt[i++] = '+';
+    if(flags & WM_SPACE) fmt[i++] = ' ';
+    if(flags & WM_ALT) fmt[i++] = '#';
+    fmt[i++] = '*';
+    fmt[i++] = '.';
+    fmt[i++] = '*';
+    fmt[i++] = conv;
+    fmt[i] = 0;
+    wm_out_format(fmt, (int)width, (int)prec, x);
+}
+
+static const uint64_t wm_pow10[] = {
+    1, 10, 100, 1000, 10000, 100000, 1000000, 10000000, 100000000, 1000000000
+};
+
+/* %f with a precision up to 9 and |x| < 1e18, snprintf otherwise. */
+static inline void wm_out_fixed(double x, int flags, int64_t width, int64_t prec, int upper){
+    if(prec < 0){
+        prec = 6;
+    }
+    if(!(fabs(x) < 1e18) || prec > 9){
+        wm_out_double_fallback(x, flags, width, prec, upper ? 'F' : 'f');
+        return;
+    }
+    int neg = signbit(x) != 0;
+    double ax = fabs(x);
+    uint64_t ip, fp = 0;
+    if(prec == 0){
+        ip = (uint64_t)rint(ax);
+    } else {
+        ip = (uint64_t)ax;
+        fp = (uint64_t)rintl((long double)(ax - (double)ip) * wm_pow10[prec]);
+        if(fp >= wm_pow10[prec]){
+            ip++;
+            fp -= wm_pow10[prec];
+        }
+    }
+    char digits[32];
+    int n = 0;
+    for(int64_t i = 0; i < prec; i++){
+        digits[n++] = '0' + fp % 10;
+        fp /= 10;
+    }
+    if(prec > 0 || (flags & WM_ALT)){
+        digits[n++] = '.';
+    }
+    do {
+        digits[n++] = '0' + ip % 10;
+        ip /= 10;
+    } while(ip);
+    char sign = neg ? '-' : (flags & WM_PLUS) ? '+' : (flags & WM_SPACE) ? ' ' : 0;
+    int64_t total = n + (sign != 0);
+    int64_t pad = width > total ? width - total : 0;
+    if(!(flags & WM_LEFT) && !(flags & WM_ZERO)){
+        wm_out_pad(' ', pad);
+    }
+    if(sign){
+        wm_out_write(&sign, 1);
+    }
+    if(!(flags & WM_LEFT) && (flags & WM_ZERO)){
+        wm_out_pad('0', pad);
+    }
+    wm_out_reserve(n);
+    while(n > 0){
+        wm_out_buf[wm_out_len++] = digits[--n];
+    }
+    if(flags & WM_LEFT){
+        wm_out_pad(' ', pad);
+    }
+}
+
+static inline void wm_out_str(const char* s, int flags, int64_t width, int64_t prec){
+    size_t n = prec < 0 ? strlen(s) : strnlen(s, prec);
+    int64_t pad = width > (int64_t)n ? width - (int64_t)n : 0;
+    if(!(flags & WM_LEFT)){
+        wm_out_pad(' ', pad);
+    }
+    wm_out_write(s, n);
+    if(flags & WM_LEFT){
+        wm_out_pad(' ', pad);
+    }
+}
+
+static inline void wm_out_char(char c, int flags, int64_t width){
+    if(!(flags & WM_LEFT)){
+        wm_out_pad(' ', width - 1);
+    }
+    wm_out_write(&c, 1);
+    if(flags & WM_LEFT){
+        wm_out_pad(' ', width - 1);
+    }
+}
+"""
+
+runtime = CUnit(
+    "io",
+    source=_runtime,
+    headers=[
+        "#include <errno.h>",
+        "#include <math.h>",
+        "#include <stdarg.h>",
+        "#include <string.h>",
+        "#include <unistd.h>",
+    ],
+    ldflags=["-lm"],
+)
+
+flush = NativeFunction("wm_out_flush", void, unit=runtime)
+
+
+_flag_bits = {"-": 1, "0": 2, "+": 4, " ": 8, "#": 16}
+
+_c_types = {int: "int64_t", float: "double", str: "char*", chr: "char"}
+
+
+def slot_to_format(slot):
+    """
+    Rebuild the printf conversion described by slot, without length modifier.
+    """
+    prec = ""
+    if slot.prec is not None:
+        prec = ".*" if slot.prec[0] == "arg" else f".{slot.prec[1]}"
+    return (
+        "%"
+        + "".join(sorted(slot.flag or ()))
+        + ("" if slot.minwidth is None else str(slot.minwidth))
+        + prec
+        + slot.spec
+    )
+
+
+def fold_constants(format, args):
+    """
+    Inline constant string and character arguments into the format, return the
+    new format and remaining arguments.
+    """
+    elements, _ = parse_format(format)
+    new_format = []
+    new_args = []
+    args = iter(args)
+    for el in elements:
+        if not isinstance(el, Slot):
+            new_format.append(el.replace("%", "%%"))
+            continue
+        if el.prec is not None and el.prec[0] == "arg":
+            new_args.append(next(args))
+            new_format.append(slot_to_format(el))
+            new_args.append(next(args))
+            continue
+        arg = next(args)
+        if (
+            el.spec in {"s", "c"}
+            and isinstance(arg, WConstant)
+            and isinstance(arg.value, str)
+        ):
+            new_format.append((slot_to_format(el) % arg.value).replace("%", "%%"))
+        else:
+            new_format.append(slot_to_format(el))
+            new_args.append(arg)
+    return "".join(new_format), new_args
+
+
+def specialize_format(format):
+    """
+    Return (arg_types, C statements) implementing printf(format, ...) with the
+    parameters named a0, a1...
+    """
+    elements, _ = parse_format(format)
+    types = []
+    body = []
+
+    def param(type_):
+        types.append(type_)
+        return f"a{len(types) - 1}"
+
+    for el in elements:
+        if not isinstance(el, Slot):
+            if el:
+                body.append(
+                    f"wm_out_write({c_string(el)}, {len(el.encode('utf-8'))});"
+                )
+            continue
+
+        if el.spec == "n":
+            raise FormatError("%n is not supported.")
+
+        flags = sum(_flag_bits.get(f, 0) for f in el.flag or ())
+        width = -1 if el.minwidth is None else el.minwidth
+
+        if el.prec is not None and el.prec[0] == "arg":
+            prec_arg = param(int)
+            value = param(formatconv_to_type(el.spec))
+            body.append(
+                f"wm_out_format({c_string(slot_to_format(el))}, (int){prec_arg}, {value});"
+            )
+            continue
+
+        prec = -1 if el.prec is None else el.prec[1]
+        value = param(formatconv_to_type(el.spec))
+
+        if el.spec in {"d", "i"}:
+            body.append(f"wm_out_int({value}, {flags}, {width}, {prec});")
+        elif el.spec in {"u", "o", "x", "X"}:
+            base = {"u": 10, "o": 8, "x": 16, "X": 16}[el.spec]
+            upper = int(el.spec == "X")
+            body.append(
+                f"wm_out_uint((uint64_t){value}, 0, {base}, {upper}, {flags}, {width}, {prec});"
+            )
+        elif el.spec in {"f", "F"}:
+            upper = int(el.spec == "F")
+            body.append(f"wm_out_fixed({value}, {flags}, {width}, {prec}, {upper});")
+        elif el.spec == "s":
+            body.append(f"wm_out_str({value}, {flags}, {width}, {prec});")
+        elif el.spec == "c":
+            body.append(f"wm_out_char({value}, {flags}, {width});")
+        else:
+            body.append(f"wm_out_format({c_string(slot_to_format(el))}, {value});")
+
+    return types, body
+
+
+class BufferedPrintf(PrintfChecker, NativeFunction):
+    """
+    Type checked like printf, every call is replaced by a call to a function
+    specialised for its format.
+    """
+
+    def __init__(self):
+        NativeFunction.__init__(self, "wm_printf", void)
+        self._cache = {}
+
+    def specialize(self, format, *args):
+        new_format, new_args = fold_constants(format.value, args)
+        if new_format not in self._cache:
+            types, body = specialize_format(new_format)
+            name = "wm_printf_" + sha1(new_format.encode("utf-8")).hexdigest()[:12]
+            params = ", ".join(
+                f"{_c_types.get(t) or to_c_type(t)} a{i}" for i, t in enumerate(types)
+            )
+            source = "\n".join(
+                [
+                    f"/* {new_format!r} */",
+                    f"static void {name}({params or 'void'}){{",
+                    *body,
+                    "}",
+                ]
+            )
+            unit = CUnit(name, source=source, requires=[runtime])
+            self._cache[new_format] = NativeFunction(name, void, *types, unit=unit)
+
+        return self._cache[new_format], new_args
+
+
+printf = BufferedPrintf()
+
+
+namespace = {
+    "printf": printf,
+    "flush": flush,
+}
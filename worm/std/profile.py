@@ -0,0 +1,201 @@
+"""
+Optional function level profiling.
+
+Programs compiled with profile=True (dump_source, save_source and
+save_program accept it) count the calls and measure the time spent in each of
+their functions, profile may also be a list of the Worm names of the functions
+to measure. Each measured function is wrapped in a function reading the clock
+(clock_gettime) on entry and exit: the inclusive time of a function includes
+the functions it calls (recursive calls are counted once), the exclusive time
+does not. The report is written when the program exits, or by
+profile_report(), to the file named by the WORM_PROFILE environment variable
+(stderr by default).
+
+Each line of the report is "<C name> <calls> <inclusive ns> <exclusive ns>",
+read_report turns it into rows keyed by the Worm names of the functions (see
+Program.symbol_map), format_report into a table. From the shell:
+
+    python -m worm.std.profile report.txt [symbols.json]
+
+The counters are updated atomically, but the inclusive time of a function
+running in several threads at once only counts the calls started while no
+other was running.
+"""
+import json
+import sys
+
+from ..native import CUnit, NativeFunction
+from ..wtypes import void
+
+
+_source = r"""
+typedef struct wm_prof_entry {
+    const char* name;
+    int64_t calls;
+    int64_t inclusive_ns;
+    int64_t exclusive_ns;
+    /* running calls, the time of nested recursive calls is already counted */
+    int64_t active;
+    int registered;
+    struct wm_prof_entry* next;
+} wm_prof_entry;
+
+typedef struct wm_prof_frame {
+    struct wm_prof_frame* prev;
+    wm_prof_entry* entry;
+    int64_t start;
+    int64_t children;
+} wm_prof_frame;
+
+static wm_prof_entry* wm_prof_entries = NULL;
+static int wm_prof_installed = 0;
+static _Thread_local wm_prof_frame* wm_prof_top = NULL;
+
+static inline int64_t wm_prof_now(void){
+    struct timespec t;
+    clock_gettime(CLOCK_MONOTONIC, &t);
+    return (int64_t)t.tv_sec * 1000000000 + t.tv_nsec;
+}
+
+void wm_prof_report(void){
+    const char* path = getenv("WORM_PROFILE");
+    FILE* out = path ? fopen(path, "w") : stderr;
+    if(out == NULL){
+        return;
+    }
+    fprintf(out, "# worm profile: name calls inclusive_ns exclusive_ns\n");
+    for(wm_prof_entry* e = wm_prof_entries; e != NULL; e = e->next){
+        fprintf(
+            out, "%s %ld %ld %ld\n", e->name,
+            (long)__atomic_load_n(&e->calls, __ATOMIC_RELAXED),
+            (long)__atomic_load_n(&e->inclusive_ns, __ATOMIC_RELAXED),
+            (long)__atomic_load_n(&e->exclusive_ns, __ATOMIC_RELAXED)
+        );
+    }
+    if(path){
+        fclose(out);
+    }
+}
+
+static void wm_prof_register(wm_prof_entry* e){
+    if(__atomic_exchange_n(&e->registered, 1, __ATOMIC_ACQ_REL)){
+        return;
+    }
+    e->next = __atomic_load_n(&wm_prof_entries, __ATOMIC_ACQUIRE);
+    while(!__atomic_compare_exchange_n(
+        &wm_prof_entries, &e->next, e, 1, __ATOMIC_ACQ_REL, __ATOMIC_ACQUIRE
+    ));
+    if(!__atomic_exchange_n(&wm_prof_installed, 1, __ATOMIC_ACQ_REL)){
+        atexit(wm_prof_report);
+    }
+}
+
+static inline void wm_prof_enter(wm_prof_frame* f, wm_prof_entry* e){
+    if(!__atomic_load_n(&e->registered, __ATOMIC_ACQUIRE)){
+        wm_prof_register(e);
+    }
+    f->prev = wm_prof_top;
+    f->entry = e;
+    f->children = 0;
+    __atomic_add_fetch(&e->active, 1, __ATOMIC_RELAXED);
+    wm_prof_top = f;
+    f->start = wm_prof_now();
+}
+
+static inline void wm_prof_leave(wm_prof_frame* f){
+    int64_t elapsed = wm_prof_now() - f->start;
+    wm_prof_entry* e = f->entry;
+    wm_prof_top = f->prev;
+    if(f->prev != NULL){
+        f->prev->children += elapsed;
+    }
+    __atomic_add_fetch(&e->calls, 1, __ATOMIC_RELAXED);
+    __atomic_add_fetch(&e->exclusive_ns, elapsed - f->children, __ATOMIC_RELAXED);
+    if(__atomic_sub_fetch(&e->active, 1, __ATOMIC_RELAXED) == 0){
+        __atomic_add_fetch(&e->inclusive_ns, elapsed, __ATOMIC_RELAXED);
+    }
+}
+"""
+
+
+unit = CUnit(
+    "profile",
+    source=_source,
+    headers=["#include <time.h>"],
+)
+
+
+profile_report = NativeFunction("wm_prof_report", void, unit=unit)
+
+
+namespace = {
+    "profile_report": profile_report,
+}
+
+
+def read_report(file, symbols=None):
+    """
+    Return the rows of the profile report in file (a filename or a text
+    file-like object) as dicts, sorted by decreasing exclusive time. symbols
+    maps the C names to Worm names (see Program.symbol_map).
+    """
+    if isinstance(file, str):
+        with open(file) as f:
+            return read_report(f, symbols)
+
+    symbols = symbols or {}
+    rows = []
+    for line in file:
+        if not line.strip() or line.startswith("#"):
+            continue
+        symbol, calls, inclusive, exclusive = line.split()
+        rows.append(
+            {
+                "name": symbols.get(symbol, symbol),
+                "symbol": symbol,
+                "calls": int(calls),
+                "inclusive_ns": int(inclusive),
+                "exclusive_ns": int(exclusive),
+            }
+        )
+    rows.sort(key=lambda row: row["exclusive_ns"], reverse=True)
+    return rows
+
+
+def format_report(rows):
+    """
+    Return a table of the rows of read_report, names of several functions
+    being followed by their C name.
+    """
+    names = [row["name"] for row in rows]
+    total = sum(row["exclusive_ns"] for row in rows) or 1
+    lines = [
+        f"{'function':<32} {'calls':>12} {'inclusive ms':>14}"
+        f" {'exclusive ms':>14} {'excl %':>7}"
+    ]
+    for row in rows:
+        name = row["name"]
+        if names.count(name) > 1:
+            name = f"{name} ({row['symbol']})"
+        lines.append(
+            f"{name:<32} {row['calls']:>12} {row['inclusive_ns'] / 1e6:>14.3f}"
+            f" {row['exclusive_ns'] / 1e6:>14.3f}"
+            f" {100 * row['exclusive_ns'] / total:>6.1f}%"
+        )
+    return "\n".join(lines)
+
+
+def main(argv):
+    if not 1 <= len(argv) <= 2:
+        print("usage: python -m worm.std.profile report.txt [symbols.json]")
+        return 2
+    symbols = None
+    if len(argv) == 2:
+        with open(argv[1]) as f:
+            symbols = json.load(f)
+    print(format_report(read_report(argv[0], symbols)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
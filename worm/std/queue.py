@@ -0,0 +1,524 @@
+"""
+Ring buffer containers.
+
+Deque[T] and Queue[T] are growable ring buffers with a power of two capacity,
+so that wrapping an index is a mask. Deque[T] supports append, appendleft, pop,
+popleft and get; Queue[T] is the first in first out view of the same buffer
+with put and get. Popping from an empty container aborts the program.
+
+SPSCQueue[T] and MPMCQueue[T] are bounded lock-free queues on C11 atomics to
+exchange values between threads. SPSCQueue[T] allows a single producer and a
+single consumer thread, MPMCQueue[T] any number of both (Vyukov's bounded
+queue). put and get spin, then yield, until they succeed; try_put and
+try_get(q, ptr(out)) return 0 instead of waiting.
+
+The operations are generic: put(q, x) is replaced at compile time by the
+function dedicated to the type of q. Containers are created with the
+new_<int|float>_<kind> functions of the namespace, or new_deque(T),
+new_queue(T), new_spsc(T) and new_mpmc(T) for other element types, and
+released with free.
+"""
+from ..native import CUnit, NativeFunction
+from ..type_checker import check_type
+from ..wtypes import HigherOrderType, Ptr, c_identifier, to_c_type, void
+
+
+class _RingType(HigherOrderType):
+    """
+    Pointer to a runtime structure, with a predictable name so that native
+    code can refer to it.
+    """
+
+    kind = None
+    struct = None
+
+    def __init__(self, element_type):
+        super().__init__(self.kind, element_type)
+        self.element_type = element_type
+        self.suffix = c_identifier(to_c_type(element_type))
+        self.name = f"{self.kind}_{self.suffix}"
+
+    def type_to_c(self, other_to_c):
+        return f"struct wm_{self.struct}_{self.suffix}*"
+
+    def dependencies(self):
+        return [self.element_type]
+
+
+class Deque(_RingType):
+    kind = "deque"
+    struct = "deque"
+
+
+class Queue(_RingType):
+    # same structure as the deque, only the available operations differ
+    kind = "queue"
+    struct = "deque"
+
+
+class SPSCQueue(_RingType):
+    kind = "spsc"
+    struct = "spsc"
+
+
+class MPMCQueue(_RingType):
+    kind = "mpmc"
+    struct = "mpmc"
+
+
+_base_source = r"""
+#define WM_CACHE_LINE 64
+
+static int64_t wm_ring_capacity(int64_t n){
+    int64_t c = 8;
+    while(c < n){
+        c <<= 1;
+    }
+    return c;
+}
+
+static void wm_ring_empty(const char* what){
+    fprintf(stderr, "%s from an empty container\n", what);
+    abort();
+}
+
+static void* wm_ring_aligned(size_t size){
+    void* p = aligned_alloc(WM_CACHE_LINE, (size + WM_CACHE_LINE - 1) / WM_CACHE_LINE * WM_CACHE_LINE);
+    memset(p, 0, size);
+    return p;
+}
+
+static inline void wm_ring_backoff(int* spins){
+    if(++*spins < 64){
+#if defined(__x86_64__) || defined(__i386__)
+        __builtin_ia32_pause();
+#endif
+    } else {
+        sched_yield();
+    }
+}
+"""
+
+base = CUnit(
+    "queue",
+    source=_base_source,
+    headers=["#include <stdatomic.h>", "#include <sched.h>", "#include <string.h>"],
+)
+
+
+def _deque_source(t, s):
+    return f"""
+struct wm_deque_{s} {{
+    {t}* elems;
+    int64_t head;
+    int64_t length;
+    int64_t mask;
+}};
+
+struct wm_deque_{s}* wm_deque_new_{s}(int64_t capacity){{
+    struct wm_deque_{s}* d = malloc(sizeof(struct wm_deque_{s}));
+    int64_t cap = wm_ring_capacity(capacity);
+    d->elems = malloc(cap * sizeof({t}));
+    d->head = 0;
+    d->length = 0;
+    d->mask = cap - 1;
+    return d;
+}}
+
+void wm_deque_free_{s}(struct wm_deque_{s}* d){{
+    free(d->elems);
+    free(d);
+}}
+
+static void wm_deque_grow_{s}(struct wm_deque_{s}* d){{
+    int64_t cap = d->mask + 1;
+    {t}* elems = malloc(2 * cap * sizeof({t}));
+    int64_t first = cap - d->head < d->length ? cap - d->head : d->length;
+    memcpy(elems, d->elems + d->head, first * sizeof({t}));
+    memcpy(elems + first, d->elems, (d->length - first) * sizeof({t}));
+    free(d->elems);
+    d->elems = elems;
+    d->head = 0;
+    d->mask = 2 * cap - 1;
+}}
+
+void wm_deque_append_{s}(struct wm_deque_{s}* d, {t} x){{
+    if(d->length > d->mask){{
+        wm_deque_grow_{s}(d);
+    }}
+    d->elems[(d->head + d->length++) & d->mask] = x;
+}}
+
+void wm_deque_appendleft_{s}(struct wm_deque_{s}* d, {t} x){{
+    if(d->length > d->mask){{
+        wm_deque_grow_{s}(d);
+    }}
+    d->head = (d->head - 1) & d->mask;
+    d->elems[d->head] = x;
+    d->length++;
+}}
+
+{t} wm_deque_pop_{s}(struct wm_deque_{s}* d){{
+    if(d->length == 0){{
+        wm_ring_empty("pop");
+    }}
+    d->length--;
+    return d->elems[(d->head + d->length) & d->mask];
+}}
+
+{t} wm_deque_popleft_{s}(struct wm_deque_{s}* d){{
+    if(d->length == 0){{
+        wm_ring_empty("pop");
+    }}
+    {t} x = d->elems[d->head];
+    d->head = (d->head + 1) & d->mask;
+    d->length--;
+    return x;
+}}
+
+/* negative indices count from the end */
+{t} wm_deque_get_{s}(struct wm_deque_{s}* d, int64_t i){{
+    if(i < 0){{
+        i += d->length;
+    }}
+    if(i < 0 || i >= d->length){{
+        fprintf(stderr, "deque index out of range\\n");
+        abort();
+    }}
+    return d->elems[(d->head + i) & d->mask];
+}}
+
+int64_t wm_deque_length_{s}(struct wm_deque_{s}* d){{
+    return d->length;
+}}
+
+#define wm_queue_new_{s} wm_deque_new_{s}
+#define wm_queue_free_{s} wm_deque_free_{s}
+#define wm_queue_put_{s} wm_deque_append_{s}
+#define wm_queue_get_{s} wm_deque_popleft_{s}
+#define wm_queue_length_{s} wm_deque_length_{s}
+"""
+
+
+def _spsc_source(t, s):
+    return f"""
+struct wm_spsc_{s} {{
+    /* consumer side */
+    _Alignas(WM_CACHE_LINE) _Atomic int64_t head;
+    int64_t cached_tail;
+    /* producer side */
+    _Alignas(WM_CACHE_LINE) _Atomic int64_t tail;
+    int64_t cached_head;
+    _Alignas(WM_CACHE_LINE) int64_t mask;
+    {t}* elems;
+}};
+
+struct wm_spsc_{s}* wm_spsc_new_{s}(int64_t capacity){{
+    struct wm_spsc_{s}* q = wm_ring_aligned(sizeof(struct wm_spsc_{s}));
+    int64_t cap = wm_ring_capacity(capacity);
+    q->mask = cap - 1;
+    q->elems = malloc(cap * sizeof({t}));
+    return q;
+}}
+
+void wm_spsc_free_{s}(struct wm_spsc_{s}* q){{
+    free(q->elems);
+    free(q);
+}}
+
+int64_t wm_spsc_try_put_{s}(struct wm_spsc_{s}* q, {t} x){{
+    int64_t tail = atomic_load_explicit(&q->tail, memory_order_relaxed);
+    if(tail - q->cached_head > q->mask){{
+        q->cached_head = atomic_load_explicit(&q->head, memory_order_acquire);
+        if(tail - q->cached_head > q->mask){{
+            return 0;
+        }}
+    }}
+    q->elems[tail & q->mask] = x;
+    atomic_store_explicit(&q->tail, tail + 1, memory_order_release);
+    return 1;
+}}
+
+int64_t wm_spsc_try_get_{s}(struct wm_spsc_{s}* q, {t}* out){{
+    int64_t head = atomic_load_explicit(&q->head, memory_order_relaxed);
+    if(head == q->cached_tail){{
+        q->cached_tail = atomic_load_explicit(&q->tail, memory_order_acquire);
+        if(head == q->cached_tail){{
+            return 0;
+        }}
+    }}
+    *out = q->elems[head & q->mask];
+    atomic_store_explicit(&q->head, head + 1, memory_order_release);
+    return 1;
+}}
+
+void wm_spsc_put_{s}(struct wm_spsc_{s}* q, {t} x){{
+    int spins = 0;
+    while(!wm_spsc_try_put_{s}(q, x)){{
+        wm_ring_backoff(&spins);
+    }}
+}}
+
+{t} wm_spsc_get_{s}(struct wm_spsc_{s}* q){{
+    {t} x;
+    int spins = 0;
+    while(!wm_spsc_try_get_{s}(q, &x)){{
+        wm_ring_backoff(&spins);
+    }}
+    return x;
+}}
+
+/* only a snapshot when other threads are using the queue */
+int64_t wm_spsc_length_{s}(struct wm_spsc_{s}* q){{
+    return atomic_load(&q->tail) - atomic_load(&q->head);
+}}
+"""
+
+
+def _mpmc_source(t, s):
+    return f"""
+struct wm_mpmc_cell_{s} {{
+    _Atomic int64_t sequence;
+    {t} value;
+}};
+
+struct wm_mpmc_{s} {{
+    _Alignas(WM_CACHE_LINE) _Atomic int64_t enqueue_pos;
+    _Alignas(WM_CACHE_LINE) _Atomic int64_t dequeue_pos;
+    _Alignas(WM_CACHE_LINE) int64_t mask;
+    struct wm_mpmc_cell_{s}* cells;
+}};
+
+struct wm_mpmc_{s}* wm_mpmc_new_{s}(int64_t capacity){{
+    struct wm_mpmc_{s}* q = wm_ring_aligned(sizeof(struct wm_mpmc_{s}));
+    int64_t cap = wm_ring_capacity(capacity);
+    q->mask = cap - 1;
+    q->cells = wm_ring_aligned(cap * sizeof(struct wm_mpmc_cell_{s}));
+    for(int64_t i = 0; i < cap; i++){{
+        atomic_init(&q->cells[i].sequence, i);
+    }}
+    return q;
+}}
+
+void wm_mpmc_free_{s}(struct wm_mpmc_{s}* q){{
+    free(q->cells);
+    free(q);
+}}
+
+int64_t wm_mpmc_try_put_{s}(struct wm_mpmc_{s}* q, {t} x){{
+    struct wm_mpmc_cell_{s}* cell;
+    int64_t pos = atomic_load_explicit(&q->enqueue_pos, memory_order_relaxed);
+    for(;;){{
+        cell = &q->cells[pos & q->mask];
+        int64_t seq = atomic_load_explicit(&cell->sequence, memory_order_acquire);
+        int64_t diff = seq - pos;
+        if(diff == 0){{
+            if(atomic_compare_exchange_weak_explicit(
+                &q->enqueue_pos, &pos, pos + 1, memory_order_relaxed, memory_order_relaxed
+            )){{
+                break;
+            }}
+        }} else if(diff < 0){{
+            return 0;
+        }} else {{
+            pos = atomic_load_explicit(&q->enqueue_pos, memory_order_relaxed);
+        }}
+    }}
+    cell->value = x;
+    atomic_store_explicit(&cell->sequence, pos + 1, memory_order_release);
+    return 1;
+}}
+
+int64_t wm_mpmc_try_get_{s}(struct wm_mpmc_{s}* q, {t}* out){{
+    struct wm_mpmc_cell_{s}* cell;
+    int64_t pos = atomic_load_explicit(&q->dequeue_pos, memory_order_relaxed);
+    for(;;){{
+        cell = &q->cells[pos & q->mask];
+        int64_t seq = atomic_load_explicit(&cell->sequence, memory_order_acquire);
+        int64_t diff = seq - (pos + 1);
+        if(diff == 0){{
+            if(atomic_compare_exchange_weak_explicit(
+                &q->dequeue_pos, &pos, pos + 1, memory_order_relaxed, memory_order_relaxed
+            )){{
+                break;
+            }}
+        }} else if(diff < 0){{
+            return 0;
+        }} else {{
+            pos = atomic_load_explicit(&q->dequeue_pos, memory_order_relaxed);
+        }}
+    }}
+    *out = cell->value;
+    atomic_store_explicit(&cell->sequence, pos + q->mask + 1, memory_order_release);
+    return 1;
+}}
+
+void wm_mpmc_put_{s}(struct wm_mpmc_{s}* q, {t} x){{
+    int spins = 0;
+    while(!wm_mpmc_try_put_{s}(q, x)){{
+        wm_ring_backoff(&spins);
+    }}
+}}
+
+{t} wm_mpmc_get_{s}(struct wm_mpmc_{s}* q){{
+    {t} x;
+    int spins = 0;
+    while(!wm_mpmc_try_get_{s}(q, &x)){{
+        wm_ring_backoff(&spins);
+    }}
+    return x;
+}}
+
+/* only a snapshot when other threads are using the queue */
+int64_t wm_mpmc_length_{s}(struct wm_mpmc_{s}* q){{
+    return atomic_load(&q->enqueue_pos) - atomic_load(&q->dequeue_pos);
+}}
+"""
+
+
+_units = {}
+
+
+def _unit(struct, element_type):
+    key = (struct, element_type)
+    if key not in _units:
+        t = to_c_type(element_type)
+        s = c_identifier(t)
+        source = {"deque": _deque_source, "spsc": _spsc_source, "mpmc": _mpmc_source}
+        _units[key] = CUnit(
+            f"{struct}_{s}",
+            source=source[struct](t, s),
+            types=[element_type],
+            requires=[base],
+        )
+    return _units[key]
+
+
+# operation name -> (returned type, other argument types), in which "C" stands
+# for the container, "T" for the element type and "P" for a pointer to it
+_operations = {
+    Deque: {
+        "new": ("C", int),
+        "free": (void,),
+        "append": (void, "T"),
+        "appendleft": (void, "T"),
+        "pop": ("T",),
+        "popleft": ("T",),
+        "get": ("T", int),
+        "length": (int,),
+    },
+    Queue: {
+        "new": ("C", int),
+        "free": (void,),
+        "put": (void, "T"),
+        "get": ("T",),
+        "length": (int,),
+    },
+}
+_operations[SPSCQueue] = _operations[MPMCQueue] = {
+    "new": ("C", int),
+    "free": (void,),
+    "put": (void, "T"),
+    "get": ("T",),
+    "try_put": (int, "T"),
+    "try_get": (int, "P"),
+    "length": (int,),
+}
+
+_natives = {}
+
+
+def container_native(container, operation):
+    """
+    Native function implementing operation for the container type.
+    """
+    key = (container, operation)
+    if key not in _natives:
+        kind = type(container)
+        returns, *args = _operations[kind][operation]
+        element = container.element_type
+
+        def resolve(t):
+            return {"T": element, "P": Ptr(element), "C": container}.get(t, t)
+
+        unit = _unit(container.struct, element)
+        if container not in unit.types:
+            unit.types.append(container)
+        params = [] if operation == "new" else [container]
+        _natives[key] = NativeFunction(
+            f"wm_{container.kind}_{operation}_{container.suffix}",
+            resolve(returns),
+            *params,
+            *map(resolve, args),
+            unit=unit,
+        )
+    return _natives[key]
+
+
+def new_deque(element_type):
+    return container_native(Deque[element_type], "new")
+
+
+def new_queue(element_type):
+    return container_native(Queue[element_type], "new")
+
+
+def new_spsc(element_type):
+    return container_native(SPSCQueue[element_type], "new")
+
+
+def new_mpmc(element_type):
+    return container_native(MPMCQueue[element_type], "new")
+
+
+class ContainerOperation(NativeFunction):
+    """
+    Generic operation, replaced by the native dedicated to the type of its
+    first argument.
+    """
+
+    def __init__(self, operation):
+        super().__init__(f"wm_ring_{operation}", void)
+        self.operation = operation
+
+    def native_for(self, container):
+        container = container.type.deref()
+        if (
+            isinstance(container, _RingType)
+            and self.operation in _operations[type(container)]
+        ):
+            return container_native(container, self.operation)
+        return None
+
+    def check_args(self, *args):
+        native = self.native_for(args[0]) if args else None
+        return (
+            native is not None
+            and len(native.args) == len(args)
+            and all(check_type(ref, arg) for ref, arg in zip(native.args, args))
+        )
+
+    def specialize(self, *args):
+        return self.native_for(args[0]), list(args)
+
+
+namespace = {
+    "Deque": Deque,
+    "Queue": Queue,
+    "SPSCQueue": SPSCQueue,
+    "MPMCQueue": MPMCQueue,
+    **{
+        op: ContainerOperation(op)
+        for op in sorted({op for ops in _operations.values() for op in ops} - {"new"})
+    },
+    **{
+        f"new_{t.__name__}_{kind}": new(t)
+        for t in (int, float)
+        for kind, new in [
+            ("deque", new_deque),
+            ("queue", new_queue),
+            ("spsc", new_spsc),
+            ("mpmc", new_mpmc),
+        ]
+    },
+}
@@ -0,0 +1,693 @@
+"""
+Regular expressions compiled to DFA at compile time.
+
+search, match and fullmatch have the semantic of their Python re counterparts
+but only tell whether the string matches (1 or 0). When the pattern is a
+literal, it is compiled by Python into a minimised DFA and the call is replaced
+by a table driven C matcher dedicated to that pattern: no regex is interpreted
+at runtime and the matching time is linear in the length of the string.
+
+Supported syntax: literals, ., [...] and [^...] classes with ranges, the \\d \\w
+\\s \\D \\W \\S escapes, groups (capturing or not, captures are ignored), |, *, +,
+?, {m}, {m,}, {m,n} and lazy variants, ^, $, \\A and \\Z. Patterns work on bytes:
+. matches any byte but a newline and $ only matches at the end of the string.
+
+Patterns only known at runtime go through a small backtracking engine that
+supports literals, ., classes, escapes, the *, + and ? quantifiers applied to
+a single atom, ^ and $.
+"""
+from hashlib import sha1
+
+from ..errors import WormSyntaxError
+from ..native import CUnit, NativeFunction
+from ..wast import WConstant
+
+
+class PatternError(WormSyntaxError):
+    pass
+
+
+_MAX_REPEAT = 1000
+
+# The automata read the start and the end of the string as two extra symbols.
+# Anchors are transitions on those symbols, but reading them does not consume
+# anything: every state survives it, so anchors are zero width.
+BOS = 256
+EOS = 257
+
+_ANY = frozenset(range(256))
+_DIGIT = frozenset(range(ord("0"), ord("9") + 1))
+_WORD = (
+    _DIGIT
+    | frozenset(range(ord("a"), ord("z") + 1))
+    | frozenset(range(ord("A"), ord("Z") + 1))
+    | {ord("_")}
+)
+_SPACE = frozenset(b" \t\n\r\f\v")
+
+_class_escapes = {
+    "d": _DIGIT,
+    "D": _ANY - _DIGIT,
+    "w": _WORD,
+    "W": _ANY - _WORD,
+    "s": _SPACE,
+    "S": _ANY - _SPACE,
+}
+
+_char_escapes = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "0": "\0"}
+
+_anchor_escapes = {"A": frozenset([BOS]), "Z": frozenset([EOS])}
+
+
+class _Parser:
+    """
+    Recursive descent parser producing a tree of tuples:
+    ("set", bytes), ("cat", nodes), ("alt", nodes), ("rep", node, min, max)
+    with max None for no upper bound.
+    """
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.pos = 0
+
+    def error(self, msg):
+        return PatternError(f"{msg} at position {self.pos} in {self.pattern!r}.")
+
+    def peek(self):
+        if self.pos < len(self.pattern):
+            return self.pattern[self.pos]
+        return None
+
+    def take(self):
+        c = self.peek()
+        if c is None:
+            raise self.error("Unexpected end of pattern")
+        self.pos += 1
+        return c
+
+    def parse(self):
+        node = self.parse_alt()
+        if self.peek() is not None:
+            raise self.error(f"Unexpected {self.peek()!r}")
+        return node
+
+    def parse_alt(self):
+        branches = [self.parse_cat()]
+        while self.peek() == "|":
+            self.pos += 1
+            branches.append(self.parse_cat())
+        return branches[0] if len(branches) == 1 else ("alt", branches)
+
+    def parse_cat(self):
+        items = []
+        while self.peek() not in (None, "|", ")"):
+            items.append(self.parse_repeat())
+        return ("cat", items)
+
+    def parse_repeat(self):
+        node = self.parse_atom()
+        while self.peek() in ("*", "+", "?", "{"):
+            c = self.take()
+            if c == "*":
+                node = ("rep", node, 0, None)
+            elif c == "+":
+                node = ("rep", node, 1, None)
+            elif c == "?":
+                node = ("rep", node, 0, 1)
+            else:
+                low, high = self.parse_count()
+                node = ("rep", node, low, high)
+            # lazy quantifiers accept the same strings
+            if self.peek() == "?":
+                self.pos += 1
+        return node
+
+    def parse_count(self):
+        start = self.pos
+        end = self.pattern.find("}", start)
+        if end < 0:
+            raise self.error("Unterminated {")
+        low, sep, high = self.pattern[start:end].partition(",")
+        try:
+            low = int(low)
+            high = int(high) if high else (None if sep else low)
+        except ValueError:
+            raise self.error("Invalid repetition count") from None
+        if max(low, high or 0) > _MAX_REPEAT or (high is not None and high < low):
+            raise self.error("Invalid repetition count")
+        self.pos = end + 1
+        return low, high
+
+    def parse_atom(self):
+        c = self.take()
+        if c == "(":
+            if self.pattern.startswith("?:", self.pos):
+                self.pos += 2
+            node = self.parse_alt()
+            if self.peek() != ")":
+                raise self.error("Missing )")
+            self.pos += 1
+            return node
+        elif c == "[":
+            return ("set", self.parse_class())
+        elif c == ".":
+            return ("set", _ANY - {ord("\n")})
+        elif c == "^":
+            return ("set", frozenset([BOS]))
+        elif c == "$":
+            return ("set", frozenset([EOS]))
+        elif c == "\\":
+            if self.peek() in _anchor_escapes:
+                return ("set", _anchor_escapes[self.take()])
+            escaped = self.parse_escape()
+            if isinstance(escaped, frozenset):
+                return ("set", escaped)
+            return self.literal(escaped)
+        elif c in "*+?{":
+            raise self.error(f"Nothing to repeat with {c!r}")
+        elif c == ")":
+            raise self.error("Unbalanced )")
+        else:
+            return self.literal(c)
+
+    def literal(self, c):
+        return ("cat", [("set", frozenset([b])) for b in c.encode("utf-8")])
+
+    def parse_escape(self):
+        """
+        Return a set of bytes for class escapes, a character otherwise.
+        """
+        c = self.take()
+        if c in _class_escapes:
+            return _class_escapes[c]
+        elif c in _char_escapes:
+            return _char_escapes[c]
+        elif c == "x":
+            digits = self.pattern[self.pos : self.pos + 2]
+            self.pos += 2
+            try:
+                return chr(int(digits, 16))
+            except ValueError:
+                raise self.error("Invalid \\x escape") from None
+        elif c.isalnum():
+            raise self.error(f"Unsupported escape \\{c}")
+        else:
+            return c
+
+    def parse_class(self):
+        negate = self.peek() == "^"
+        if negate:
+            self.pos += 1
+        members = set()
+        first = True
+        while first or self.peek() != "]":
+            first = False
+            low = self.class_char()
+            if isinstance(low, frozenset):
+                members |= low
+                continue
+            if (
+                self.peek() == "-"
+                and self.pos + 1 < len(self.pattern)
+                and self.pattern[self.pos + 1] != "]"
+            ):
+                self.pos += 1
+                high = self.class_char()
+                if isinstance(high, frozenset) or high < low:
+                    raise self.error("Invalid class range")
+            else:
+                high = low
+            members.update(range(low, high + 1))
+        self.pos += 1
+        return _ANY - members if negate else frozenset(members)
+
+    def class_char(self):
+        c = self.take()
+        if c == "\\":
+            c = self.parse_escape()
+            if isinstance(c, frozenset):
+                return c
+        if ord(c) > 127:
+            raise self.error("Only ASCII characters are supported in classes")
+        return ord(c)
+
+
+class _NFA:
+    """
+    Thompson automaton, moves are (set of byte classes, target) pairs.
+    """
+
+    def __init__(self):
+        self.eps = []
+        self.moves = []
+
+    def state(self):
+        self.eps.append([])
+        self.moves.append([])
+        return len(self.eps) - 1
+
+    def build(self, node, classes):
+        kind = node[0]
+        if kind == "set":
+            s, e = self.state(), self.state()
+            self.moves[s].append((classes[node[1]], e))
+            return s, e
+        elif kind == "cat":
+            s = e = self.state()
+            for item in node[1]:
+                a, b = self.build(item, classes)
+                self.eps[e].append(a)
+                e = b
+            return s, e
+        elif kind == "alt":
+            s, e = self.state(), self.state()
+            for branch in node[1]:
+                a, b = self.build(branch, classes)
+                self.eps[s].append(a)
+                self.eps[b].append(e)
+            return s, e
+        else:
+            _, inner, low, high = node
+            s = e = self.state()
+            for _ in range(low):
+                a, b = self.build(inner, classes)
+                self.eps[e].append(a)
+                e = b
+            if high is None:
+                a, b = self.build(inner, classes)
+                end = self.state()
+                self.eps[e] += [a, end]
+                self.eps[b] += [a, end]
+                return s, end
+            end = self.state()
+            for _ in range(high - low):
+                self.eps[e].append(end)
+                a, b = self.build(inner, classes)
+                self.eps[e].append(a)
+                e = b
+            self.eps[e].append(end)
+            return s, end
+
+    def closure(self, states):
+        stack = list(states)
+        seen = set(states)
+        while stack:
+            for t in self.eps[stack.pop()]:
+                if t not in seen:
+                    seen.add(t)
+                    stack.append(t)
+        return frozenset(seen)
+
+
+def _byte_sets(node):
+    if node[0] == "set":
+        yield node[1]
+    elif node[0] in ("cat", "alt"):
+        for item in node[1]:
+            yield from _byte_sets(item)
+    else:
+        yield from _byte_sets(node[1])
+
+
+def byte_classes(tree):
+    """
+    Partition the bytes (and BOS and EOS) in classes that no byte set of the
+    tree separates. Return the class of each symbol, the number of classes and
+    the mapping from each byte set to the set of its classes.
+    """
+    sets = set(_byte_sets(tree))
+    # BOS and EOS always get a class of their own
+    signature = [
+        (b if b >= BOS else None, *(b in s for s in sets)) for b in range(EOS + 1)
+    ]
+    ids = {}
+    class_of = [ids.setdefault(sig, len(ids)) for sig in signature]
+    return class_of, len(ids), {
+        s: frozenset(class_of[b] for b in s) for s in sets
+    }
+
+
+class DFA:
+    """
+    Minimised automaton over symbol classes, run on BOS, the bytes of the
+    string then EOS. State 0 is the initial state, accept is the only accepting
+    state and it is absorbing: the matcher can stop as soon as it is reached.
+    dead is the state from which nothing can be accepted. Both are None when
+    they do not exist.
+    """
+
+    def __init__(self, class_of, transitions, accepting):
+        self.class_of = class_of
+        self.transitions = transitions
+        self.accept = accepting.index(True) if True in accepting else None
+        self.dead = next(
+            (
+                s
+                for s, row in enumerate(transitions)
+                if s != self.accept and all(t == s for t in row)
+            ),
+            None,
+        )
+
+    def __len__(self):
+        return len(self.transitions)
+
+    def step(self, state, symbol):
+        return self.transitions[state][self.class_of[symbol]]
+
+    def matches(self, data):
+        """
+        Run the automaton in Python on bytes.
+        """
+        state = self.step(0, BOS)
+        for b in data:
+            if state == self.accept:
+                return True
+            state = self.step(state, b)
+        return self.step(state, EOS) == self.accept
+
+
+def compile_pattern(pattern, mode="search"):
+    """
+    Compile pattern into a DFA, mode is one of "search", "match" or
+    "fullmatch".
+    """
+    tree = _Parser(pattern).parse()
+    if mode == "fullmatch":
+        tree = ("cat", [tree, ("set", frozenset([EOS]))])
+
+    class_of, nclasses, classes = byte_classes(tree)
+    nfa = _NFA()
+    start, final = nfa.build(tree, classes)
+    start_set = nfa.closure([start])
+    anchors = {class_of[BOS], class_of[EOS]}
+
+    def step(current, c):
+        moved = {t for s in current for cs, t in nfa.moves[s] if c in cs}
+        if c in anchors:
+            # zero width: keep the current states and follow consecutive anchors
+            target = frozenset(current)
+            while not nfa.closure(moved) <= target:
+                target = target | nfa.closure(moved)
+                moved = {t for s in target for cs, t in nfa.moves[s] if c in cs}
+            return target
+        target = nfa.closure(moved)
+        if mode == "search":
+            # a match can start anywhere
+            target = target | start_set
+        return target
+
+    # subset construction, all the sets containing the final state are merged
+    # in one absorbing state
+    ACCEPT = "accept"
+    order = [ACCEPT if final in start_set else start_set]
+    states = {order[0]: 0}
+    transitions = []
+    i = 0
+    while i < len(order):
+        current = order[i]
+        i += 1
+        row = []
+        for c in range(nclasses):
+            if current is ACCEPT:
+                target = ACCEPT
+            else:
+                target = step(current, c)
+                if final in target:
+                    target = ACCEPT
+            if target not in states:
+                states[target] = len(order)
+                order.append(target)
+            row.append(states[target])
+        transitions.append(row)
+
+    accepting = [s is ACCEPT for s in order]
+    return DFA(class_of, *minimise(transitions, accepting))
+
+
+def minimise(transitions, accepting):
+    """
+    Merge equivalent states (Moore's algorithm), return the new transitions
+    and accepting flags. States are renumbered in breadth first order from 0.
+    """
+    block = [int(a) for a in accepting]
+    while True:
+        signatures = {}
+        new_block = [
+            signatures.setdefault(
+                (block[s], tuple(block[t] for t in row)), len(signatures)
+            )
+            for s, row in enumerate(transitions)
+        ]
+        stable = len(signatures) == len(set(block))
+        block = new_block
+        if stable:
+            break
+
+    number = {block[0]: 0}
+    representative = [0]
+    i = 0
+    while i < len(representative):
+        for t in transitions[representative[i]]:
+            if block[t] not in number:
+                number[block[t]] = len(representative)
+                representative.append(t)
+        i += 1
+
+    return (
+        [[number[block[t]] for t in transitions[r]] for r in representative],
+        [accepting[r] for r in representative],
+    )
+
+
+def dfa_to_c(name, dfa, comment=""):
+    """
+    Return the C definition of a function int64_t name(const char*) running
+    dfa on a zero terminated string.
+    """
+    n = len(dfa)
+    state_t = "uint8_t" if n <= 256 else "uint16_t" if n <= 65536 else "uint32_t"
+    nclasses = len(dfa.transitions[0])
+    bos, eos = dfa.class_of[BOS], dfa.class_of[EOS]
+
+    classes = dfa.class_of[:256]
+    code = [
+        f"/* {comment} */" if comment else "",
+        f"static const uint8_t {name}_class[256] = {{",
+        ",\n".join(
+            "    " + ", ".join(map(str, classes[i : i + 16])) for i in range(0, 256, 16)
+        ),
+        "};",
+        f"static const {state_t} {name}_next[{n}][{nclasses}] = {{",
+        ",\n".join("    {" + ", ".join(map(str, row)) + "}" for row in dfa.transitions),
+        "};",
+        f"int64_t {name}(const char* s){{",
+    ]
+    if dfa.accept is None:
+        code += ["    (void)s;", "    return 0;", "}"]
+        return "\n".join(code)
+
+    code += [
+        "    const unsigned char* p = (const unsigned char*)s;",
+        f"    unsigned state = {name}_next[0][{bos}];",
+        "    while(*p){",
+        f"        if(state == {dfa.accept}) return 1;",
+    ]
+    if dfa.dead is not None:
+        code.append(f"        if(state == {dfa.dead}) return 0;")
+    code += [
+        f"        state = {name}_next[state][{name}_class[*p++]];",
+        "    }",
+        f"    return {name}_next[state][{eos}] == {dfa.accept};",
+        "}",
+    ]
+    return "\n".join(code)
+
+
+_runtime_source = r"""
+static int wm_re_atom_len(const char* re){
+    if(*re == '\\'){
+        return re[1] ? 2 : 1;
+    }
+    if(*re == '['){
+        const char* p = re + 1;
+        if(*p == '^') p++;
+        if(*p == ']') p++;
+        while(*p && *p != ']'){
+            if(*p == '\\' && p[1]) p++;
+            p++;
+        }
+        return (int)(p - re) + (*p == ']');
+    }
+    return 1;
+}
+
+/* -1 if e is not a class escape, else whether c is in the class */
+static int wm_re_class_escape(char e, unsigned char c){
+    switch(e){
+        case 'd': return isdigit(c) != 0;
+        case 'D': return isdigit(c) == 0;
+        case 'w': return isalnum(c) || c == '_';
+        case 'W': return !(isalnum(c) || c == '_');
+        case 's': return isspace(c) != 0;
+        case 'S': return isspace(c) == 0;
+        default: return -1;
+    }
+}
+
+static unsigned char wm_re_escape_char(char e){
+    switch(e){
+        case 'n': return '\n';
+        case 't': return '\t';
+        case 'r': return '\r';
+        case 'f': return '\f';
+        case 'v': return '\v';
+        default: return (unsigned char)e;
+    }
+}
+
+static int wm_re_atom_matches(const char* re, int len, unsigned char c){
+    if(*re == '.'){
+        return c != '\n';
+    }
+    if(*re == '\\'){
+        int m = wm_re_class_escape(re[1], c);
+        return m >= 0 ? m : c == wm_re_escape_char(re[1]);
+    }
+    if(*re == '['){
+        const char* p = re + 1;
+        const char* end = re + len - 1;
+        int negate = *p == '^';
+        int found = 0;
+        p += negate;
+        while(p < end){
+            unsigned char lo, hi;
+            if(*p == '\\'){
+                int m = wm_re_class_escape(p[1], c);
+                if(m >= 0){
+                    found |= m;
+                    p += 2;
+                    continue;
+                }
+                lo = wm_re_escape_char(p[1]);
+                p += 2;
+            } else {
+                lo = (unsigned char)*p++;
+            }
+            hi = lo;
+            if(*p == '-' && p + 1 < end){
+                p++;
+                if(*p == '\\'){
+                    hi = wm_re_escape_char(p[1]);
+                    p += 2;
+                } else {
+                    hi = (unsigned char)*p++;
+                }
+            }
+            found |= lo <= c && c <= hi;
+        }
+        return found != negate;
+    }
+    return c == (unsigned char)*re;
+}
+
+static int wm_re_here(const char* re, const char* s, int full){
+    for(;;){
+        if(*re == 0){
+            return !full || *s == 0;
+        }
+        if(re[0] == '$' && re[1] == 0){
+            return *s == 0;
+        }
+        int len = wm_re_atom_len(re);
+        char q = re[len];
+        if(q == '*' || q == '+' || q == '?'){
+            int min = q == '+';
+            int max = q == '?' ? 1 : -1;
+            int n = 0;
+            const char* t = s;
+            while(*t && (max < 0 || n < max) && wm_re_atom_matches(re, len, *t)){
+                t++;
+                n++;
+            }
+            /* greedy, give back one character at a time */
+            for(; n >= min; n--, t--){
+                if(wm_re_here(re + len + 1, t, full)){
+                    return 1;
+                }
+            }
+            return 0;
+        }
+        if(*s == 0 || !wm_re_atom_matches(re, len, *s)){
+            return 0;
+        }
+        re += len;
+        s++;
+    }
+}
+
+int64_t wm_re_search(const char* re, const char* s){
+    if(*re == '^'){
+        return wm_re_here(re + 1, s, 0);
+    }
+    do {
+        if(wm_re_here(re, s, 0)){
+            return 1;
+        }
+    } while(*s++);
+    return 0;
+}
+
+int64_t wm_re_match(const char* re, const char* s){
+    return wm_re_here(re + (*re == '^'), s, 0);
+}
+
+int64_t wm_re_fullmatch(const char* re, const char* s){
+    return wm_re_here(re + (*re == '^'), s, 1);
+}
+"""
+
+
+runtime = CUnit(
+    "regex_runtime", source=_runtime_source, headers=["#include <ctype.h>"]
+)
+
+
+class RegexFunction(NativeFunction):
+    """
+    Calls with a literal pattern are replaced by a call to a matcher generated
+    for that pattern, other calls go to the runtime engine.
+    """
+
+    def __init__(self, mode):
+        super().__init__(f"wm_re_{mode}", int, str, str, unit=runtime)
+        self.mode = mode
+        self._cache = {}
+
+    def specialize(self, pattern, subject):
+        if not (isinstance(pattern, WConstant) and isinstance(pattern.value, str)):
+            return self, [pattern, subject]
+
+        if pattern.value not in self._cache:
+            dfa = compile_pattern(pattern.value, self.mode)
+            key = f"{self.mode}:{pattern.value}".encode("utf-8")
+            name = "wm_re_" + sha1(key).hexdigest()[:12]
+            comment = f"{self.mode} {pattern.value!r}, {len(dfa)} states".replace(
+                "*/", "*\\/"
+            )
+            unit = CUnit(name, source=dfa_to_c(name, dfa, comment))
+            self._cache[pattern.value] = NativeFunction(name, int, str, unit=unit)
+
+        return self._cache[pattern.value], [subject]
+
+
+search = RegexFunction("search")
+match = RegexFunction("match")
+fullmatch = RegexFunction("fullmatch")
+
+
+namespace = {
+    "search": search,
+    "match": match,
+    "fullmatch": fullmatch,
+}
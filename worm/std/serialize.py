@@ -0,0 +1,932 @@
+"""
+JSON and MessagePack serialisation of Struct values.
+
+The functions are generated at compile time for each Struct type: the field
+names are turned into constant byte strings for the writers and into nested
+switch statements for the readers (see argparse.dispatch_names), so no field
+table is looked up at run time. Fields may be int, float, str or nested
+Structs.
+
+Writers append to a Buffer, a growable byte buffer. Readers parse the whole
+content of a Buffer in a single pass, in place: strings are unescaped inside
+the buffer and NUL terminated there, so the str fields of the result point
+into the buffer, which must outlive them (and not be cleared). For
+MessagePack the byte following a string is saved by the scanner before being
+overwritten by the terminator. Keys that are not fields of the struct are
+skipped, fields missing from the input keep their previous value. Readers
+return 1 on success and 0 on malformed input or type mismatch.
+
+    buf: Buffer = buffer_new()
+    to_json(buf, record)
+    ok: int = from_json(buf, ptr(copy))
+
+JSON floats are written with the shortest of %.15g, %.16g and %.17g that
+reads back to the same value, non finite floats and NULL strings as null.
+"""
+from ..errors import WormTypeError
+from ..native import CUnit, NativeFunction, c_string
+from ..type_checker import check_type
+from ..wtypes import SimpleType, Struct, Ptr, void
+from .argparse import dispatch_names
+
+
+Buffer = SimpleType("wm_buf*")
+
+
+_source = r"""
+typedef struct wm_buf {
+    char* data;
+    size_t len, cap;
+} wm_buf;
+
+wm_buf* wm_buf_new(void){
+    wm_buf* b = malloc(sizeof(wm_buf));
+    b->cap = 256;
+    b->len = 0;
+    /* one more byte for the terminator added by readers and wm_buf_str */
+    b->data = malloc(b->cap + 1);
+    b->data[0] = 0;
+    return b;
+}
+
+void wm_buf_free(wm_buf* b){
+    free(b->data);
+    free(b);
+}
+
+void wm_buf_clear(wm_buf* b){
+    b->len = 0;
+    b->data[0] = 0;
+}
+
+static inline char* wm_buf_reserve(wm_buf* b, size_t n){
+    if(b->len + n > b->cap){
+        size_t cap = 2 * b->cap;
+        while(cap < b->len + n){
+            cap *= 2;
+        }
+        b->data = realloc(b->data, cap + 1);
+        b->cap = cap;
+    }
+    return b->data + b->len;
+}
+
+static inline void wm_buf_put(wm_buf* b, const void* data, size_t n){
+    memcpy(wm_buf_reserve(b, n), data, n);
+    b->len += n;
+}
+
+static inline void wm_buf_byte(wm_buf* b, unsigned char c){
+    *wm_buf_reserve(b, 1) = c;
+    b->len++;
+}
+
+void wm_buf_append(wm_buf* b, const char* s){
+    wm_buf_put(b, s, strlen(s));
+}
+
+int64_t wm_buf_length(wm_buf* b){
+    return b->len;
+}
+
+char* wm_buf_str(wm_buf* b){
+    b->data[b->len] = 0;
+    return b->data;
+}
+
+void wm_buf_print(wm_buf* b){
+    fwrite(b->data, 1, b->len, stdout);
+}
+
+/* JSON writers */
+
+static inline void wm_json_write_int(wm_buf* b, int64_t x){
+    char tmp[20];
+    char* end = tmp + sizeof(tmp);
+    char* p = end;
+    uint64_t u = x < 0 ? -(uint64_t)x : (uint64_t)x;
+    do {
+        *--p = '0' + u % 10;
+        u /= 10;
+    } while(u);
+    if(x < 0){
+        wm_buf_byte(b, '-');
+    }
+    wm_buf_put(b, p, end - p);
+}
+
+static inline void wm_json_write_float(wm_buf* b, double x){
+    if(x != x || x - x != 0){
+        wm_buf_put(b, "null", 4);
+        return;
+    }
+    char* out = wm_buf_reserve(b, 32);
+    int n = 0;
+    for(int prec = 15; prec <= 17; prec++){
+        n = snprintf(out, 32, "%.*g", prec, x);
+        if(strtod(out, NULL) == x){
+            break;
+        }
+    }
+    /* keep a float a float when read back */
+    if(!strpbrk(out, ".eE")){
+        out[n++] = '.';
+        out[n++] = '0';
+    }
+    b->len += n;
+}
+
+static const char wm_json_hex[] = "0123456789abcdef";
+
+static inline void wm_json_write_str(wm_buf* b, const char* s){
+    if(s == NULL){
+        wm_buf_put(b, "null", 4);
+        return;
+    }
+    wm_buf_byte(b, '"');
+    const char* run = s;
+    for(const unsigned char* p = (const unsigned char*)s; *p; p++){
+        if(*p >= 0x20 && *p != '"' && *p != '\\'){
+            continue;
+        }
+        wm_buf_put(b, run, (const char*)p - run);
+        run = (const char*)p + 1;
+        char esc[6] = {'\\', 0, '0', '0', 0, 0};
+        switch(*p){
+        case '"': esc[1] = '"'; break;
+        case '\\': esc[1] = '\\'; break;
+        case '\n': esc[1] = 'n'; break;
+        case '\t': esc[1] = 't'; break;
+        case '\r': esc[1] = 'r'; break;
+        case '\b': esc[1] = 'b'; break;
+        case '\f': esc[1] = 'f'; break;
+        default:
+            esc[1] = 'u';
+            esc[4] = wm_json_hex[*p >> 4];
+            esc[5] = wm_json_hex[*p & 15];
+            wm_buf_put(b, esc, 6);
+            continue;
+        }
+        wm_buf_put(b, esc, 2);
+    }
+    wm_buf_put(b, run, strlen(run));
+    wm_buf_byte(b, '"');
+}
+
+/* JSON scanner, works in place on a NUL terminated buffer */
+
+typedef struct wm_json {
+    char* p;
+} wm_json;
+
+static inline char wm_json_ws(wm_json* j){
+    while(*j->p == ' ' || *j->p == '\n' || *j->p == '\t' || *j->p == '\r'){
+        j->p++;
+    }
+    return *j->p;
+}
+
+static inline int wm_json_expect(wm_json* j, char c){
+    if(wm_json_ws(j) != c){
+        return 0;
+    }
+    j->p++;
+    return 1;
+}
+
+static inline int wm_json_literal(wm_json* j, const char* word, size_t n){
+    if(strncmp(j->p, word, n) != 0){
+        return 0;
+    }
+    j->p += n;
+    return 1;
+}
+
+static int wm_json_read_int(wm_json* j, int64_t* out){
+    char* p = j->p;
+    int neg = 0;
+    uint64_t u = 0;
+    wm_json_ws(j);
+    p = j->p;
+    if(*p == '-'){
+        neg = 1;
+        p++;
+    }
+    if(*p < '0' || *p > '9'){
+        return 0;
+    }
+    while(*p >= '0' && *p <= '9'){
+        uint64_t next = u * 10 + (*p - '0');
+        if(next / 10 != u || next > (uint64_t)INT64_MAX + neg){
+            return 0;
+        }
+        u = next;
+        p++;
+    }
+    if(*p == '.' || *p == 'e' || *p == 'E'){
+        return 0;
+    }
+    *out = neg ? (int64_t)-u : (int64_t)u;
+    j->p = p;
+    return 1;
+}
+
+static int wm_json_read_float(wm_json* j, double* out){
+    char* end;
+    char c = wm_json_ws(j);
+    if(c == 'n'){
+        if(!wm_json_literal(j, "null", 4)){
+            return 0;
+        }
+        *out = 0.0 / 0.0;
+        return 1;
+    }
+    if(c != '-' && (c < '0' || c > '9')){
+        return 0;
+    }
+    *out = strtod(j->p, &end);
+    if(end == j->p){
+        return 0;
+    }
+    j->p = end;
+    return 1;
+}
+
+static inline int wm_json_hex4(const char* p, unsigned* out){
+    unsigned v = 0;
+    for(int i = 0; i < 4; i++){
+        char c = p[i];
+        v <<= 4;
+        if(c >= '0' && c <= '9') v |= c - '0';
+        else if(c >= 'a' && c <= 'f') v |= c - 'a' + 10;
+        else if(c >= 'A' && c <= 'F') v |= c - 'A' + 10;
+        else return 0;
+    }
+    *out = v;
+    return 1;
+}
+
+/* Unescape the string starting after the opening quote in place, store its
+   start and length, NUL terminate it and move after the closing quote. */
+static int wm_json_scan_str(wm_json* j, char** out, size_t* len){
+    char* p = j->p;
+    char* start = p;
+    while(*p != '"' && *p != '\\'){
+        if(*p == 0){
+            return 0;
+        }
+        p++;
+    }
+    char* w = p;
+    while(*p != '"'){
+        if(*p == 0){
+            return 0;
+        } else if(*p != '\\'){
+            *w++ = *p++;
+            continue;
+        }
+        p++;
+        switch(*p++){
+        case '"': *w++ = '"'; break;
+        case '\\': *w++ = '\\'; break;
+        case '/': *w++ = '/'; break;
+        case 'b': *w++ = '\b'; break;
+        case 'f': *w++ = '\f'; break;
+        case 'n': *w++ = '\n'; break;
+        case 'r': *w++ = '\r'; break;
+        case 't': *w++ = '\t'; break;
+        case 'u': {
+            unsigned c, low;
+            if(!wm_json_hex4(p, &c)){
+                return 0;
+            }
+            p += 4;
+            if(c >= 0xd800 && c < 0xdc00){
+                if(p[0] != '\\' || p[1] != 'u' || !wm_json_hex4(p + 2, &low)
+                   || low < 0xdc00 || low >= 0xe000){
+                    return 0;
+                }
+                p += 6;
+                c = 0x10000 + ((c - 0xd800) << 10) + (low - 0xdc00);
+            }
+            if(c < 0x80){
+                *w++ = c;
+            } else if(c < 0x800){
+                *w++ = 0xc0 | (c >> 6);
+                *w++ = 0x80 | (c & 63);
+            } else if(c < 0x10000){
+                *w++ = 0xe0 | (c >> 12);
+                *w++ = 0x80 | ((c >> 6) & 63);
+                *w++ = 0x80 | (c & 63);
+            } else {
+                *w++ = 0xf0 | (c >> 18);
+                *w++ = 0x80 | ((c >> 12) & 63);
+                *w++ = 0x80 | ((c >> 6) & 63);
+                *w++ = 0x80 | (c & 63);
+            }
+            break;
+        }
+        default:
+            return 0;
+        }
+    }
+    *w = 0;
+    *out = start;
+    *len = w - start;
+    j->p = p + 1;
+    return 1;
+}
+
+static int wm_json_read_str(wm_json* j, char** out){
+    size_t len;
+    char c = wm_json_ws(j);
+    if(c == 'n'){
+        *out = NULL;
+        return wm_json_literal(j, "null", 4);
+    }
+    if(c != '"'){
+        return 0;
+    }
+    j->p++;
+    return wm_json_scan_str(j, out, &len);
+}
+
+/* Read "key": and return the unescaped key. */
+static int wm_json_read_key(wm_json* j, char** name, size_t* len){
+    if(!wm_json_expect(j, '"')){
+        return 0;
+    }
+    return wm_json_scan_str(j, name, len) && wm_json_expect(j, ':');
+}
+
+static int wm_json_skip(wm_json* j){
+    int depth = 0;
+    do {
+        char* s;
+        size_t n;
+        switch(wm_json_ws(j)){
+        case '{':
+        case '[':
+            j->p++;
+            depth++;
+            if(wm_json_ws(j) == '}' || *j->p == ']'){
+                j->p++;
+                depth--;
+                break;
+            }
+            continue;
+        case '"':
+            j->p++;
+            if(!wm_json_scan_str(j, &s, &n)){
+                return 0;
+            }
+            if(depth && wm_json_ws(j) == ':'){
+                j->p++;
+                continue;
+            }
+            break;
+        case 't':
+            if(!wm_json_literal(j, "true", 4)) return 0;
+            break;
+        case 'f':
+            if(!wm_json_literal(j, "false", 5)) return 0;
+            break;
+        case 'n':
+            if(!wm_json_literal(j, "null", 4)) return 0;
+            break;
+        default: {
+            char* end;
+            strtod(j->p, &end);
+            if(end == j->p){
+                return 0;
+            }
+            j->p = end;
+        }
+        }
+        /* after a value: next element or end of containers */
+        while(depth){
+            char c = wm_json_ws(j);
+            if(c == ','){
+                j->p++;
+                break;
+            } else if(c == '}' || c == ']'){
+                j->p++;
+                depth--;
+            } else {
+                return 0;
+            }
+        }
+    } while(depth);
+    return 1;
+}
+
+/* MessagePack writers */
+
+static inline void wm_mp_be(wm_buf* b, unsigned char tag, uint64_t x, int n){
+    unsigned char* out = (unsigned char*)wm_buf_reserve(b, n + 1);
+    out[0] = tag;
+    for(int i = n; i > 0; i--){
+        out[i] = x & 255;
+        x >>= 8;
+    }
+    b->len += n + 1;
+}
+
+static inline void wm_mp_write_int(wm_buf* b, int64_t x){
+    if(x >= 0){
+        if(x < 128) wm_buf_byte(b, x);
+        else if(x < 256) wm_mp_be(b, 0xcc, x, 1);
+        else if(x < 65536) wm_mp_be(b, 0xcd, x, 2);
+        else if(x < 4294967296LL) wm_mp_be(b, 0xce, x, 4);
+        else wm_mp_be(b, 0xcf, x, 8);
+    } else {
+        if(x >= -32) wm_buf_byte(b, (unsigned char)x);
+        else if(x >= -128) wm_mp_be(b, 0xd0, (uint8_t)x, 1);
+        else if(x >= -32768) wm_mp_be(b, 0xd1, (uint16_t)x, 2);
+        else if(x >= -2147483648LL) wm_mp_be(b, 0xd2, (uint32_t)x, 4);
+        else wm_mp_be(b, 0xd3, (uint64_t)x, 8);
+    }
+}
+
+static inline void wm_mp_write_float(wm_buf* b, double x){
+    uint64_t u;
+    memcpy(&u, &x, 8);
+    wm_mp_be(b, 0xcb, u, 8);
+}
+
+static inline void wm_mp_write_str(wm_buf* b, const char* s){
+    if(s == NULL){
+        wm_buf_byte(b, 0xc0);
+        return;
+    }
+    size_t n = strlen(s);
+    if(n < 32) wm_buf_byte(b, 0xa0 | n);
+    else if(n < 256) wm_mp_be(b, 0xd9, n, 1);
+    else if(n < 65536) wm_mp_be(b, 0xda, n, 2);
+    else wm_mp_be(b, 0xdb, n, 4);
+    wm_buf_put(b, s, n);
+}
+
+static inline void wm_mp_write_map(wm_buf* b, size_t n){
+    if(n < 16) wm_buf_byte(b, 0x80 | n);
+    else if(n < 65536) wm_mp_be(b, 0xde, n, 2);
+    else wm_mp_be(b, 0xdf, n, 4);
+}
+
+/* MessagePack scanner. Strings are NUL terminated in place: the byte after a
+   string (always the type byte of the next object) is kept in saved. */
+
+typedef struct wm_mp {
+    unsigned char* p;
+    unsigned char* end;
+    int saved;
+} wm_mp;
+
+static inline int wm_mp_tag(wm_mp* m){
+    if(m->saved >= 0){
+        int c = m->saved;
+        m->saved = -1;
+        m->p++;
+        return c;
+    }
+    if(m->p >= m->end){
+        return -1;
+    }
+    return *m->p++;
+}
+
+static inline int wm_mp_be_read(wm_mp* m, int n, uint64_t* out){
+    if(m->end - m->p < n){
+        return 0;
+    }
+    uint64_t x = 0;
+    for(int i = 0; i < n; i++){
+        x = (x << 8) | m->p[i];
+    }
+    m->p += n;
+    *out = x;
+    return 1;
+}
+
+static int wm_mp_read_int(wm_mp* m, int64_t* out){
+    int tag = wm_mp_tag(m);
+    uint64_t x;
+    if(tag < 0){
+        return 0;
+    } else if(tag < 0x80){
+        *out = tag;
+        return 1;
+    } else if(tag >= 0xe0){
+        *out = (int8_t)tag;
+        return 1;
+    }
+    switch(tag){
+    case 0xcc: if(!wm_mp_be_read(m, 1, &x)) return 0; *out = x; return 1;
+    case 0xcd: if(!wm_mp_be_read(m, 2, &x)) return 0; *out = x; return 1;
+    case 0xce: if(!wm_mp_be_read(m, 4, &x)) return 0; *out = x; return 1;
+    case 0xcf: if(!wm_mp_be_read(m, 8, &x) || x > INT64_MAX) return 0; *out = x; return 1;
+    case 0xd0: if(!wm_mp_be_read(m, 1, &x)) return 0; *out = (int8_t)x; return 1;
+    case 0xd1: if(!wm_mp_be_read(m, 2, &x)) return 0; *out = (int16_t)x; return 1;
+    case 0xd2: if(!wm_mp_be_read(m, 4, &x)) return 0; *out = (int32_t)x; return 1;
+    case 0xd3: if(!wm_mp_be_read(m, 8, &x)) return 0; *out = (int64_t)x; return 1;
+    default: return 0;
+    }
+}
+
+static int wm_mp_read_float(wm_mp* m, double* out){
+    uint64_t x;
+    int64_t i;
+    switch(m->saved >= 0 ? m->saved : (m->p < m->end ? *m->p : -1)){
+    case 0xca: {
+        float f;
+        uint32_t u;
+        wm_mp_tag(m);
+        if(!wm_mp_be_read(m, 4, &x)) return 0;
+        u = x;
+        memcpy(&f, &u, 4);
+        *out = f;
+        return 1;
+    }
+    case 0xcb:
+        wm_mp_tag(m);
+        if(!wm_mp_be_read(m, 8, &x)) return 0;
+        memcpy(out, &x, 8);
+        return 1;
+    default:
+        if(!wm_mp_read_int(m, &i)) return 0;
+        *out = i;
+        return 1;
+    }
+}
+
+/* Length of the string (or binary) of type tag, -1 if tag is not one. */
+static int64_t wm_mp_str_len(wm_mp* m, int tag){
+    uint64_t n;
+    if((tag & 0xe0) == 0xa0){
+        return tag & 31;
+    }
+    switch(tag){
+    case 0xd9: case 0xc4: if(!wm_mp_be_read(m, 1, &n)) return -1; break;
+    case 0xda: case 0xc5: if(!wm_mp_be_read(m, 2, &n)) return -1; break;
+    case 0xdb: case 0xc6: if(!wm_mp_be_read(m, 4, &n)) return -1; break;
+    default: return -1;
+    }
+    return n;
+}
+
+static int wm_mp_scan_str(wm_mp* m, int tag, char** out, size_t* len){
+    int64_t n = wm_mp_str_len(m, tag);
+    if(n < 0 || m->end - m->p < n){
+        return 0;
+    }
+    *out = (char*)m->p;
+    *len = n;
+    m->p += n;
+    if(m->p < m->end){
+        m->saved = *m->p;
+    }
+    /* the buffer has room for a terminator after its end */
+    *m->p = 0;
+    return 1;
+}
+
+static int wm_mp_read_str(wm_mp* m, char** out){
+    size_t len;
+    int tag = wm_mp_tag(m);
+    if(tag == 0xc0){
+        *out = NULL;
+        return 1;
+    }
+    return wm_mp_scan_str(m, tag, out, &len);
+}
+
+static int wm_mp_read_map(wm_mp* m, size_t* n){
+    int tag = wm_mp_tag(m);
+    uint64_t x;
+    if((tag & 0xf0) == 0x80){
+        *n = tag & 15;
+        return 1;
+    } else if(tag == 0xde && wm_mp_be_read(m, 2, &x)){
+        *n = x;
+        return 1;
+    } else if(tag == 0xdf && wm_mp_be_read(m, 4, &x)){
+        *n = x;
+        return 1;
+    }
+    return 0;
+}
+
+static int wm_mp_skip(wm_mp* m){
+    /* number of objects left to skip */
+    uint64_t left = 1;
+    while(left){
+        int tag = wm_mp_tag(m);
+        uint64_t n = 0;
+        int size = 0;
+        left--;
+        if(tag < 0){
+            return 0;
+        } else if(tag < 0x80 || tag >= 0xe0 || tag == 0xc0 || tag == 0xc2 || tag == 0xc3){
+            continue;
+        } else if((tag & 0xf0) == 0x80){
+            left += 2 * (tag & 15);
+            continue;
+        } else if((tag & 0xf0) == 0x90){
+            left += tag & 15;
+            continue;
+        }
+        switch(tag){
+        case 0xcc: case 0xd0: size = 1; break;
+        case 0xcd: case 0xd1: size = 2; break;
+        case 0xce: case 0xd2: case 0xca: size = 4; break;
+        case 0xcf: case 0xd3: case 0xcb: size = 8; break;
+        case 0xd4: size = 2; break;
+        case 0xd5: size = 3; break;
+        case 0xd6: size = 5; break;
+        case 0xd7: size = 9; break;
+        case 0xd8: size = 17; break;
+        case 0xdc: if(!wm_mp_be_read(m, 2, &n)) return 0; left += n; continue;
+        case 0xdd: if(!wm_mp_be_read(m, 4, &n)) return 0; left += n; continue;
+        case 0xde: if(!wm_mp_be_read(m, 2, &n)) return 0; left += 2 * n; continue;
+        case 0xdf: if(!wm_mp_be_read(m, 4, &n)) return 0; left += 2 * n; continue;
+        case 0xc7: if(!wm_mp_be_read(m, 1, &n)) return 0; size = n + 1; break;
+        case 0xc8: if(!wm_mp_be_read(m, 2, &n)) return 0; size = n + 1; break;
+        case 0xc9: if(!wm_mp_be_read(m, 4, &n)) return 0; size = n + 1; break;
+        default: {
+            int64_t len = wm_mp_str_len(m, tag);
+            if(len < 0){
+                return 0;
+            }
+            size = len;
+        }
+        }
+        if(m->end - m->p < size){
+            return 0;
+        }
+        m->p += size;
+    }
+    return 1;
+}
+"""
+
+
+unit = CUnit(
+    "serialize",
+    source=_source,
+    headers=["#include <string.h>"],
+)
+
+buffer_new = NativeFunction("wm_buf_new", Buffer, unit=unit)
+buffer_free = NativeFunction("wm_buf_free", void, Buffer, unit=unit)
+buffer_clear = NativeFunction("wm_buf_clear", void, Buffer, unit=unit)
+buffer_append = NativeFunction("wm_buf_append", void, Buffer, str, unit=unit)
+buffer_length = NativeFunction("wm_buf_length", int, Buffer, unit=unit)
+buffer_str = NativeFunction("wm_buf_str", str, Buffer, unit=unit)
+buffer_print = NativeFunction("wm_buf_print", void, Buffer, unit=unit)
+
+
+def _check_fields(struct):
+    for name, type_ in struct.fields.items():
+        if type_ not in (int, float, str) and not isinstance(type_, Struct):
+            raise WormTypeError(
+                f"Cannot serialise field {name} of type {type_} of {struct}."
+            )
+
+
+def _json_writer(struct, name):
+    code = [f"static void {name}(wm_buf* b, {struct.name}* v){{"]
+    for i, (field, type_) in enumerate(struct.fields.items()):
+        key = ("{" if i == 0 else ",") + f'"{field}":'
+        code.append(f"wm_buf_put(b, {c_string(key)}, {len(key)});")
+        if isinstance(type_, Struct):
+            code.append(f"{_names(type_)['json_write']}(b, &v->{field});")
+        else:
+            kind = {int: "int", float: "float", str: "str"}[type_]
+            code.append(f"wm_json_write_{kind}(b, v->{field});")
+    code.append("wm_buf_byte(b, '}');" if struct.fields else 'wm_buf_put(b, "{}", 2);')
+    code.append("}")
+    return code
+
+
+def _json_reader(struct, name):
+    handlers = {}
+    for field, type_ in struct.fields.items():
+        if isinstance(type_, Struct):
+            read = f"{_names(type_)['json_read']}(j, &v->{field})"
+        else:
+            kind = {int: "int", float: "float", str: "str"}[type_]
+            read = f"wm_json_read_{kind}(j, &v->{field})"
+        handlers[field] = [f"if(!{read}){{", "return 0;", "}", "goto next;"]
+    return [
+        f"static int {name}(wm_json* j, {struct.name}* v){{",
+        "if(!wm_json_expect(j, '{')){",
+        "return 0;",
+        "}",
+        "if(wm_json_ws(j) == '}'){",
+        "j->p++;",
+        "return 1;",
+        "}",
+        "for(;;){",
+        "char* name;",
+        "size_t len;",
+        "if(!wm_json_read_key(j, &name, &len)){",
+        "return 0;",
+        "}",
+        *dispatch_names(handlers),
+        "if(!wm_json_skip(j)){",
+        "return 0;",
+        "}",
+        "next:",
+        "if(wm_json_ws(j) == '}'){",
+        "j->p++;",
+        "return 1;",
+        "}",
+        "if(!wm_json_expect(j, ',')){",
+        "return 0;",
+        "}",
+        "}",
+        "}",
+    ]
+
+
+def _mp_writer(struct, name):
+    code = [f"static void {name}(wm_buf* b, {struct.name}* v){{"]
+    header = len(struct.fields)
+    header = bytes([0x80 | header]) if header < 16 else b"\xde" + header.to_bytes(2, "big")
+    for i, (field, type_) in enumerate(struct.fields.items()):
+        key = field.encode("utf-8")
+        # keys are identifiers, shorter than 32 bytes in practice
+        if len(key) < 32:
+            key = bytes([0xA0 | len(key)]) + key
+        else:
+            key = b"\xd9" + bytes([len(key)]) + key
+        if i == 0:
+            key = header + key
+        code.append(f"wm_buf_put(b, {c_string(key)}, {len(key)});")
+        if isinstance(type_, Struct):
+            code.append(f"{_names(type_)['msgpack_write']}(b, &v->{field});")
+        else:
+            kind = {int: "int", float: "float", str: "str"}[type_]
+            code.append(f"wm_mp_write_{kind}(b, v->{field});")
+    if not struct.fields:
+        code.append(f"wm_buf_put(b, {c_string(header)}, 1);")
+    code.append("}")
+    return code
+
+
+def _mp_reader(struct, name):
+    handlers = {}
+    for field, type_ in struct.fields.items():
+        if isinstance(type_, Struct):
+            read = f"{_names(type_)['msgpack_read']}(m, &v->{field})"
+        else:
+            kind = {int: "int", float: "float", str: "str"}[type_]
+            read = f"wm_mp_read_{kind}(m, &v->{field})"
+        handlers[field] = [f"if(!{read}){{", "return 0;", "}", "continue;"]
+    return [
+        f"static int {name}(wm_mp* m, {struct.name}* v){{",
+        "size_t n;",
+        "if(!wm_mp_read_map(m, &n)){",
+        "return 0;",
+        "}",
+        "while(n--){",
+        "char* name;",
+        "size_t len;",
+        "if(!wm_mp_scan_str(m, wm_mp_tag(m), &name, &len)){",
+        "return 0;",
+        "}",
+        *dispatch_names(handlers),
+        "if(!wm_mp_skip(m)){",
+        "return 0;",
+        "}",
+        "}",
+        "return 1;",
+        "}",
+    ]
+
+
+def _names(struct):
+    return {
+        op: f"wm_{op}_{struct.name}"
+        for op in ("json_write", "json_read", "msgpack_write", "msgpack_read")
+    }
+
+
+def struct_serialize_source(struct):
+    """
+    Return the C definitions of the JSON and MessagePack readers and writers of
+    struct and of the functions exposing them.
+    """
+    names = _names(struct)
+    t = struct.name
+    code = [
+        *_json_writer(struct, names["json_write"]),
+        *_json_reader(struct, names["json_read"]),
+        *_mp_writer(struct, names["msgpack_write"]),
+        *_mp_reader(struct, names["msgpack_read"]),
+        f"void wm_to_json_{t}(wm_buf* b, {t} v){{",
+        f"{names['json_write']}(b, &v);",
+        "}",
+        f"int64_t wm_from_json_{t}(wm_buf* b, {t}* out){{",
+        "b->data[b->len] = 0;",
+        "wm_json j = {b->data};",
+        f"if(!{names['json_read']}(&j, out)){{",
+        "return 0;",
+        "}",
+        "wm_json_ws(&j);",
+        "return j.p == b->data + b->len;",
+        "}",
+        f"void wm_to_msgpack_{t}(wm_buf* b, {t} v){{",
+        f"{names['msgpack_write']}(b, &v);",
+        "}",
+        f"int64_t wm_from_msgpack_{t}(wm_buf* b, {t}* out){{",
+        "wm_mp m = {(unsigned char*)b->data, (unsigned char*)b->data + b->len, -1};",
+        f"return {names['msgpack_read']}(&m, out) && m.p == m.end;",
+        "}",
+    ]
+    return "\n".join(code)
+
+
+_struct_units = {}
+
+
+def _struct_unit(struct):
+    if struct not in _struct_units:
+        _check_fields(struct)
+        requires = [unit] + [
+            _struct_unit(t) for t in struct.fields.values() if isinstance(t, Struct)
+        ]
+        _struct_units[struct] = CUnit(
+            f"serialize_{struct.name}",
+            source=struct_serialize_source(struct),
+            types=[struct],
+            requires=requires,
+        )
+    return _struct_units[struct]
+
+
+_natives = {}
+
+
+def serializer(struct, operation):
+    """
+    Native function implementing operation (to_json, from_json, to_msgpack or
+    from_msgpack) for values of type struct.
+    """
+    if not isinstance(struct, Struct):
+        raise WormTypeError(f"Cannot serialise values of type {struct}.")
+    key = (struct, operation)
+    if key not in _natives:
+        name = f"wm_{operation}_{struct.name}"
+        if operation.startswith("to_"):
+            native = NativeFunction(name, void, Buffer, struct, unit=_struct_unit(struct))
+        else:
+            native = NativeFunction(name, int, Buffer, Ptr(struct), unit=_struct_unit(struct))
+        _natives[key] = native
+    return _natives[key]
+
+
+class SerializeOperation(NativeFunction):
+    """
+    Generic (de)serialisation, replaced by the native dedicated to the struct
+    passed as second argument (pointed to for readers).
+    """
+
+    def __init__(self, operation):
+        super().__init__(f"wm_{operation}", void)
+        self.operation = operation
+
+    def native_for(self, value):
+        type_ = value.type.deref()
+        if self.operation.startswith("from_"):
+            if not isinstance(type_, Ptr):
+                return None
+            type_ = type_.pointed_type
+        if isinstance(type_, Struct):
+            return serializer(type_, self.operation)
+        return None
+
+    def check_args(self, *args):
+        native = self.native_for(args[1]) if len(args) == 2 else None
+        return native is not None and all(
+            check_type(ref, arg) for ref, arg in zip(native.args, args)
+        )
+
+    def specialize(self, *args):
+        return self.native_for(args[1]), list(args)
+
+
+namespace = {
+    "Buffer": Buffer,
+    "buffer_new": buffer_new,
+    "buffer_free": buffer_free,
+    "buffer_clear": buffer_clear,
+    "buffer_append": buffer_append,
+    "buffer_length": buffer_length,
+    "buffer_str": buffer_str,
+    "buffer_print": buffer_print,
+    **{
+        op: SerializeOperation(op)
+        for op in ("to_json", "from_json", "to_msgpack", "from_msgpack")
+    },
+}
@@ -0,0 +1,488 @@
+"""
+Threads, mutexes, condition variables and a work-stealing thread pool on top of
+pthreads.
+
+The pool is made of n - 1 worker threads, the thread submitting a parallel loop
+takes part in the work. Each worker owns a deque of ranges: a worker pops ranges
+from the bottom of its own deque, splits them in halves until they are smaller
+than the grain (pushing the upper halves back) and runs the remaining piece.
+Idle workers steal from the top of the other deques, hence the big ranges.
+
+parallel_reduce combine function must be associative and commutative since
+partial results are combined per worker.
+"""
+from ..native import CUnit, NativeFunction
+from ..type_checker import FunctionPrototype
+from ..wtypes import SimpleType, void
+
+
+Thread = SimpleType("wm_thread*")
+Mutex = SimpleType("wm_mutex*")
+Cond = SimpleType("wm_cond*")
+Pool = SimpleType("wm_pool*")
+
+
+_source = r"""
+typedef struct wm_thread {
+    pthread_t handle;
+    void (*fn)(int64_t);
+    int64_t arg;
+} wm_thread;
+
+typedef pthread_mutex_t wm_mutex;
+typedef pthread_cond_t wm_cond;
+
+int64_t wm_cpu_count(void){
+    long n = sysconf(_SC_NPROCESSORS_ONLN);
+    return n > 0 ? n : 1;
+}
+
+static void* wm_thread_trampoline(void* p){
+    wm_thread* t = p;
+    t->fn(t->arg);
+    return NULL;
+}
+
+wm_thread* wm_thread_spawn(void (*fn)(int64_t), int64_t arg){
+    wm_thread* t = malloc(sizeof(wm_thread));
+    t->fn = fn;
+    t->arg = arg;
+    if(pthread_create(&t->handle, NULL, wm_thread_trampoline, t) != 0){
+        free(t);
+        return NULL;
+    }
+    return t;
+}
+
+void wm_thread_join(wm_thread* t){
+    pthread_join(t->handle, NULL);
+    free(t);
+}
+
+wm_mutex* wm_mutex_new(void){
+    wm_mutex* m = malloc(sizeof(wm_mutex));
+    pthread_mutex_init(m, NULL);
+    return m;
+}
+
+void wm_mutex_lock(wm_mutex* m){ pthread_mutex_lock(m); }
+void wm_mutex_unlock(wm_mutex* m){ pthread_mutex_unlock(m); }
+
+void wm_mutex_free(wm_mutex* m){
+    pthread_mutex_destroy(m);
+    free(m);
+}
+
+wm_cond* wm_cond_new(void){
+    wm_cond* c = malloc(sizeof(wm_cond));
+    pthread_cond_init(c, NULL);
+    return c;
+}
+
+void wm_cond_wait(wm_cond* c, wm_mutex* m){ pthread_cond_wait(c, m); }
+void wm_cond_signal(wm_cond* c){ pthread_cond_signal(c); }
+void wm_cond_broadcast(wm_cond* c){ pthread_cond_broadcast(c); }
+
+void wm_cond_free(wm_cond* c){
+    pthread_cond_destroy(c);
+    free(c);
+}
+
+typedef void (*wm_task_fn)(void* ctx, int64_t lo, int64_t hi, int64_t worker);
+
+typedef struct wm_job {
+    wm_task_fn fn;
+    void* ctx;
+    int64_t grain;
+    atomic_int_fast64_t remaining;
+} wm_job;
+
+typedef struct wm_task {
+    wm_job* job;
+    int64_t lo, hi;
+} wm_task;
+
+typedef struct wm_deque {
+    pthread_mutex_t lock;
+    wm_task* tasks;
+    int64_t top, bottom, capacity;
+} wm_deque;
+
+typedef struct wm_pool {
+    int64_t nworkers;
+    pthread_t* threads;
+    wm_deque* deques; /* nworkers + 1, the last one belongs to the submitter */
+    pthread_mutex_t lock;
+    pthread_mutex_t submit;
+    pthread_cond_t wake;
+    atomic_int_fast64_t queued;
+    atomic_int_fast64_t sleeping;
+    int stop;
+} wm_pool;
+
+static _Thread_local wm_pool* wm_current_pool = NULL;
+static _Thread_local int64_t wm_current_worker = -1;
+
+static void wm_deque_push(wm_deque* d, wm_task t){
+    pthread_mutex_lock(&d->lock);
+    if(d->bottom - d->top == d->capacity){
+        int64_t capacity = d->capacity * 2;
+        wm_task* tasks = malloc(capacity * sizeof(wm_task));
+        for(int64_t i = d->top; i < d->bottom; i++){
+            tasks[i % capacity] = d->tasks[i % d->capacity];
+        }
+        free(d->tasks);
+        d->tasks = tasks;
+        d->capacity = capacity;
+    }
+    d->tasks[d->bottom % d->capacity] = t;
+    d->bottom++;
+    pthread_mutex_unlock(&d->lock);
+}
+
+static int wm_deque_pop(wm_deque* d, wm_task* t){
+    int found = 0;
+    pthread_mutex_lock(&d->lock);
+    if(d->bottom > d->top){
+        d->bottom--;
+        *t = d->tasks[d->bottom % d->capacity];
+        found = 1;
+    }
+    pthread_mutex_unlock(&d->lock);
+    return found;
+}
+
+static int wm_deque_steal(wm_deque* d, wm_task* t){
+    int found = 0;
+    pthread_mutex_lock(&d->lock);
+    if(d->bottom > d->top){
+        *t = d->tasks[d->top % d->capacity];
+        d->top++;
+        found = 1;
+    }
+    pthread_mutex_unlock(&d->lock);
+    return found;
+}
+
+static void wm_pool_push(wm_pool* pool, int64_t worker, wm_task t){
+    wm_deque_push(&pool->deques[worker], t);
+    atomic_fetch_add(&pool->queued, 1);
+    if(atomic_load(&pool->sleeping) > 0){
+        pthread_mutex_lock(&pool->lock);
+        pthread_cond_broadcast(&pool->wake);
+        pthread_mutex_unlock(&pool->lock);
+    }
+}
+
+static int wm_pool_find(wm_pool* pool, int64_t worker, wm_task* t){
+    int64_t n = pool->nworkers + 1;
+    if(wm_deque_pop(&pool->deques[worker], t)){
+        atomic_fetch_sub(&pool->queued, 1);
+        return 1;
+    }
+    for(int64_t k = 1; k < n; k++){
+        if(wm_deque_steal(&pool->deques[(worker + k) % n], t)){
+            atomic_fetch_sub(&pool->queued, 1);
+            return 1;
+        }
+    }
+    return 0;
+}
+
+static void wm_pool_run(wm_pool* pool, int64_t worker, wm_task t){
+    wm_job* job = t.job;
+    int64_t lo = t.lo, hi = t.hi;
+    while(hi - lo > job->grain){
+        int64_t mid = lo + (hi - lo) / 2;
+        wm_pool_push(pool, worker, (wm_task){job, mid, hi});
+        hi = mid;
+    }
+    job->fn(job->ctx, lo, hi, worker);
+    if(atomic_fetch_sub(&job->remaining, hi - lo) == hi - lo){
+        pthread_mutex_lock(&pool->lock);
+        pthread_cond_broadcast(&pool->wake);
+        pthread_mutex_unlock(&pool->lock);
+    }
+}
+
+static void* wm_pool_worker(void* p){
+    wm_pool* pool = p;
+    int64_t worker = wm_current_worker;
+    wm_task t;
+    while(1){
+        if(wm_pool_find(pool, worker, &t)){
+            wm_pool_run(pool, worker, t);
+            continue;
+        }
+        pthread_mutex_lock(&pool->lock);
+        atomic_fetch_add(&pool->sleeping, 1);
+        while(!pool->stop && atomic_load(&pool->queued) == 0){
+            pthread_cond_wait(&pool->wake, &pool->lock);
+        }
+        atomic_fetch_sub(&pool->sleeping, 1);
+        int stop = pool->stop;
+        pthread_mutex_unlock(&pool->lock);
+        if(stop){
+            return NULL;
+        }
+    }
+}
+
+typedef struct wm_worker_start {
+    wm_pool* pool;
+    int64_t worker;
+} wm_worker_start;
+
+static void* wm_pool_worker_start(void* p){
+    wm_worker_start start = *(wm_worker_start*)p;
+    free(p);
+    wm_current_pool = start.pool;
+    wm_current_worker = start.worker;
+    return wm_pool_worker(start.pool);
+}
+
+wm_pool* wm_pool_new(int64_t nthreads){
+    if(nthreads <= 0){
+        nthreads = wm_cpu_count();
+    }
+    wm_pool* pool = malloc(sizeof(wm_pool));
+    pool->nworkers = nthreads - 1;
+    pool->threads = malloc(pool->nworkers * sizeof(pthread_t));
+    pool->deques = malloc((pool->nworkers + 1) * sizeof(wm_deque));
+    for(int64_t i = 0; i <= pool->nworkers; i++){
+        pthread_mutex_init(&pool->deques[i].lock, NULL);
+        pool->deques[i].capacity = 64;
+        pool->deques[i].tasks = malloc(64 * sizeof(wm_task));
+        pool->deques[i].top = 0;
+        pool->deques[i].bottom = 0;
+    }
+    pthread_mutex_init(&pool->lock, NULL);
+    pthread_mutex_init(&pool->submit, NULL);
+    pthread_cond_init(&pool->wake, NULL);
+    atomic_init(&pool->queued, 0);
+    atomic_init(&pool->sleeping, 0);
+    pool->stop = 0;
+    for(int64_t i = 0; i < pool->nworkers; i++){
+        wm_worker_start* start = malloc(sizeof(wm_worker_start));
+        start->pool = pool;
+        start->worker = i;
+        pthread_create(&pool->threads[i], NULL, wm_pool_worker_start, start);
+    }
+    return pool;
+}
+
+int64_t wm_pool_size(wm_pool* pool){
+    return pool->nworkers + 1;
+}
+
+void wm_pool_free(wm_pool* pool){
+    pthread_mutex_lock(&pool->lock);
+    pool->stop = 1;
+    pthread_cond_broadcast(&pool->wake);
+    pthread_mutex_unlock(&pool->lock);
+    for(int64_t i = 0; i < pool->nworkers; i++){
+        pthread_join(pool->threads[i], NULL);
+    }
+    for(int64_t i = 0; i <= pool->nworkers; i++){
+        pthread_mutex_destroy(&pool->deques[i].lock);
+        free(pool->deques[i].tasks);
+    }
+    pthread_mutex_destroy(&pool->lock);
+    pthread_mutex_destroy(&pool->submit);
+    pthread_cond_destroy(&pool->wake);
+    free(pool->deques);
+    free(pool->threads);
+    free(pool);
+}
+
+/* Run fn over [lo, hi) on the pool and return when every index has been
+   processed. The calling thread works too. */
+void wm_pool_parallel(wm_pool* pool, int64_t lo, int64_t hi, wm_task_fn fn, void* ctx){
+    if(hi <= lo){
+        return;
+    }
+    int nested = wm_current_pool == pool;
+    int64_t self = nested ? wm_current_worker : pool->nworkers;
+    int64_t n = pool->nworkers + 1;
+    wm_job job;
+    job.fn = fn;
+    job.ctx = ctx;
+    job.grain = (hi - lo) / (8 * n);
+    if(job.grain < 1){
+        job.grain = 1;
+    }
+    atomic_init(&job.remaining, hi - lo);
+
+    if(!nested){
+        pthread_mutex_lock(&pool->submit);
+        wm_current_pool = pool;
+        wm_current_worker = self;
+    }
+
+    int64_t chunk = (hi - lo + n - 1) / n;
+    for(int64_t w = 0, start = lo; start < hi; w++, start += chunk){
+        int64_t end = start + chunk < hi ? start + chunk : hi;
+        wm_pool_push(pool, (self + w) % n, (wm_task){&job, start, end});
+    }
+
+    wm_task t;
+    while(atomic_load(&job.remaining) > 0){
+        if(wm_pool_find(pool, self, &t)){
+            wm_pool_run(pool, self, t);
+            continue;
+        }
+        pthread_mutex_lock(&pool->lock);
+        atomic_fetch_add(&pool->sleeping, 1);
+        while(atomic_load(&job.remaining) > 0 && atomic_load(&pool->queued) == 0){
+            pthread_cond_wait(&pool->wake, &pool->lock);
+        }
+        atomic_fetch_sub(&pool->sleeping, 1);
+        pthread_mutex_unlock(&pool->lock);
+    }
+
+    if(!nested){
+        wm_current_pool = NULL;
+        wm_current_worker = -1;
+        pthread_mutex_unlock(&pool->submit);
+    }
+}
+
+typedef struct wm_for_ctx {
+    void (*body)(int64_t);
+} wm_for_ctx;
+
+static void wm_for_task(void* p, int64_t lo, int64_t hi, int64_t worker){
+    wm_for_ctx* ctx = p;
+    for(int64_t i = lo; i < hi; i++){
+        ctx->body(i);
+    }
+}
+
+void wm_parallel_for(wm_pool* pool, int64_t lo, int64_t hi, void (*body)(int64_t)){
+    wm_for_ctx ctx = {body};
+    wm_pool_parallel(pool, lo, hi, wm_for_task, &ctx);
+}
+"""
+
+
+def _reduce_source(suffix, ctype):
+    return rf"""
+typedef struct wm_reduce{suffix}_ctx {{
+    {ctype} (*body)(int64_t);
+    {ctype} (*combine)({ctype}, {ctype});
+    {ctype}* partial;
+    char* has_partial;
+}} wm_reduce{suffix}_ctx;
+
+static void wm_reduce{suffix}_task(void* p, int64_t lo, int64_t hi, int64_t worker){{
+    wm_reduce{suffix}_ctx* ctx = p;
+    {ctype} acc = ctx->body(lo);
+    for(int64_t i = lo + 1; i < hi; i++){{
+        acc = ctx->combine(acc, ctx->body(i));
+    }}
+    if(ctx->has_partial[worker]){{
+        ctx->partial[worker] = ctx->combine(ctx->partial[worker], acc);
+    }} else {{
+        ctx->partial[worker] = acc;
+        ctx->has_partial[worker] = 1;
+    }}
+}}
+
+{ctype} wm_parallel_reduce{suffix}(wm_pool* pool, int64_t lo, int64_t hi, {ctype} (*body)(int64_t), {ctype} (*combine)({ctype}, {ctype}), {ctype} init){{
+    int64_t n = pool->nworkers + 1;
+    wm_reduce{suffix}_ctx ctx = {{body, combine, malloc(n * sizeof({ctype})), calloc(n, 1)}};
+    wm_pool_parallel(pool, lo, hi, wm_reduce{suffix}_task, &ctx);
+    {ctype} acc = init;
+    for(int64_t w = 0; w < n; w++){{
+        if(ctx.has_partial[w]){{
+            acc = combine(acc, ctx.partial[w]);
+        }}
+    }}
+    free(ctx.partial);
+    free(ctx.has_partial);
+    return acc;
+}}
+"""
+
+
+unit = CUnit(
+    "threading",
+    source=_source + _reduce_source("", "int64_t") + _reduce_source("_float", "double"),
+    headers=["#include <pthread.h>", "#include <stdatomic.h>", "#include <unistd.h>"],
+    cflags=["-pthread"],
+    ldflags=["-pthread"],
+)
+
+cpu_count = NativeFunction("wm_cpu_count", int, unit=unit)
+
+thread_spawn = NativeFunction(
+    "wm_thread_spawn", Thread, FunctionPrototype(void, int), int, unit=unit
+)
+thread_join = NativeFunction("wm_thread_join", void, Thread, unit=unit)
+
+mutex_new = NativeFunction("wm_mutex_new", Mutex, unit=unit)
+mutex_lock = NativeFunction("wm_mutex_lock", void, Mutex, unit=unit)
+mutex_unlock = NativeFunction("wm_mutex_unlock", void, Mutex, unit=unit)
+mutex_free = NativeFunction("wm_mutex_free", void, Mutex, unit=unit)
+
+cond_new = NativeFunction("wm_cond_new", Cond, unit=unit)
+cond_wait = NativeFunction("wm_cond_wait", void, Cond, Mutex, unit=unit)
+cond_signal = NativeFunction("wm_cond_signal", void, Cond, unit=unit)
+cond_broadcast = NativeFunction("wm_cond_broadcast", void, Cond, unit=unit)
+cond_free = NativeFunction("wm_cond_free", void, Cond, unit=unit)
+
+pool_new = NativeFunction("wm_pool_new", Pool, int, unit=unit)
+pool_size = NativeFunction("wm_pool_size", int, Pool, unit=unit)
+pool_free = NativeFunction("wm_pool_free", void, Pool, unit=unit)
+
+parallel_for = NativeFunction(
+    "wm_parallel_for", void, Pool, int, int, FunctionPrototype(void, int), unit=unit
+)
+parallel_reduce = NativeFunction(
+    "wm_parallel_reduce",
+    int,
+    Pool,
+    int,
+    int,
+    FunctionPrototype(int, int),
+    FunctionPrototype(int, int, int),
+    int,
+    unit=unit,
+)
+parallel_reduce_float = NativeFunction(
+    "wm_parallel_reduce_float",
+    float,
+    Pool,
+    int,
+    int,
+    FunctionPrototype(float, int),
+    FunctionPrototype(float, float, float),
+    float,
+    unit=unit,
+)
+
+
+namespace = {
+    "Thread": Thread,
+    "Mutex": Mutex,
+    "Cond": Cond,
+    "Pool": Pool,
+    "cpu_count": cpu_count,
+    "thread_spawn": thread_spawn,
+    "thread_join": thread_join,
+    "mutex_new": mutex_new,
+    "mutex_lock": mutex_lock,
+    "mutex_unlock": mutex_unlock,
+    "mutex_free": mutex_free,
+    "cond_new": cond_new,
+    "cond_wait": cond_wait,
+    "cond_signal": cond_signal,
+    "cond_broadcast": cond_broadcast,
+    "cond_free": cond_free,
+    "pool_new": pool_new,
+    "pool_size": pool_size,
+    "pool_free": pool_free,
+    "parallel_for": parallel_for,
+    "parallel_reduce": parallel_reduce,
+    "parallel_reduce_float": parallel_reduce_float,
+}
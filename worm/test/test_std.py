@@ -0,0 +1,481 @@
+import json
+import os
+import random
+import re
+import shutil
+import struct
+import subprocess
+import tempfile
+
+import pytest
+
+from ..transformer import hook
+
+hook(debug=False)
+
+
+needs_cc = pytest.mark.skipif(
+    shutil.which(os.environ.get("CC", "cc")) is None, reason="no C compiler"
+)
+
+
+def run_program(context, **kwargs):
+    with tempfile.TemporaryDirectory() as tmp:
+        exe = os.path.join(tmp, "prog")
+        context.save_program(exe, **kwargs)
+        return subprocess.run(
+            [exe], capture_output=True, text=True, timeout=60
+        ).stdout
+
+
+@needs_cc
+def test_threading():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    from .threads import worm
+
+    assert run_program(worm) == "332833500 500.0 4\n"
+
+
+@needs_cc
+def test_eventloop():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    from .echo import worm
+
+    assert run_program(worm) == "invalid fd\nping\npong\ntick 42\n"
+
+
+@needs_cc
+def test_buffered_printf():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    from .buffered_io import worm
+
+    source = worm.dump_source()
+    main = source[source.index("void main()"):]
+    assert "printf(" not in main.replace("wm_printf_", "")
+
+    a, b, s = -42, 3.14159, "worm"
+    expected = "\n".join(
+        [
+            "a=%d [%5d] [%-5d] [%05d] [%+d] %x %X %#x %o %u"
+            % (a, a, a, a, 7, 255, 255, 255, 8, 12),
+            "b=%f [%.2f] [%8.3f] [%-8.1f] [%08.2f] %.0f %.0f %e"
+            % (b, b, b, b, b, 2.5, 3.5, b),
+            "s=%s [%6s] [%-6s] [%.2s] %c %s 100%%" % (s, s, s, s, "!", "const"),
+            "",
+        ]
+    )
+    assert run_program(worm) == expected
+
+    worm.setup_fresh_state()
+    from .float_io import worm
+
+    # without optimisation the float formatting calls rint from libm: the
+    # flags of the natives specialized by the type checker must be used
+    assert run_program(worm, cflags=("-O0",)) == "0.250000\n"
+
+
+def test_printf_pointer():
+    from ..std import io
+    from ..wast import WConstant, WName
+    from ..wtypes import Ptr, void
+
+    p = WName("p")
+    p.type = Ptr(void)
+    native, args = io.printf.specialize(WConstant("%p\n"), p)
+    # %p takes a Ptr(void), printed by the C printf
+    assert args == [p]
+    assert f"static void {native.name}(void* a0){{" in native.unit.source
+
+
+def xoshiro256ss(seed):
+    mask = (1 << 64) - 1
+
+    def rotl(x, k):
+        return ((x << k) | (x >> (64 - k))) & mask
+
+    s = []
+    x = seed
+    for _ in range(4):
+        x = (x + 0x9E3779B97F4A7C15) & mask
+        z = x
+        z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & mask
+        z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & mask
+        s.append(z ^ (z >> 31))
+
+    while True:
+        yield rotl((s[1] * 5) & mask, 7) * 9 & mask
+        t = (s[1] << 17) & mask
+        s[2] ^= s[0]
+        s[3] ^= s[1]
+        s[1] ^= s[2]
+        s[0] ^= s[3]
+        s[2] ^= t
+        s[3] = rotl(s[3], 45)
+
+
+@needs_cc
+def test_random():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    from .rng import worm
+
+    gen = xoshiro256ss(42)
+    expected = [f"{next(gen):x}" for _ in range(3)] + ["1 0.5", "1", "10", ""]
+    assert run_program(worm) == "\n".join(expected)
+
+
+MASK64 = (1 << 64) - 1
+
+
+def siphash24(k0, k1, data):
+    def rotl(x, b):
+        return ((x << b) | (x >> (64 - b))) & MASK64
+
+    v = [
+        0x736F6D6570736575 ^ k0,
+        0x646F72616E646F6D ^ k1,
+        0x6C7967656E657261 ^ k0,
+        0x7465646279746573 ^ k1,
+    ]
+
+    def rounds(n):
+        for _ in range(n):
+            v[0] = (v[0] + v[1]) & MASK64
+            v[1] = rotl(v[1], 13) ^ v[0]
+            v[0] = rotl(v[0], 32)
+            v[2] = (v[2] + v[3]) & MASK64
+            v[3] = rotl(v[3], 16) ^ v[2]
+            v[0] = (v[0] + v[3]) & MASK64
+            v[3] = rotl(v[3], 21) ^ v[0]
+            v[2] = (v[2] + v[1]) & MASK64
+            v[1] = rotl(v[1], 17) ^ v[2]
+            v[2] = rotl(v[2], 32)
+
+    tail = len(data) % 8
+    blocks = [data[i : i + 8] for i in range(0, len(data) - tail, 8)]
+    blocks.append(data[len(data) - tail :] + bytes(7 - tail) + bytes([len(data) & 0xFF]))
+    for block in blocks:
+        m = int.from_bytes(block, "little")
+        v[3] ^= m
+        rounds(2)
+        v[0] ^= m
+    v[2] ^= 0xFF
+    rounds(4)
+    return v[0] ^ v[1] ^ v[2] ^ v[3]
+
+
+def wyhash(data, seed):
+    p0, p1, p2, p3 = (
+        0x2D358DCCAA6C78A5,
+        0x8BB84B93962EACC9,
+        0x4B33A62ED433D4A3,
+        0x4D5A2DA51DE1AA47,
+    )
+
+    def mum(a, b):
+        r = a * b
+        return r & MASK64, r >> 64
+
+    def mix(a, b):
+        lo, hi = mum(a, b)
+        return lo ^ hi
+
+    def r8(i):
+        return int.from_bytes(data[i : i + 8], "little")
+
+    def r4(i):
+        return int.from_bytes(data[i : i + 4], "little")
+
+    n = len(data)
+    seed ^= mix(seed ^ p0, p1)
+    if n <= 16:
+        if n >= 4:
+            a = (r4(0) << 32) | r4((n >> 3) << 2)
+            b = (r4(n - 4) << 32) | r4(n - 4 - ((n >> 3) << 2))
+        elif n > 0:
+            a = (data[0] << 16) | (data[n >> 1] << 8) | data[n - 1]
+            b = 0
+        else:
+            a = b = 0
+    else:
+        i, p = n, 0
+        if i >= 48:
+            see1 = see2 = seed
+            while i >= 48:
+                seed = mix(r8(p) ^ p1, r8(p + 8) ^ seed)
+                see1 = mix(r8(p + 16) ^ p2, r8(p + 24) ^ see1)
+                see2 = mix(r8(p + 32) ^ p3, r8(p + 40) ^ see2)
+                p += 48
+                i -= 48
+            seed ^= see1 ^ see2
+        while i > 16:
+            seed = mix(r8(p) ^ p1, r8(p + 8) ^ seed)
+            i -= 16
+            p += 16
+        a, b = r8(p + i - 16), r8(p + i - 8)
+    a, b = mum(a ^ p1, b ^ seed)
+    return mix(a ^ p0 ^ n, b ^ p1)
+
+
+@needs_cc
+def test_hashing():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    from .hashes import worm
+
+    k0 = int.from_bytes(bytes(range(8)), "little")
+    k1 = int.from_bytes(bytes(range(8, 16)), "little")
+    long = b"a longer string of more than forty eight bytes, to hit the bulk loop"
+
+    lines = run_program(worm).splitlines()
+    # first reference vector of the SipHash paper
+    assert lines[0] == "726fdb47dd0e0e31" == f"{siphash24(k0, k1, b''):x}"
+    assert lines[1] == f"{siphash24(k0, k1, b'hello world, hello worm'):x}"
+    assert lines[2] == f"{wyhash(b'hello', 0):x}"
+    assert lines[3] == f"{wyhash(long, 7):x}"
+
+    a, b, c = lines[4].split()
+    assert a == b != c
+    one, two = lines[5].split()
+    assert one != two
+
+
+def test_regex_dfa():
+    from ..std.regex import compile_pattern
+
+    patterns = [
+        "ERROR|WARN(ING)?",
+        "^ab*c$",
+        "(ab|a)c+",
+        r"[a-c]{2,3}x?",
+        r"\d+\.\d*",
+        "^$",
+        "",
+        "[^ab]+$",
+        "(a|b)*abb",
+        r"\w+@\w+",
+        "(?:ab)+?c",
+        "[]a-]z",
+        "a^b|(^a|b)c",
+        r"\Aa|z\Z",
+        "(a|)+b",
+    ]
+    alphabet = "abcz1.@ $]-"
+    rand = random.Random(0)
+    samples = [
+        "".join(rand.choice(alphabet) for _ in range(rand.randint(0, 8)))
+        for _ in range(500)
+    ]
+    for pattern in patterns:
+        compiled = re.compile(pattern)
+        for mode in ("search", "match", "fullmatch"):
+            dfa = compile_pattern(pattern, mode)
+            for s in samples:
+                expected = bool(getattr(compiled, mode)(s))
+                assert dfa.matches(s.encode()) == expected, (pattern, mode, s)
+
+
+@needs_cc
+def test_regex():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    from .grep import worm
+
+    lines = [
+        "2024-01-02 WARNING: disk 93% full",
+        "2024-01-02 INFO: started.",
+        "[ERROR] disk 12% full!",
+        "aabbc",
+        "",
+    ]
+    expected = []
+    for line in lines:
+        results = [
+            re.search("ERROR|WARN(ING)?", line),
+            re.match(r"\d{4}-\d\d-\d\d ", line),
+            re.fullmatch(r"[^ ]+ \w+: .*[.!]", line),
+            re.search("disk [0-9]+% full$", line),
+            " ",
+            re.search("^[0-9]+-.*ING", line),
+            re.fullmatch("a*b+c?", line),
+        ]
+        expected.append("".join(r if r == " " else str(int(bool(r))) for r in results))
+
+    assert run_program(worm) == "\n".join(expected) + "\n"
+
+
+@needs_cc
+def test_queues():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    from .rings import worm
+
+    assert run_program(worm) == (
+        "40 -19 19 0\n"
+        "19 -19\n"
+        "1.5 1\n"
+        "8 0 7\n"
+        "1\n"
+        f"{4 * 200000 * 200001 // 2}\n"
+    )
+
+
+@needs_cc
+def test_gc():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    from .gc_strings import worm
+
+    assert run_program(worm, gc=True) == "item-0item-777\ncollected\nsmall heap\n"
+    # without gc=True nothing is ever collected
+    assert run_program(worm) == "item-0item-777\n"
+
+    import importlib
+    from ..errors import WormCompileError
+    from . import threads
+
+    # the collector is single threaded
+    worm.setup_fresh_state()
+    worm = importlib.reload(threads).worm
+    with pytest.raises(WormCompileError, match="not thread safe"):
+        worm.dump_source(gc=True)
+
+
+@needs_cc
+def test_argparse():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    from .cli import worm
+
+    with tempfile.TemporaryDirectory() as tmp:
+        exe = os.path.join(tmp, "greet")
+        worm.save_program(exe)
+
+        def run(*args):
+            return subprocess.run(
+                [exe, *args], capture_output=True, text=True, timeout=60
+            )
+
+        assert run("Bob").stdout == "Hello Bob\nverbose=0 quiet=0 ratio=0.5\n"
+        assert run("-vv", "-n3", "--ratio=2.5", "Ann").stdout == (
+            "Hello Ann\n" * 3 + "verbose=2 quiet=0 ratio=2.5\n"
+        )
+        assert run("--greeting", "Hi", "-qn", "2", "--", "-x").stdout == (
+            "Hi -x\n" * 2 + "verbose=0 quiet=1 ratio=0.5\n"
+        )
+
+        res = run("--help")
+        assert res.returncode == 0
+        assert res.stdout.startswith("usage: greet [-h] [-n COUNT]")
+        assert "  -n COUNT, --count COUNT\n" in res.stdout
+
+        for args, error in [
+            (["-n", "x", "Bob"], "argument -n/--count: invalid int value: 'x'"),
+            ([], "the following argument is required: name"),
+            (["Bob", "extra"], "unrecognized argument: extra"),
+            (["--colour", "x", "Bob"], "unrecognized argument: --colour"),
+            (["--quiet=1", "Bob"], "ignored explicit argument: --quiet=1"),
+            (["Bob", "--count"], "expected one argument: -n/--count"),
+        ]:
+            res = run(*args)
+            assert res.returncode == 2
+            assert res.stderr.endswith(f"greet: error: {error}\n")
+
+    from .cli_required import worm
+
+    with tempfile.TemporaryDirectory() as tmp:
+        exe = os.path.join(tmp, "many")
+        worm.save_program(exe)
+
+        def run(*args):
+            return subprocess.run(
+                [exe, *args], capture_output=True, text=True, timeout=60
+            )
+
+        args = [f"--o{i}={i}" for i in range(70)]
+        assert run(*args).stdout == "0 69\n"
+        res = run(*args[:-1])
+        assert res.returncode == 2
+        error = "the following argument is required: --o69"
+        assert res.stderr.endswith(f"many: error: {error}\n")
+
+
+def msgpack_pack(value):
+    """
+    Reference MessagePack encoder for dicts, ints, floats and strs.
+    """
+    if isinstance(value, dict):
+        assert len(value) < 16
+        out = bytes([0x80 | len(value)])
+        for k, v in value.items():
+            out += msgpack_pack(k) + msgpack_pack(v)
+        return out
+    elif isinstance(value, str):
+        data = value.encode()
+        assert len(data) < 256
+        if len(data) < 32:
+            return bytes([0xA0 | len(data)]) + data
+        return bytes([0xD9, len(data)]) + data
+    elif isinstance(value, float):
+        return b"\xcb" + struct.pack(">d", value)
+    elif -32 <= value < 128:
+        return struct.pack(">b", value)
+    elif 0 <= value < 256:
+        return b"\xcc" + struct.pack(">B", value)
+    elif 0 <= value < 65536:
+        return b"\xcd" + struct.pack(">H", value)
+    elif -128 <= value < 0:
+        return b"\xd0" + struct.pack(">b", value)
+    else:
+        return b"\xd3" + struct.pack(">q", value)
+
+
+@needs_cc
+def test_serialize():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    from .records import worm
+
+    out = run_program(worm).split("\n")
+    expected = {
+        "id": -42,
+        "name": 'say "hi"\n\tbye',
+        "score": 0.1,
+        "origin": {"x": 1.5, "y": -2.0},
+        "tags": 300,
+    }
+    assert json.loads(out[0]) == expected
+    roundtrip = '1 -42 [say "hi"\n\tbye] 0.1 (1.5, -2) 300'
+    assert "\n".join(out[1:3]) == roundtrip
+    assert out[3] == "1 7 [café \U0001f600] 0.1 (1.5, 4) 1000"
+    assert out[4] == "1 7 [x] 1.25 (1.5, 4) 2"
+    assert out[5:7] == ["0", "0"]
+    assert bytes.fromhex(out[7]) == msgpack_pack(expected)
+    assert "\n".join(out[8:10]) == roundtrip
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -1,4 +1,7 @@
+import pytest
+
 from ..transformer import hook
+from .test_std import needs_cc, run_program
 
 hook(debug=False)
 
@@ -33,6 +36,455 @@ def test_custom_type():
     assert __doc__ == worm.dump_source()
 
 
+@needs_cc
+def test_constant_tables():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    from .tables import worm
+
+    source = worm.dump_source()
+    # the large blob is a string literal, not an initialiser list
+    assert "unsigned char bytes[10240];" in source
+    assert source.count("static const table_uint8_t") == 2
+    assert run_program(worm) == (
+        'tables "ok"\n'
+        "40 8\n"
+        "81 10\n"
+        "-0.28125 0.5\n"
+        "zero two\n"
+        "-300 7 32000\n"
+        "1305600 10240\n"
+    )
+
+
+def test_invalid_constant():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    import array
+    from ..constants import as_constant, constant_error
+    from ..errors import WormTypeError
+    from .bad_constant import worm
+
+    with pytest.raises(WormTypeError, match="BIG cannot be used as a constant"):
+        worm.dump_source()
+
+    for value in ([], [1, "a"], [[1, 2]], 1 << 64, array.array("u", "ab")):
+        assert as_constant(value) is None
+        assert constant_error(value) is not None
+    # not a constant at all, ignored
+    assert constant_error({1: 2}) is None
+
+
+@needs_cc
+def test_pattern():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    from .pattern import worm
+
+    source = worm.dump_source()
+    # dense constants are a switch on the value, sparse ones a binary search
+    assert "switch(wm_match_" in source
+    assert " < 404){" in source
+    assert "switch(wm_case_" in source
+    # break and continue in a case jump out of the switch
+    assert "goto wm_break_1;" in source and "goto wm_continue_1;" in source
+    assert run_program(worm) == (
+        "50 175 2 375 600\n"
+        "10 13 15 -1\n"
+        "0 0\n"
+        "0 2 3 3\n"
+        "0 4\n"
+        "5211\n"
+    )
+
+
+@needs_cc
+def test_sum():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    from .sums import worm, Option, Color
+
+    source = worm.dump_source()
+    # niche: Option is a nullable pointer, Color only its tag
+    assert f"typedef int64_t* {Option.name};" in source
+    assert f"typedef uint8_t {Color.name};" in source
+    assert run_program(worm) == (
+        "ok 0.25\n"
+        "error division by zero\n"
+        "0 1 42 -1\n"
+        "1 2 3\n"
+    )
+
+
+@needs_cc
+def test_sum_constructors():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    from ..wtypes import Variant
+    from .sum import worm, Result
+
+    # the constructors of the variants can be put in a scope
+    assert Result.ok == Variant(Result, "ok")
+    with pytest.raises(AttributeError):
+        Result.missing
+    assert run_program(worm) == (
+        "1.414214\ncannot take square root of a negative number.\n"
+    )
+
+
+def test_sum_layout():
+    from ..wtypes import Sum, Struct, to_c_type, void
+
+    many = Sum(**{f"v{i}": void for i in range(300)})
+    assert many.layout == "enum" and many.tag_type == "uint16_t"
+    assert Sum(a=str, b=void).layout == "niche"
+    assert Sum(a=str, b=void, c=void).layout == "tagged"
+    # the tag goes after the union, or before it when the values are narrower
+    wide = Sum(ok=int, error=str).type_to_c(to_c_type).splitlines()
+    assert wide[-2:] == ["uint8_t tag;", "}"]
+    narrow = Sum(**{f"v{i}": bool for i in range(300)}).type_to_c(to_c_type)
+    assert narrow.splitlines()[1] == "uint16_t tag;"
+    assert Sum(p=Struct(x=int), q=void).alignment() == 8
+
+
+def test_invalid_pattern():
+    from .. import worm
+    from ..errors import WormSyntaxError
+    from ..pattern import check_pattern
+    from ..wast import WBinary, WName
+
+    worm.setup_fresh_state()
+    with pytest.raises(WormSyntaxError):
+        check_pattern(WBinary("*", WName("a"), WName("b")))
+
+
+def test_break_outside_loop():
+    from ..errors import WormSyntaxError
+    from ..program import MakeCSource
+    from ..wast import WBreak
+
+    with pytest.raises(WormSyntaxError):
+        MakeCSource().visit(WBreak())
+
+
+@needs_cc
+def test_macros():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    from .macros import worm
+    from ..wast import WName
+
+    # same arguments, same expansion, sharing the statements of the template
+    swap = worm.flat_scope()["swap"]
+    first = swap(a=WName("a"), b=WName("b"))
+    assert swap(a=WName("a"), b=WName("b")) is first
+    assert swap(a=WName("b"), b=WName("c")) is not first
+    assert swap(a=WName("b"), b=WName("c")).statements == first.statements
+
+    assert run_program(worm) == "2 1 3\n2 3 1\n3 2 1\n2 1 3\n"
+    # the template was not changed by the compilation
+    assert not first.statements[0].targets[0].name.startswith("v")
+
+
+@needs_cc
+def test_generic():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    from .templates import worm
+
+    source = worm.dump_source()
+    # Summer(int) is requested twice but emitted once
+    assert source.count("_total(table_int64_t") == 2  # prototype and definition
+    assert source.count("_total(table_double") == 2
+    assert worm.generic_report().splitlines() == [
+        "Summer(int): 1 function(s), 0 class(es), requested 2 time(s)",
+        "Summer(float): 1 function(s), 0 class(es), requested 1 time(s)",
+        "2 instantiation(s), 2 function(s)",
+    ]
+    assert run_program(worm) == "10 0.75 20\n"
+
+
+@needs_cc
+def test_parallel():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    import importlib
+    from . import records
+
+    # already imported by test_std
+    worm = importlib.reload(records).worm
+
+    serial = run_program(worm)
+    source = worm.dump_source(jobs=3)
+    # the fragments are assembled in a deterministic order
+    assert worm.dump_source(jobs=3) == source
+    assert run_program(worm, jobs=3) == serial
+
+
+def test_save_source(tmp_path):
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    import io
+    import importlib
+    from .. import program
+    from . import tables
+
+    # already imported by test_constant_tables
+    worm = importlib.reload(tables).worm
+
+    source = worm.dump_source()
+    path = tmp_path / "prog.c"
+    worm.save_source(str(path))
+    assert path.read_text() == source
+
+    # spill the functions to a temporary file
+    spool_size, program.SPOOL_SIZE = program.SPOOL_SIZE, 16
+    try:
+        out = io.StringIO()
+        worm.save_source(out)
+    finally:
+        program.SPOOL_SIZE = spool_size
+    assert out.getvalue() == source
+
+
+@needs_cc
+def test_line_directives():
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    import io
+    import json
+    import importlib
+    from . import tables
+
+    # already imported by test_constant_tables
+    worm = importlib.reload(tables).worm
+
+    source = worm.dump_source(lines=True)
+    assert f'#line 20 "{tables.__file__}"\nint64_t v' in source
+    assert "#line" not in worm.dump_source()
+    assert run_program(worm, lines=True) == run_program(worm)
+
+    out = io.StringIO()
+    worm.save_symbols(out)
+    symbols = json.loads(out.getvalue())
+    names = {name for symbol, name in symbols.items() if symbol in source}
+    assert {"popcount", "blob_sum", "x", "total", "i", "BLOB"} <= names
+
+
+@needs_cc
+def test_profile(tmp_path):
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    import os
+    import subprocess
+    from ..std.profile import read_report
+    from .profiled import worm
+
+    assert worm.dump_source(profile=["twice"]).count("wm_prof_enter(&") == 1
+
+    exe = str(tmp_path / "prog")
+    report = str(tmp_path / "profile.txt")
+    worm.save_program(exe, profile=True)
+    env = dict(os.environ, WORM_PROFILE=report)
+    res = subprocess.run([exe], capture_output=True, text=True, env=env)
+    assert res.stdout == "330\n"
+    assert res.returncode == 0
+
+    rows = {row["name"]: row for row in read_report(report, worm.program.symbol_map())}
+    assert {name: row["calls"] for name, row in rows.items()} == {
+        "main": 1,
+        "twice": 3,
+        "fib": 3 * 177,
+    }
+    # recursive calls are counted once in the inclusive time
+    assert rows["fib"]["inclusive_ns"] == rows["fib"]["exclusive_ns"]
+    assert rows["twice"]["inclusive_ns"] <= rows["main"]["inclusive_ns"]
+    assert "twice" in worm.profile_report(report)
+
+
+@needs_cc
+def test_save_library(tmp_path):
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    import array
+    import importlib.util
+    from .exported import worm
+
+    worm.save_library(str(tmp_path / "libexported.so"))
+    spec = importlib.util.spec_from_file_location(
+        "exported_bindings", tmp_path / "libexported_bindings.py"
+    )
+    lib = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(lib)
+
+    a = array.array("d", [1.0, 2.0, 3.0])
+    assert lib.dot(a, memoryview(a)) == 14.0
+    assert lib.norm2(array.array("d", [3.0, 4.0]).tobytes()) == 25.0
+    assert lib.count(bytes([1, 0, 1, 1])) == 3
+    # the function writes to the memory of the Python object
+    b = array.array("q", [1, 2, 3])
+    assert lib.scale(b, 3) is None
+    assert b.tolist() == [3, 6, 9]
+
+    with pytest.raises(TypeError):
+        lib.dot(array.array("i", [1, 2, 3]), a)
+    with pytest.raises(TypeError):
+        lib.dot(a)
+
+
+@needs_cc
+def test_jit(tmp_path, monkeypatch):
+    from .. import worm
+    # prevent inter test pollution
+    worm.setup_fresh_state()
+
+    import array
+    import importlib
+    from .. import program
+
+    monkeypatch.setenv("WORM_CACHE", str(tmp_path))
+    from . import jitted
+
+    out = array.array("q", [0] * 10)
+    assert jitted.fibs(out) is None
+    assert out.tolist() == [0, 1, 1, 2, 3, 5, 8, 13, 21, 34]
+    assert jitted.total(array.array("d", [1.0, 2.0, 3.0, 6.0])) == 12.0
+    assert jitted.total.__doc__ == "Sum of the elements of a."
+    # one library per set of compiler options
+    cached = sorted(tmp_path.iterdir())
+    assert len(cached) == 2
+
+    def no_compiler(*args, **kwargs):
+        raise AssertionError("the library was compiled again")
+
+    # a new program with the same source is loaded from the cache
+    worm.setup_fresh_state()
+    jitted = importlib.reload(jitted)
+    monkeypatch.setattr(program.subprocess, "run", no_compiler)
+    assert jitted.total(memoryview(array.array("d", [0.5, 0.25]))) == 0.75
+    assert sorted(tmp_path.iterdir()) == cached
+
+
+def test_invalid_index():
+    from ..errors import WormTypeError
+    from ..prelude import prelude
+    from ..type_checker import PropagateAndCheckTypes
+    from ..wast import WConstant, WGetItem
+
+    with pytest.raises(WormTypeError):
+        PropagateAndCheckTypes(prelude).visit(WGetItem(WConstant(3), WConstant(0)))
+
+
+def test_prototype_hash():
+    from ..native import NativeFunction
+    from ..type_checker import FunctionPrototype
+
+    f = NativeFunction("f", int, float)
+    assert f == FunctionPrototype(int, float)
+    assert hash(f) == hash(FunctionPrototype(int, float))
+    assert len({f, NativeFunction("g", int, float), NativeFunction("h", int)}) == 2
+
+
+def test_deep_refs():
+    from ..wast import Ref
+
+    # as long as the chains of calls of large programs
+    refs = [Ref(int)]
+    for _ in range(10000):
+        refs.append(Ref(refs[-1]))
+    assert refs[-1].deref() is int
+    refs[0].ref(float)
+    assert refs[-1].deref() is float
+
+
+def test_pickled_types():
+    import pickle
+    from ..wtypes import Array, Struct, Sum, void
+
+    t = Sum(ok=Struct(x=int, names=Array[str]), error=void)
+    assert pickle.loads(pickle.dumps(t)) is t
+    assert pickle.loads(pickle.dumps(void)) is void
+
+
+def test_lazy_import():
+    import subprocess
+    import sys
+
+    code = "\n".join(
+        [
+            "import sys",
+            "from worm.transformer import hook",
+            "hook()",
+            "from worm.test.macros import worm",
+            "print('worm.program' in sys.modules)",
+            "worm.dump_source()",
+            "print('worm.program' in sys.modules)",
+        ]
+    )
+    res = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    # the compiler is only loaded to build the program
+    assert res.stdout == "False\nTrue\n"
+
+
+def test_compiler_without_std():
+    import subprocess
+    import sys
+
+    code = "\n".join(
+        [
+            "import sys",
+            "import worm.program",
+            "print(sorted(m for m in sys.modules if m.startswith('worm.std')))",
+        ]
+    )
+    res = subprocess.run(
+        [sys.executable, "-c", code], capture_output=True, text=True, check=True
+    )
+    # the standard library depends on the compiler, not the other way around
+    assert res.stdout == "[]\n"
+
+
+def test_interned_types():
+    from copy import deepcopy
+    from ..wtypes import Array, Struct, Ptr, Table, to_c_type
+
+    assert Array[int] is Array[int]
+    assert Ptr(Array[float]) is Ptr(Array[float])
+    assert Struct(x=int, y=float) is Struct(x=int, y=float)
+    assert Struct(x=int, y=float) is not Struct(y=float, x=int)
+    # same type built from different arguments
+    assert Table[int] is Table[int, "int64_t"]
+    assert deepcopy(Array[str]) is Array[str]
+    assert len({Array[int], Array[int], Array[float]}) == 2
+    assert to_c_type(Ptr(Array[int])) == "array_int64_t*"
+
+
 # def test_quote():
 #     from .quote import worm, __doc__
 #     assert worm.dump_source() == __doc__
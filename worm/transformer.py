@@ -314,7 +314,7 @@ class RewriteWorm(ast.NodeTransformer):
     def visit_NamedExpr(self, node):
         raise NotImplementedError()
 
-    def visit_SubScript(self, node):
+    def visit_Subscript(self, node):
         if isinstance(node.ctx, Load):
             return make_node(
                 node,
@@ -366,7 +366,7 @@ class RewriteWorm(ast.NodeTransformer):
             values=[
                 copy_loc(node.target, List(elts=[self.visit(node.target)], ctx=Load())),
                 self.visit(node.value),
-                self.visit(node.annotation or copy_loc(node, Constant(None))),
+                self.visit_annotation(node.annotation or copy_loc(node, Constant(None))),
             ],
         )
 
@@ -570,15 +570,27 @@ class RewriteWorm(ast.NodeTransformer):
                 docstring,
             ],
         )
+        # the file of the function, for the #line directives of the C source
+        func.keywords.append(keyword(arg="src_file", value=source_file(node)))
 
         return reduce(compose_dec, reversed(node.decorator_list), func)
 
     def visit_arg(self, node):
-        annot = self.visit(node.annotation or copy_loc(node, Constant(None)))
+        annot = self.visit_annotation(node.annotation or copy_loc(node, Constant(None)))
         return make_node(
             node, "arg", values=[copy_loc(node, Constant(node.arg)), annot]
         )
 
+    def visit_annotation(self, node):
+        """
+        Names are resolved in the Worm scope, other type expressions (Array[int],
+        Ptr(void)...) are evaluated by Python.
+        """
+        if isinstance(node, (Name, Constant)):
+            return self.visit(node)
+        else:
+            return node
+
     def visit_Return(self, node):
         return make_node(
             node,
@@ -681,6 +693,21 @@ def copy_loc(src, dest):
     return dest
 
 
+def source_file(node):
+    """
+    Return an expression evaluating to the file of the module at python
+    runtime, or None (in the interactive console).
+    """
+    globals_ = copy_loc(
+        node,
+        Call(func=copy_loc(node, Name(id="globals", ctx=Load())), args=[], keywords=[]),
+    )
+    get = copy_loc(node, Attribute(value=globals_, attr="get", ctx=Load()))
+    return copy_loc(
+        node, Call(func=get, args=[copy_loc(node, Constant("__file__"))], keywords=[])
+    )
+
+
 def get_loc(node):
     return [
         node.lineno,
@@ -704,7 +731,15 @@ def make_assign(target, value):
 
 
 def is_quoting(f):
-    if isinstance(f, Name):
+    if isinstance(f, Call):
+        # decorator with options: @worm.jit(cflags=[...])
+        return (
+            isinstance(f.func, Attribute)
+            and isinstance(f.func.value, Name)
+            and f.func.value.id == "worm"
+            and f.func.attr == "jit"
+        )
+    elif isinstance(f, Name):
         return f.id == "worm"
     elif isinstance(f, Attribute):
         return (
@@ -714,7 +749,9 @@ def is_quoting(f):
             in {
                 "block",
                 "entry",
+                "export",
                 "exported",
+                "jit",
                 "method",
             }
         )
@@ -1,9 +1,10 @@
 from functools import reduce
 
 from .errors import WormTypeError, WormBindingError
+from .pattern import typed_bindings
 from .visitor import WormVisitor
-from .wtypes import void, Ptr, Deref, SimpleType, Struct, Array
-from .wast import WName, WStoreName, WConstant, Ref, merge_types
+from .wtypes import void, Ptr, Deref, SimpleType, Struct, Array, Table, Sum
+from .wast import WName, WStoreName, WSetItem, WConstant, Ref, merge_types
 
 
 class ResolveTypes(WormVisitor):
@@ -82,6 +83,8 @@ class AnnotateSymbols(WormVisitor):
                     if not node.type.deref():
                         node.type = Missing(node.src_pos)
                     self.symbol_table[name] = Ref(node.type)
+            elif isinstance(target, WSetItem):
+                pass
             else:
                 raise NotImplementedError(
                     f"Assignement to complex target: expected {WStoreName} but got {type(target)}."
@@ -103,6 +106,7 @@ class PropagateAndCheckTypes(WormVisitor):
 
     def visit_topLevel(self, node):
         self.symbol_table = node.symbol_table
+        self.natives = node.natives
 
         return super().visit_topLevel(node)
 
@@ -115,7 +119,7 @@ class PropagateAndCheckTypes(WormVisitor):
         if node.elements:
             node.type = reduce(merge_types, (e.type for e in node.elements))
             if node.type.deref() is not None:
-                node.type = Array[node.elements[0].type]
+                node.type = Array[node.elements[0].type.deref()]
             else:
                 raise WormTypeError("Non homogeneous array.", at=node.src_pos)
         else:
@@ -141,12 +145,17 @@ class PropagateAndCheckTypes(WormVisitor):
 
     def visit_ptr(self, node):
         node.value = self.visit(node.value)
-        node.type = Ptr(node.value.type)
+        node.type = Ptr(node.value.type.deref())
         return node
 
     def visit_deref(self, node):
         node.value = self.visit(node.value)
-        node.type = Deref(node.value.type)
+        pointer = node.value.type.deref()
+        if isinstance(pointer, Ptr):
+            node.type = Ref(pointer.pointed_type)
+        else:
+            node.type = Deref(node.value.type)
+        return node
 
     def visit_binary(self, node):
         # FIXME take operator overloading in account
@@ -204,7 +213,28 @@ class PropagateAndCheckTypes(WormVisitor):
         return node
 
     def visit_getItem(self, node):
-        raise NotImplementedError("Type of item")
+        node.value = self.visit(node.value)
+        node.slice = self.visit(node.slice)
+        t = node.value.type.deref()
+        if not isinstance(t, (Array, Table)):
+            raise WormTypeError(
+                f"Only arrays and tables can be indexed, not {t}.", at=node.src_pos
+            )
+        if node.slice.type.deref() != int:
+            raise WormTypeError(
+                "Array index must be an int.",
+                at=node.src_pos,
+                expect=int,
+                got=node.slice.type,
+            )
+        node.type = t.element_type
+        return node
+
+    def visit_setItem(self, node):
+        node = self.visit_getItem(node)
+        if isinstance(node.value.type.deref(), Table):
+            raise WormTypeError("Tables are read only.", at=node.src_pos)
+        return node
 
     def visit_slice(self, node):
         raise NotImplementedError("Type of slice")
@@ -214,7 +244,17 @@ class PropagateAndCheckTypes(WormVisitor):
         if len(node.targets) != 1:
             raise NotImplementedError("Multiple target")
         target = node.targets[0]
-        if not isinstance(target, WStoreName):
+        if isinstance(target, WSetItem):
+            node.targets = [self.visit(target)]
+            if node.value.type.deref() != node.targets[0].type.deref():
+                raise WormTypeError(
+                    "Incompatible type in item assignment.",
+                    at=node.src_pos,
+                    expect=node.targets[0].type,
+                    got=node.value.type,
+                )
+            return node
+        elif not isinstance(target, WStoreName):
             raise NotImplementedError(
                 f"Assignement to complex target: expected {WStoreName} but got {type(target)}."
             )
@@ -231,6 +271,39 @@ class PropagateAndCheckTypes(WormVisitor):
 
         return node
 
+    def visit_match(self, node):
+        node.subject = self.visit(node.subject)
+        subject_type = node.subject.type.deref()
+        if subject_type != int and not isinstance(subject_type, Sum):
+            raise WormTypeError(
+                "Only int and Sum values can be matched.",
+                at=node.src_pos,
+                got=node.subject.type,
+            )
+        cases = []
+        for pattern, body in node.cases:
+            for name, type_ in typed_bindings(pattern, subject_type):
+                name.type = type_
+                self.symbol_table[name.name] = Ref(type_)
+            cases.append((pattern, self.visit(body)))
+        node.cases = cases
+        node.orelse = self.visit(node.orelse)
+        return node
+
+    def visit_variant(self, node):
+        expected = node.sum_type.variants[node.variant]
+        if node.value is not None:
+            node.value = self.visit(node.value)
+            if not check_type(expected, node.value):
+                raise WormTypeError(
+                    f"Incompatible value for the variant {node.variant}.",
+                    at=node.src_pos,
+                    expect=expected,
+                    got=node.value.type,
+                )
+        node.type = node.sum_type
+        return node
+
     def visit_funcDef(self, node):
         self.current_function_return.append(Ref(node.returns))
         res = super().visit_funcDef(node)
@@ -269,6 +342,14 @@ class PropagateAndCheckTypes(WormVisitor):
                 at=node.src_pos,
             )
 
+        if hasattr(proto, "specialize"):
+            # the prototype generates a native function dedicated to this call
+            native, args = proto.specialize(*node.args)
+            self.natives[native.name] = native
+            node.func = WName(native.name).copy_common(node.func)
+            node.args = list(args)
+            proto = native
+
         node.type = proto.returns
         return node
 
@@ -284,6 +365,21 @@ class FunctionPrototype:
     def check_args(self, *args):
         return all(check_type(ref, arg) for ref, arg in zip(self.args, args))
 
+    def __eq__(self, other):
+        """
+        Prototypes are equal when they have the same signature, which allows
+        passing a function where a callback is expected.
+        """
+        return (
+            isinstance(other, FunctionPrototype)
+            and len(self.args) == len(other.args)
+            and self.returns.deref() == other.returns.deref()
+            and all(a.deref() == b.deref() for a, b in zip(self.args, other.args))
+        )
+
+    def __hash__(self):
+        return hash((len(self.args), self.returns.deref()))
+
 
 def check_type(expected, instance):
     if isinstance(expected, Ref):
@@ -13,6 +13,7 @@ from .wast import (
     WBoolOp,
     WCompare,
     WCall,
+    WVariant,
     WIfExpr,
     WGetAttr,
     WSetAttr,
@@ -24,6 +25,7 @@ from .wast import (
     WAssert,
     WDel,
     WIf,
+    WMatch,
     WFor,
     WWhile,
     WFuncDef,
@@ -72,10 +74,10 @@ class WormVisitor:
         return WUnary(node.op, self.visit(node.operand)).copy_common(node)
 
     def visit_ptr(self, node):
-        return WPtr(node.value).copy_common(node)
+        return WPtr(self.visit(node.value)).copy_common(node)
 
     def visit_deref(self, node):
-        return WDeref(node.value).copy_common(node)
+        return WDeref(self.visit(node.value)).copy_common(node)
 
     def visit_binary(self, node):
         return WBinary(node.op, *map(self.visit, (node.left, node.right))).copy_common(
@@ -102,6 +104,11 @@ class WormVisitor:
             {arg: self.visit(val) for arg, val in node.kwargs.items()},
         ).copy_common(node)
 
+    def visit_variant(self, node):
+        return WVariant(
+            node.sum_type, node.variant, self.visit(node.value)
+        ).copy_common(node)
+
     def visit_ifExpr(self, node):
         return WIfExpr(
             *map(self.visit, (node.test, node.body, node.orelse))
@@ -114,10 +121,10 @@ class WormVisitor:
         return WSetAttr(self.visit(node.value), node.attr).copy_common(node)
 
     def visit_getItem(self, node):
-        return WGetItem(*map(self.visit, (node.value, node.slice_))).copy_common(node)
+        return WGetItem(*map(self.visit, (node.value, node.slice))).copy_common(node)
 
     def visit_setItem(self, node):
-        return WSetItem(*map(self.visit, (node.value, node.slice_))).copy_common(node)
+        return WSetItem(*map(self.visit, (node.value, node.slice))).copy_common(node)
 
     def visit_slice(self, node):
         return WSlice(
@@ -144,6 +151,13 @@ class WormVisitor:
             node
         )
 
+    def visit_match(self, node):
+        return WMatch(
+            self.visit(node.subject),
+            [(self.visit(pattern), self.visit(body)) for pattern, body in node.cases],
+            self.visit(node.orelse),
+        ).copy_common(node)
+
     def visit_for(self, node):
         return WFor(
             *map(
@@ -25,12 +25,24 @@ class WAst:
 
 
 class WTopLevel(WAst):
-    def __init__(self, *, entry=None, functions=(), headers=(), exported=(), **kwargs):
+    def __init__(
+        self,
+        *,
+        entry=None,
+        functions=(),
+        headers=(),
+        exported=(),
+        natives=None,
+        constants=None,
+        **kwargs,
+    ):
         super().__init__(**kwargs)
         self.entry = entry
         self.functions = list(functions)
         self.headers = list(headers)
         self.exported = set(exported)
+        self.natives = natives or {}
+        self.constants = constants or {}
         self.symbol_table = {}
         self.required = {}
 
@@ -38,6 +50,8 @@ class WTopLevel(WAst):
         if isinstance(other, WTopLevel):
             self.symbol_table = other.symbol_table
             self.required = other.required
+            self.natives = other.natives
+            self.constants = other.constants
 
         return super().copy_common(other)
 
@@ -62,12 +76,16 @@ class WBlock(WStatement):
         self.statements = list(statements)
         self.injected = {}
         self.hygienic = False
+        # file of the statements when it is not the file of the function
+        # (expansions of worm.block)
+        self.src_file = None
 
     def copy_common(self, other):
         super().copy_common(other)
         if isinstance(other, WBlock):
             self.injected = other.injected
             self.hygienic = other.hygienic
+            self.src_file = other.src_file
         return self
 
 
@@ -154,6 +172,19 @@ class WCompare(WExpr):
         self.rest = rest
 
 
+class WVariant(WExpr):
+    """
+    Value of the variant variant of the Sum type sum_type, value is None for
+    variants without value. Written Result.ok(value) in Worm code.
+    """
+
+    def __init__(self, sum_type, variant, value, **kwargs):
+        super().__init__(**kwargs)
+        self.sum_type = sum_type
+        self.variant = variant
+        self.value = value
+
+
 class WCall(WExpr):
     def __init__(self, func, args, func_kwargs, **kwargs):
         super().__init__(**kwargs)
@@ -247,6 +278,19 @@ class WIf(WStatement):
         self.orelse = orelse
 
 
+class WMatch(WStatement):
+    """
+    Pattern matching of subject: cases is a list of (pattern, body) tried in
+    order, orelse is executed when no pattern matches (see worm.pattern).
+    """
+
+    def __init__(self, subject, cases, orelse, **kwargs):
+        super().__init__(**kwargs)
+        self.subject = subject
+        self.cases = list(cases)
+        self.orelse = orelse
+
+
 class WFor(WStatement):
     def __init__(self, target, iter, body, orelse, **kwargs):
         super().__init__(**kwargs)
@@ -273,10 +317,14 @@ class WContinue(WStatement):
 
 
 class WFuncDef(WStatement):
-    def __init__(self, name, args, defaults, body, returns, docstring=None, **kwargs):
+    def __init__(
+        self, name, args, defaults, body, returns, docstring=None, src_file=None, **kwargs
+    ):
         super().__init__(**kwargs)
         self.name = name
         self.docstring = docstring
+        # file the function was written in, None if unknown
+        self.src_file = src_file
         self.args = list(args)
         self.defaults = list(defaults)
         self.body = body
@@ -307,6 +355,9 @@ class WFuncDef(WStatement):
         if isinstance(other, WFuncDef):
             self.attached = other.attached
             self.docstring = other.docstring
+            self.src_file = other.src_file
+            # the function as defined by the user, before any compiler pass
+            self.origin = getattr(other, "origin", other)
         return self
 
 
@@ -345,6 +396,7 @@ class WPtr(WPrimitiveExpr):
     _primitive = True
 
     def __init__(self, *args, **kwargs):
+        super().__init__()
         if len(args) != 1:
             raise WormTypeError("ptr must be applied to exaclty one value.")
         val = args[0]
@@ -358,6 +410,7 @@ class WDeref(WPrimitiveExpr):
     _primitive = True
 
     def __init__(self, *args, **kwargs):
+        super().__init__()
         if len(args) != 1:
             raise WormTypeError("deref must be applied to exaclty one value.")
         val = args[0]
@@ -372,10 +425,14 @@ class Ref:
         self.refered = value
 
     def _root(self):
-        if isinstance(self.refered, Ref):
-            return self.refered._root()
-        else:
-            return self
+        root = self
+        while isinstance(root.refered, Ref):
+            root = root.refered
+        # path compression, the chains grow with the size of the program
+        node = self
+        while node is not root:
+            node.refered, node = root, node.refered
+        return root
 
     def deref(self):
         return self._root().refered
@@ -6,14 +6,25 @@ Summary:
   (which is a subclasses of WormType)
 - type derivated from an higher order type are instance of class defining the higer order type
 - higher order types are not types themself and must be specialized to be used
+- higher order types are hash-consed: building the same type twice returns the
+  same instance, so they are compared and hashed by identity
+- types keep their identity through pickling: a pickled type is rebuilt from its
+  constructor arguments (higher order types) or its name (simple types)
 """
-from uuid import uuid1
+from hashlib import sha1
+import itertools
+import threading
+
+
+_ids = itertools.count(1)
+# protects the interning tables and the name counter
+_intern_lock = threading.RLock()
 
 
 class WormType:
     def __init__(self):
         self.methods = {}
-        self.id = uuid1()
+        self.id = next(_ids)
 
     def value_to_c(self, value):
         raise NotImplementedError("This type does not have literal values.")
@@ -33,6 +44,12 @@ class WormType:
     def get_attr(self, attr, default=None):
         return default
 
+    def dependencies(self):
+        """
+        Return the types that must be declared before this one.
+        """
+        return []
+
 
 class MetaHigherOrderType(type):
     def __getitem__(self, params):
@@ -41,10 +58,42 @@ class MetaHigherOrderType(type):
         else:
             return self.specialize(params)
 
+    def __call__(cls, *args, **kwargs):
+        """
+        Return the interned instance for these arguments, building it the
+        first time.
+        """
+        try:
+            key = (cls, args, tuple(kwargs.items()))
+            return HigherOrderType.calls[key]
+        except KeyError:
+            pass
+        except TypeError:
+            # unhashable arguments, only the caracteristic is interned
+            key = None
+
+        with _intern_lock:
+            instance = super().__call__(*args, **kwargs)
+            instance._init_args = (args, kwargs)
+            # different arguments may build the same type (defaults...)
+            instance = HigherOrderType.interned.setdefault(
+                instance.caracteristic, instance
+            )
+            if key is not None:
+                HigherOrderType.calls[key] = instance
+        return instance
+
 
 class HigherOrderType(WormType, metaclass=MetaHigherOrderType):
+    # caracteristic to the unique instance
+    interned = {}
+    # constructor arguments to the unique instance
+    calls = {}
     type_names = {}
-    name_counter = [0]
+    name_counter = itertools.count(1)
+    # name new types after their content instead of a counter, used where
+    # several processes create types concurrently (see Program.write_source)
+    content_names = False
 
     def __init__(self, basename, *args):
         """
@@ -53,9 +102,13 @@ class HigherOrderType(WormType, metaclass=MetaHigherOrderType):
         super().__init__()
         self.caracteristic = (self.__class__.__name__, *args)
         self.id = self.unique_id(basename, *args)
-        if self.id not in self.type_names:
-            self.name_counter[0] += 1
-            self.type_names[self.id] = f"{basename}_{self.name_counter[0]}"
+        with _intern_lock:
+            if self.id not in self.type_names:
+                if HigherOrderType.content_names:
+                    suffix = sha1(repr(_stable_key(args)).encode()).hexdigest()[:10]
+                else:
+                    suffix = next(self.name_counter)
+                self.type_names[self.id] = f"{basename}_{suffix}"
 
         self.name = self.type_names[self.id]
 
@@ -68,24 +121,64 @@ class HigherOrderType(WormType, metaclass=MetaHigherOrderType):
     def declaration(self, to_c):
         return f"typedef {self.type_to_c(to_c)} {self.name};"
 
-    def __eq__(self, other):
-        return (
-            isinstance(other, HigherOrderType)
-            and len(self.caracteristic) == len(other.caracteristic)
-            and all(s == o for s, o in zip(self.caracteristic, other.caracteristic))
-        )
+    # instances are unique, the default identity equality and hash apply
 
-    def __hash__(self):
-        return hash(self.caracteristic)
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        args, kwargs = self._init_args
+        return (_rebuild, (type(self), args, kwargs, self.name))
 
     @classmethod
     def specialize(cls, *args, **kwargs):
         return cls(*args, **kwargs)
 
 
+def _rebuild(cls, args, kwargs, name):
+    with _intern_lock:
+        known = len(HigherOrderType.interned)
+        instance = cls(*args, **kwargs)
+        if len(HigherOrderType.interned) > known:
+            # new here, keep the name given by the process that built it
+            instance.name = name
+    return instance
+
+
+def _stable_key(value):
+    """
+    Representation of value that does not depend on the process.
+    """
+    if isinstance(value, (HigherOrderType, SimpleType)):
+        return value.name
+    elif isinstance(value, type):
+        return value.__name__
+    elif isinstance(value, (tuple, list)):
+        return tuple(map(_stable_key, value))
+    return repr(value)
+
+
+# name to simple type, to keep their identity through pickling
+_simple_types = {}
+
+
+def _simple_type(name):
+    return _simple_types.get(name) or SimpleType(name)
+
+
 class SimpleType(WormType):
     def __init__(self, name):
         self.name = name
+        if type(self) is SimpleType:
+            _simple_types.setdefault(name, self)
+
+    def __reduce_ex__(self, protocol):
+        if _simple_types.get(self.name) is self:
+            return (_simple_type, (self.name,))
+        return super().__reduce_ex__(protocol)
 
     def type_to_c(self, _):
         return self.name
@@ -107,6 +200,9 @@ class Ptr(Primitive):
     def is_declared(self):
         return False
 
+    def dependencies(self):
+        return [self.pointed_type]
+
 
 class Deref(HigherOrderType):
     def __init__(self, derefed_type):
@@ -133,6 +229,9 @@ class Struct(Primitive):
     def get_attr(self, name, default=None):
         return self.fields.get(name, default)
 
+    def dependencies(self):
+        return list(self.fields.values())
+
     def type_to_c(self, other_to_c):
         code = ["struct {"]
         for name, type in self.fields.items():
@@ -152,6 +251,9 @@ class CArray(Primitive):
         self.elements_type = elements_type
         self.size = size
 
+    def dependencies(self):
+        return [self.elements_type]
+
     def type_to_c(self, other_to_c):
         return (
             other_to_c(self.elements_type) + "[]"
@@ -161,24 +263,243 @@ class CArray(Primitive):
 
 
 class Array(HigherOrderType):
+    """
+    A length and a pointer to the elements, the elements are not owned by the
+    array value.
+    """
+
     def __init__(self, element_type):
         super().__init__("array", element_type)
         self.element_type = element_type
-        self.struct = Struct(len=int, elems=self.element_type)
+        if element_type in {int, float, bool, str} or isinstance(
+            element_type, WormType
+        ):
+            # predictable name so that native code can refer to the type
+            self.name = "array_" + c_identifier(to_c_type(element_type))
+
+    def type_to_c(self, other_to_c):
+        return "\n".join(
+            [
+                "struct {",
+                f"{other_to_c(int)} length;",
+                f"{other_to_c(self.element_type)}* elems;",
+                "}",
+            ]
+        )
 
     def value_to_c(self, elements):
-        return f"{{.length={len(elements)}, .elements={{"
-        +", ".join(elements)
-        +"}}"
+        element = to_c_type(self.element_type)
+        return (
+            f"({self.name}){{.length={len(elements)}, .elems=({element}[]){{"
+            + ", ".join(elements)
+            + "}}"
+        )
+
+    def expose_attr(self, name):
+        return name == "length"
+
+    def get_attr(self, name, default=None):
+        return int if name == "length" else default
+
+    def dependencies(self):
+        return [self.element_type]
 
     def to_primitives(self):
-        return self.struct
+        return Struct(length=int, elems=Ptr(self.element_type))
+
+
+class Table(HigherOrderType):
+    """
+    Read only array of constants (see worm.constants). The elements are stored
+    with the C type storage and read as element_type (int or float), so a
+    table of bytes uses one byte per element.
+    """
+
+    def __init__(self, element_type, storage=None):
+        storage = storage or to_c_type(element_type)
+        super().__init__("table", element_type, storage)
+        self.element_type = element_type
+        self.storage = storage
+        self.name = "table_" + c_identifier(storage)
+
+    def type_to_c(self, other_to_c):
+        return "\n".join(
+            [
+                "struct {",
+                f"{other_to_c(int)} length;",
+                f"{self.storage} const* elems;",
+                "}",
+            ]
+        )
+
+    def expose_attr(self, name):
+        return name == "length"
+
+    def get_attr(self, name, default=None):
+        return int if name == "length" else default
+
+
+class Sum(HigherOrderType):
+    """
+    Tagged union: a value of one of the variants, each variant holding a
+    value of its type or nothing (void).
+
+    The layout is as small as possible:
+    - without any value, a Sum is its tag
+    - with a pointer (or str) variant and a void variant, a Sum is a nullable
+      pointer, NULL being the void variant
+    - else a union of the values followed by the tag, members ordered by
+      decreasing alignment to avoid padding
+
+    The tag is the smallest unsigned integer able to number the variants.
+
+    The variants are also attributes of the type, Result.ok is the constructor
+    of the variant ok that can be put in a scope: worm.scope(ok=Result.ok)
+    lets Worm code write ok(x) for Result.ok(x).
+    """
+
+    def __init__(self, **variants):
+        super().__init__("sum", tuple(variants.items()))
+        self.variants = {
+            name: void if type_ is None else type_ for name, type_ in variants.items()
+        }
+        self.tags = {name: i for i, name in enumerate(self.variants)}
+        self.tag_type = next(
+            f"uint{bits}_t" for bits in (8, 16, 32) if len(self.variants) <= 1 << bits
+        )
+
+        values = [name for name, type_ in self.variants.items() if type_ is not void]
+        empty = [name for name, type_ in self.variants.items() if type_ is void]
+        if not values:
+            self.layout = "enum"
+        elif len(values) == 1 and len(empty) == 1 and _nullable(self.variants[values[0]]):
+            self.layout = "niche"
+            self.pointer_variant, self.null_variant = values[0], empty[0]
+        else:
+            self.layout = "tagged"
+
+    def type_to_c(self, other_to_c):
+        if self.layout == "enum":
+            return self.tag_type
+        elif self.layout == "niche":
+            return other_to_c(self.variants[self.pointer_variant])
+
+        union = ["union {"]
+        for name, type_ in self.variants.items():
+            if type_ is not void:
+                union.append(f"{other_to_c(type_)} {name};")
+        union.append("} as;")
+        members = [(self.alignment(only_values=True), "\n".join(union))]
+        members.append((_tag_sizes[self.tag_type], f"{self.tag_type} tag;"))
+        members.sort(key=lambda m: -m[0])
+        return "\n".join(["struct {", *(code for _, code in members), "}"])
+
+    def alignment(self, only_values=False):
+        """
+        Alignment of the C type in bytes (estimated for foreign types).
+        """
+        if self.layout == "enum":
+            return _tag_sizes[self.tag_type]
+        values = [_alignment(t) for t in self.variants.values() if t is not void]
+        if not only_values and self.layout == "tagged":
+            values.append(_tag_sizes[self.tag_type])
+        return max(values)
+
+    def dependencies(self):
+        return [t for t in self.variants.values() if t is not void]
+
+    def construct(self, variant, value=None):
+        """
+        C expression of the variant holding value (a C expression).
+        """
+        tag = self.tags[variant]
+        if self.layout == "enum":
+            return f"(({self.name}){tag})"
+        elif self.layout == "niche":
+            return value if variant == self.pointer_variant else f"(({self.name})NULL)"
+        elif value is None:
+            return f"(({self.name}){{.tag={tag}}})"
+        return f"(({self.name}){{.as.{variant}={value}, .tag={tag}}})"
+
+    def tag_of(self, value):
+        """
+        C expression of the tag of the C expression value.
+        """
+        if self.layout == "enum":
+            return value
+        elif self.layout == "niche":
+            null, pointer = self.tags[self.null_variant], self.tags[self.pointer_variant]
+            return f"({value} == NULL ? {null} : {pointer})"
+        return f"{value}.tag"
+
+    def payload_of(self, value, variant):
+        """
+        C expression of the value of the variant held by the C expression value.
+        """
+        if self.layout == "niche":
+            return value
+        return f"{value}.as.{variant}"
+
+    def __getattr__(self, name):
+        # only called for names that are not regular attributes
+        if name in self.__dict__.get("variants", ()):
+            return Variant(self, name)
+        raise AttributeError(f"{self} has no variant {name}.")
+
+
+class Variant:
+    """
+    Constructor of the variant name of sum_type, see Sum.
+    """
+
+    def __init__(self, sum_type, name):
+        self.sum_type = sum_type
+        self.name = name
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, Variant)
+            and self.sum_type is other.sum_type
+            and self.name == other.name
+        )
+
+    def __hash__(self):
+        return hash((self.sum_type, self.name))
+
+    def __repr__(self):
+        return f"Variant({self.sum_type}, '{self.name}')"
+
+
+_tag_sizes = {"uint8_t": 1, "uint16_t": 2, "uint32_t": 4}
+
+
+def _nullable(type_):
+    return type_ == str or isinstance(type_, Ptr)
+
+
+def _alignment(type_):
+    if type_ == bool or type_ is char:
+        return 1
+    elif isinstance(type_, Struct):
+        return max(map(_alignment, type_.fields.values()), default=1)
+    elif isinstance(type_, Sum):
+        return type_.alignment()
+    # int, float, pointers and structures starting with pointers or int64_t
+    return 8
 
 
 void = SimpleType("void")
 char = SimpleType("char")
 
 
+def gc_managed(type_):
+    """
+    Whether values of type_ may point to memory of the collector (see
+    worm.std.gc).
+    """
+    return type_ == str or getattr(type_, "gc_managed", False)
+
+
 def to_c_type(type_):
     if type_ == int:
         return "int64_t"
@@ -188,17 +509,34 @@ def to_c_type(type_):
         return "double"
     elif type_ == str:
         return "char*"
+    elif isinstance(type_, HigherOrderType):
+        # interned and immutable, the translation is computed once
+        c_type = type_.__dict__.get("c_type")
+        if c_type is None:
+            c_type = type_.c_type = _to_c_type(type_)
+        return c_type
     elif isinstance(type_, WormType):
-        if type_.is_declared():
-            return type_.name
-        elif hasattr(type_, "to_primitives"):
-            return to_c_type(type_.to_primitives())
-        else:
-            return type_.type_to_c(to_c_type)
+        return _to_c_type(type_)
     else:
         raise NotImplementedError(f"{type_} is not a valid type.")
 
 
+def _to_c_type(type_):
+    if type_.is_declared():
+        return type_.name
+    elif hasattr(type_, "to_primitives") and type_.to_primitives() is not type_:
+        return to_c_type(type_.to_primitives())
+    else:
+        return type_.type_to_c(to_c_type)
+
+
+def c_identifier(c_type):
+    """
+    Turn a C type into something usable in an identifier.
+    """
+    return c_type.replace("*", "p").replace(" ", "_")
+
+
 def merge_types(a, b):
     """
     Should be used to merge partial types.